@@ -3,3 +3,11 @@ from django.apps import AppConfig
 
 class DatabaseConfig(AppConfig):
     name = 'database'
+    
+    def ready(self):
+        from dope.settings import WRITE_BEHIND_SAVES, WRITE_BEHIND_FLUSHER
+        
+        if WRITE_BEHIND_SAVES and WRITE_BEHIND_FLUSHER:
+            # Flushes any saves journaled before a restart, without waiting for a new one
+            from .write_behind import start_flusher
+            start_flusher()
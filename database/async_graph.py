@@ -0,0 +1,181 @@
+"""
+Async access to the graph for the ASGI views (database.async_views).
+
+The named statements of database.cypher are run on the Neo4j driver's async API, so a
+request waiting on Bolt I/O doesn't tie up a worker thread.  On any other graph backend
+(i.e. the in-memory one) the same statements run on a worker thread via sync_to_async.
+"""
+
+from neo4j import AsyncGraphDatabase
+from asgiref.sync import sync_to_async
+from dope.settings import NEOMODEL_NEO4J_BOLT_URL
+from dope.retry import graph_retry_policy
+from .graph_backend import graph_backend
+from .graph_instrumentation import record_graph_query
+from .models import QuiverDiagram, Diagram, lease_params
+from . import cypher
+from urllib.parse import urlsplit
+import time
+
+_driver = None
+
+
+def async_driver():
+    global _driver
+
+    if _driver is None:
+        url = urlsplit(NEOMODEL_NEO4J_BOLT_URL)
+        auth = (url.username, url.password) if url.username else None
+        _driver = AsyncGraphDatabase.driver(
+            f'{url.scheme}://{url.hostname}:{url.port or 7687}', auth=auth)
+
+    return _driver
+
+
+def uses_driver() -> bool:
+    return graph_backend().name == 'neo4j'
+
+
+async def _run(tx, name:str, params:dict, shape:dict) -> list:
+    query = cypher.statement_text(name, **shape)
+    start = time.perf_counter()
+
+    try:
+        result = await tx.run(query, params)
+        rows = [list(record.values()) async for record in result]
+    finally:
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        cypher.record_statement(name, elapsed_ms)
+
+    record_graph_query(query, elapsed_ms, len(rows))
+    return rows
+
+
+async def run(name:str, params:dict=None, **shape) -> list:
+    """
+    Runs the named statement in a transaction of its own and returns its result rows.
+    """
+    if not uses_driver():
+        results, meta = await sync_to_async(cypher.run)(name, params, **shape)
+        return results
+
+    results = await graph_retry_policy.acall(_run_transaction, [(name, params or {})], **shape)
+    return results[0]
+
+
+async def _run_transaction(statements, **shape) -> list:
+    async with async_driver().session() as session:
+        tx = await session.begin_transaction()
+
+        try:
+            results = []
+
+            for name, params in statements:
+                results.append(await _run(tx, name, params, shape))
+
+            await tx.commit()
+            return results
+        finally:
+            await tx.close()    # Rolls back unless committed
+
+
+async def revision_by_name(name:str, Model=Diagram):
+    Model.check_name(name)
+    results = await run('revision_by_name', {'name': name}, label=Model.__label__)
+    return Model.revision_from_results(name, results)
+
+
+async def checkout(name:str, username:str, Model=Diagram):
+    """
+    The async counterpart of QuiverDiagram.checkout.
+    """
+    Model.check_name(name)
+    results = await run('checkout_diagram', lease_params(name=name, username=username),
+                        label=Model.__label__)
+    return Model.revision_from_results(name, results)
+
+
+async def quiver_format_by_uid(diagram_uid:str):
+    results = await run('editor_rows', {'diagram_uid': diagram_uid})
+    return QuiverDiagram.quiver_format_from_rows(*QuiverDiagram.editor_rows_from_results(results))
+
+
+async def update_from_editor(diagram_uid:str, format, base_revision:int=None) -> int:
+    """
+    The async counterpart of QuiverDiagram.update_from_editor.  Returns the new revision.
+    """
+    def statements(stored_vertices, stored_edges):
+        return QuiverDiagram.update_statements(diagram_uid, format, stored_vertices, stored_edges) + \
+            [('bump_revision', QuiverDiagram.bump_params(
+                diagram_uid, QuiverDiagram.format_counts(format)))]
+
+    return await run_save(diagram_uid, statements, base_revision)
+
+
+async def patch_from_editor(diagram_uid:str, base_revision:int, ops:list) -> int:
+    """
+    The async counterpart of QuiverDiagram.patch_from_editor.  Returns the new revision.
+    """
+    def statements(stored_vertices, stored_edges):
+        format = QuiverDiagram.patched_format(stored_vertices, stored_edges, ops)
+        return QuiverDiagram.update_statements(diagram_uid, format, stored_vertices, stored_edges) + \
+            [('bump_revision', QuiverDiagram.bump_params(
+                diagram_uid, QuiverDiagram.format_counts(format)))]
+
+    return await run_save(diagram_uid, statements, base_revision)
+
+
+async def run_save(diagram_uid:str, statements, base_revision:int=None) -> int:
+    """
+    Runs a save in one transaction:  takes the diagram's write lock (checking that it's 
+    still at base_revision if given, else raising RevisionConflict), reads its stored rows,
+    then runs the (name, params) list that statements(stored_vertices, stored_edges) makes
+    of them.  The last statement must return the new revision, which is returned.
+    """
+    if not uses_driver():
+        def save():
+            with graph_backend().transaction():
+                results, meta = cypher.run('lock_revision', {'diagram_uid': diagram_uid})
+                if base_revision is not None:
+                    QuiverDiagram.check_revision(results, base_revision)
+                rows = QuiverDiagram.editor_rows_by_uid(diagram_uid)
+                for name, params in statements(*rows):
+                    results, meta = cypher.run(name, params)
+                return results[0][0]
+
+        return await sync_to_async(save)()
+
+    return await graph_retry_policy.acall(_run_save_transaction, diagram_uid, statements,
+                                          base_revision)
+
+
+async def _run_save_transaction(diagram_uid:str, statements, base_revision:int=None) -> int:
+    async with async_driver().session() as session:
+        tx = await session.begin_transaction()
+
+        try:
+            results = await _run(tx, 'lock_revision', {'diagram_uid': diagram_uid}, {})
+            if base_revision is not None:
+                QuiverDiagram.check_revision(results, base_revision)
+
+            results = await _run(tx, 'editor_rows', {'diagram_uid': diagram_uid}, {})
+            rows = QuiverDiagram.editor_rows_from_results(results)
+
+            for name, params in statements(*rows):
+                results = await _run(tx, name, params, {})
+
+            await tx.commit()
+            return results[0][0]
+        finally:
+            await tx.close()    # Rolls back unless committed
+
+
+async def create_diagram(name:str, checked_out_by:str, Model=Diagram):
+    """
+    Creates a diagram in the default category with a single statement.  Returns its uid,
+    or None if a diagram by that name already exists.
+    """
+    results = await run('create_diagram', Model.create_params(name, checked_out_by),
+                        labels=tuple(Model.inherited_labels()))
+
+    return results[0][0] if results else None
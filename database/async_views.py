@@ -0,0 +1,213 @@
+"""
+Async versions of the diagram editor's create / load / save / patch / commit views, served in place of the
+ones in database.views when ASYNC_DIAGRAM_VIEWS is on (the ASGI deployment, Procfile.asgi).
+Their graph I/O goes through database.async_graph, so one worker can keep many editors'
+requests waiting on the graph at once.
+"""
+
+from django.shortcuts import render, redirect
+from django.contrib.auth.decorators import login_required
+from django.contrib import messages
+from django.http import JsonResponse
+from django.db import OperationalError
+from asgiref.sync import sync_to_async
+from . import async_graph, write_behind
+from .diagram_cache import aget_diagram_json, ainvalidate_diagram
+from .views import (diagram_etag, diagram_response, posted_diagram, wants_compact, 
+                    posted_edit_ops, patched_response, conflict_response, 
+                    is_conditional_save, posted_base_revision)
+from .models import RevisionConflict
+from django.views.decorators.gzip import gzip_page
+from dope.http_tools import etag_matches
+from dope.python_tools import full_qualname
+from dope.retry import CircuitOpenError
+from dope.settings import MAX_ATOMIC_LATEX_LENGTH, WRITE_BEHIND_SAVES
+
+
+@login_required
+async def create_diagram(request):
+    error_msg = None
+
+    try:
+        if request.method == 'POST':
+            diagram_name = request.POST.get('diagram-name-input', '')
+
+            if 0 < len(diagram_name) <= MAX_ATOMIC_LATEX_LENGTH:
+                user = await request.auser()
+                uid = await async_graph.create_diagram(diagram_name, user.username)
+
+                if uid is not None:
+                    return redirect('diagram_editor', diagram_name)
+
+                error_msg = 'A diagram by that name already exists.'
+            elif len(diagram_name) == 0:
+                error_msg = 'A diagram name must be non-empty.'
+            else:
+                error_msg = f'A diagram name can be no longer than {MAX_ATOMIC_LATEX_LENGTH} characters.'
+
+    except CircuitOpenError as e:
+        error_msg = str(e)
+
+    except Exception as e:
+        if __debug__:
+            raise e
+        error_msg = f'{full_qualname(e)}: {str(e)}'
+
+    if error_msg:
+        messages.error(request, error_msg)
+
+    # Rendering may touch the session & user lazily, which is synchronous ORM work:
+    return await sync_to_async(render)(request, 'create_diagram.html')
+
+
+@login_required
+@gzip_page
+async def load_diagram(request, diagram_name:str):
+    try:
+        if request.method != 'GET':
+            raise OperationalError('You can only use the GET method to load from the database.')
+
+        user = await request.auser()
+        uid, revision, checked_out_by = await async_graph.checkout(diagram_name, user.username)
+
+        if checked_out_by != user.username:
+            raise OperationalError(
+                f'The diagram with name "{diagram_name}" is already checked out by {checked_out_by}')
+
+        if WRITE_BEHIND_SAVES and await sync_to_async(write_behind.commit)(uid):
+            uid, revision, checked_out_by = await async_graph.revision_by_name(diagram_name)
+
+        compact = wants_compact(request)
+        etag = diagram_etag(uid, revision, compact)
+
+        if etag_matches(request, etag):
+            data = None
+        else:
+            data = await aget_diagram_json(uid, revision, compact)
+            messages.success(request, "Loaded diagram from the database! ✨")
+
+        return diagram_response(data, etag, compact)
+
+    except Exception as e:
+        if __debug__:
+            raise e
+        error_msg = f'{full_qualname(e)}: {str(e)}'
+        messages.error(request, error_msg)
+        return JsonResponse({'error_msg' : error_msg})
+
+
+@login_required
+async def save_diagram(request, diagram_name:str):
+    try:
+        if request.method != 'POST':
+            raise OperationalError('You can only use the POST method to save to the database.')
+
+        user = await request.auser()
+
+        if is_conditional_save(request):
+            # No checkout needed, see database.views.save_diagram
+            uid, revision, checked_out_by = await async_graph.revision_by_name(diagram_name)
+            base_revision = posted_base_revision(request, uid, revision)
+            data = posted_diagram(request)
+
+            if WRITE_BEHIND_SAVES:
+                await sync_to_async(write_behind.commit)(uid)
+
+            revision = await async_graph.update_from_editor(uid, data, base_revision)
+            await ainvalidate_diagram(uid)
+            return patched_response(uid, revision)
+
+        uid, revision, checked_out_by = await async_graph.checkout(diagram_name, user.username)
+
+        if checked_out_by != user.username:
+            raise OperationalError(
+                f'The diagram with name "{diagram_name}" is already checked out by {checked_out_by}')
+
+        data = posted_diagram(request)
+
+        if WRITE_BEHIND_SAVES:
+            await sync_to_async(write_behind.queue_save)(uid, user.username, data)
+        else:
+            # Always incremental: it's one read plus one write transaction whatever the edit.
+            await async_graph.update_from_editor(uid, data)
+            await ainvalidate_diagram(uid)
+
+        messages.success(request, "Saved diagram to the database! 🤩")
+
+        return JsonResponse(
+            'Wrote the following data to the database:\n' + str(data), safe=False)
+
+    except RevisionConflict as e:
+        return conflict_response(e)
+
+    except ValueError as e:
+        return JsonResponse({'error_msg' : str(e)}, status=400)
+
+    except Exception as e:
+        if __debug__:
+            raise e
+        error_msg = f'{full_qualname(e)}: {str(e)}'
+        messages.error(request, error_msg)
+        return JsonResponse({'error_msg' : error_msg})
+
+
+@login_required
+async def patch_diagram(request, diagram_name:str):
+    try:
+        if request.method != 'POST':
+            raise OperationalError('You can only use the POST method to save to the database.')
+
+        user = await request.auser()
+        uid, revision, checked_out_by = await async_graph.checkout(diagram_name, user.username)
+
+        if checked_out_by != user.username:
+            raise OperationalError(
+                f'The diagram with name "{diagram_name}" is already checked out by {checked_out_by}')
+
+        base_revision, ops = posted_edit_ops(request)
+
+        if WRITE_BEHIND_SAVES:
+            await sync_to_async(write_behind.commit)(uid)
+
+        revision = await async_graph.patch_from_editor(uid, base_revision, ops)
+        await ainvalidate_diagram(uid)
+        return patched_response(uid, revision)
+
+    except RevisionConflict as e:
+        return conflict_response(e)
+
+    except ValueError as e:
+        return JsonResponse({'error_msg' : str(e)}, status=400)
+
+    except Exception as e:
+        if __debug__:
+            raise e
+        error_msg = f'{full_qualname(e)}: {str(e)}'
+        messages.error(request, error_msg)
+        return JsonResponse({'error_msg' : error_msg})
+
+
+@login_required
+async def commit_diagram(request, diagram_name:str):
+    try:
+        if request.method != 'POST':
+            raise OperationalError('You can only use the POST method to save to the database.')
+
+        user = await request.auser()
+        uid, revision, checked_out_by = await async_graph.checkout(diagram_name, user.username)
+
+        if checked_out_by != user.username:
+            raise OperationalError(
+                f'The diagram with name "{diagram_name}" is already checked out by {checked_out_by}')
+
+        if await sync_to_async(write_behind.commit)(uid):
+            uid, revision, checked_out_by = await async_graph.revision_by_name(diagram_name)
+
+        return patched_response(uid, revision)
+
+    except Exception as e:
+        if __debug__:
+            raise e
+        error_msg = f'{full_qualname(e)}: {str(e)}'
+        messages.error(request, error_msg)
+        return JsonResponse({'error_msg' : error_msg})
@@ -0,0 +1,2 @@
+from .suite import DiagramBenchmark, DEFAULT_SIZES
+from .diagrams import synthetic_diagram, edited_diagram
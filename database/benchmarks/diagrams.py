@@ -0,0 +1,94 @@
+"""
+Synthetic Quiver diagrams for the benchmarks, in the editor's array format.
+"""
+
+import random
+
+
+OBJECT_LABELS = [
+    'A_{{{i}}}', 'X_{{{i}}} \\times Y', '\\mathbb{{Z}}^{{{i}}}', 'F(X_{{{i}}})',
+    'G \\circ F(A_{{{i}}})', '\\Omega^{{{i}}} M', 'C', 'X \\otimes Y',
+]
+
+ARROW_LABELS = [
+    'f_{{{i}}}', 'g \\circ h', '\\pi_{{{i}}}', '\\iota', 'F(f_{{{i}}})',
+    '\\eta_{{X_{{{i}}}}}', '', 'd^{{{i}}}',
+]
+
+BODY_STYLES = ['solid', 'solid', 'solid', 'dashed', 'dotted']
+
+
+def vertex(i:int, columns:int, rng):
+    label = rng.choice(OBJECT_LABELS).format(i=i)
+    return [i % columns, i // columns, label, [0, 0, 0, 1]]
+
+
+def edge(source:int, target:int, i:int, rng, curve=0):
+    label = rng.choice(ARROW_LABELS).format(i=i)
+    options = {
+        'label_position' : 50,
+        'offset' : 0,
+        'curve' : curve,
+        'shorten' : {'source': 0, 'target': 0},
+        'level' : 1,
+        'style' : {
+            'body' : {'name': rng.choice(BODY_STYLES)},
+            'head' : {'name': 'arrowhead', 'side': 'none'},
+            'tail' : {'name': 'none', 'side': 'none'},
+        },
+    }
+    return [source, target, label, 0, options]
+
+
+def synthetic_diagram(num_objects:int, seed=0):
+    """
+    Returns a Quiver array with num_objects objects laid out on a grid.  Neighbouring
+    objects are joined by arrows along the rows & columns, every third arrow has a
+    parallel (curved) twin, and every fifth object closes a cycle back to the start of
+    its row, so there are about two arrows per object.
+    """
+    rng = random.Random(seed)
+    columns = max(1, int(num_objects ** 0.5))
+    vertices = [vertex(i, columns, rng) for i in range(num_objects)]
+    edges = []
+
+    def add(source, target, curve=0):
+        edges.append(edge(source, target, len(edges), rng, curve))
+
+    for i in range(num_objects):
+        if (i + 1) % columns and i + 1 < num_objects:
+            add(i, i + 1)
+            if len(edges) % 3 == 0:
+                add(i, i + 1, curve=2)
+
+        if i + columns < num_objects and i % 2 == 0:
+            add(i, i + columns)
+
+        if i % 5 == 4 and i % columns:
+            add(i, i - i % columns)
+
+    return [0, len(vertices)] + vertices + edges
+
+
+def edited_diagram(format:list, fraction=0.05, seed=1):
+    """
+    Returns a copy of the Quiver array with about the given fraction of its objects moved,
+    its arrows relabelled, and its last arrow deleted: a typical small editing session.
+    """
+    rng = random.Random(seed)
+    format = [list(x) if isinstance(x, list) else x for x in format]
+    num_vertices = format[1]
+    vertices = range(2, 2 + num_vertices)
+    edges = range(2 + num_vertices, len(format))
+    count = max(1, int(num_vertices * fraction))
+
+    for k in rng.sample(vertices, min(count, len(vertices))):
+        format[k][0] += 1
+
+    for k in rng.sample(edges, min(count, len(edges))):
+        format[k][2] = rng.choice(ARROW_LABELS).format(i=k)
+
+    if len(edges):
+        format.pop()
+
+    return format
@@ -0,0 +1,189 @@
+"""
+Times the diagram save, load, serialization, deletion and search paths at increasing
+diagram sizes.  The views are driven through Django's test client, so middleware,
+sessions, caching and JSON (de)serialization are all part of the measurement.  Saves are
+written straight to the graph (WRITE_BEHIND_SAVES is off during a run), so they're timed
+rather than just their journaling.
+"""
+
+from database.graph_backend import graph_backend, set_graph_backend, make_graph_backend
+from database.diagram_cache import invalidate_diagram
+from database.models import QuiverDiagram, Diagram
+from .diagrams import synthetic_diagram, edited_diagram
+from django.contrib.auth import get_user_model
+from django.test import Client
+from django.urls import reverse
+from collections import defaultdict
+from contextlib import ExitStack
+from unittest import mock
+from uuid import uuid4
+import json
+import math
+import time
+
+
+DEFAULT_SIZES = [10, 100, 1000, 10000]
+
+
+class CountingBackend:
+    """
+    Wraps a graph backend to count its calls, each of which is a round trip to the graph
+    server on Neo4j (opening & committing transactions aside).
+    """
+    def __init__(self, backend):
+        self.backend = backend
+        self.name = backend.name
+        self.round_trips = 0
+
+    def transaction(self):
+        return self.backend.transaction()
+
+    def __getattr__(self, name):
+        method = getattr(self.backend, name)
+
+        def counted(*args, **kwargs):
+            self.round_trips += 1
+            return method(*args, **kwargs)
+
+        return counted
+
+
+def percentile(samples:list, q:float) -> float:
+    """
+    The nearest-rank q-th percentile (0 < q <= 100) of the samples.
+    """
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+
+class DiagramBenchmark:
+    def __init__(self, sizes=None, repeat=5, search_path_length=4, search_path_limit=64,
+                 username='benchmark'):
+        self.sizes = sizes or DEFAULT_SIZES
+        self.repeat = repeat
+        self.search_path_length = search_path_length
+        self.search_path_limit = search_path_limit
+        self.username = username
+        self.samples = None
+
+    def measure(self, operation:str, func, *args, **kwargs):
+        backend = graph_backend()
+        round_trips = backend.round_trips
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        self.samples[operation].append((elapsed_ms, backend.round_trips - round_trips))
+        return result
+
+    def run(self, backend_name='memory') -> dict:
+        previous = set_graph_backend(CountingBackend(make_graph_backend(backend_name)))
+
+        try:
+            with ExitStack() as stack:
+                for module in ['database.views', 'database.async_views']:
+                    stack.enter_context(mock.patch(f'{module}.WRITE_BEHIND_SAVES', False))
+
+                return self.run_sizes(backend_name)
+        finally:
+            set_graph_backend(previous)
+
+    def run_sizes(self, backend_name:str) -> dict:
+        User = get_user_model()
+        user, created = User.objects.get_or_create(username=self.username)
+        client = Client()
+        client.force_login(user)
+
+        results = {}
+
+        for size in self.sizes:
+            self.samples = defaultdict(list)
+
+            for k in range(self.repeat):
+                # Unique per run, so reruns against the same graph don't hit "already exists":
+                self.run_once(client, size, f'benchmark-{size}-{k}-{uuid4().hex[:8]}')
+
+            results[str(size)] = self.summary()
+
+        return {
+            'backend' : backend_name,
+            'sizes' : self.sizes,
+            'repeat' : self.repeat,
+            'search_path_length' : self.search_path_length,
+            'search_path_limit' : self.search_path_limit,
+            'results' : results,
+        }
+
+    def run_once(self, client, size:int, diagram_name:str):
+        try:
+            self.time_operations(client, size, diagram_name)
+        finally:
+            # Not leaving benchmark diagrams behind in the graph:
+            diagram = graph_backend().get_or_none(Diagram, name=diagram_name)
+
+            if diagram is not None:
+                diagram.delete_diagram()
+
+    def time_operations(self, client, size:int, diagram_name:str):
+        format = synthetic_diagram(size, seed=size)
+        edited = edited_diagram(format)
+
+        response = self.measure('create_diagram', client.post, reverse('create_diagram'),
+                                {'diagram-name-input': diagram_name})
+        self.check(response, 302)
+        diagram = graph_backend().get_or_none(Diagram, name=diagram_name)
+
+        save_url = reverse('save_diagram', args=[diagram_name])
+        load_url = reverse('load_diagram', args=[diagram_name])
+
+        for operation, data in [('save_diagram (new)', format), ('save_diagram (edit)', edited)]:
+            response = self.measure(operation, client.post, save_url, json.dumps(data),
+                                    content_type='application/json')
+            self.check(response, 200)
+
+        # Nothing's pending, so this times the commit's overhead alone:
+        response = self.measure('commit_diagram', client.post,
+                                reverse('commit_diagram', args=[diagram_name]))
+        self.check(response, 200)
+
+        invalidate_diagram(diagram.uid)
+        response = self.measure('load_diagram (cold)', client.get, load_url)
+        self.check(response, 200)
+        etag = response['ETag']
+
+        response = self.measure('load_diagram (warm)', client.get, load_url)
+        self.check(response, 200)
+
+        response = self.measure('load_diagram (revalidate)', client.get, load_url,
+                                HTTP_IF_NONE_MATCH=etag)
+        self.check(response, 304)
+
+        self.measure('quiver_format', QuiverDiagram.quiver_format_by_uid, diagram.uid)
+        self.measure('search', self.search, diagram.uid)
+        self.measure('delete_objects', diagram.delete_objects)
+
+    def search(self, diagram_uid:str):
+        paths = QuiverDiagram.iter_paths(
+            diagram_uid, self.search_path_length, limit=self.search_path_limit)
+        nodes, rels, pattern = QuiverDiagram.build_query_from_paths(list(paths))
+        return QuiverDiagram.build_match_query(pattern, nodes, rels)
+
+    @staticmethod
+    def check(response, status_code:int):
+        if response.status_code != status_code:
+            raise AssertionError(
+                f'Expected a {status_code} response but got {response.status_code}: '
+                f'{response.content[:500]}')
+
+    def summary(self) -> dict:
+        summary = {}
+
+        for operation, samples in self.samples.items():
+            times = [elapsed_ms for elapsed_ms, round_trips in samples]
+            summary[operation] = {
+                'round_trips' : max(round_trips for elapsed_ms, round_trips in samples),
+                'p50_ms' : round(percentile(times, 50), 3),
+                'p95_ms' : round(percentile(times, 95), 3),
+                'samples' : len(samples),
+            }
+
+        return summary
@@ -0,0 +1,344 @@
+"""
+Named, parameterized Cypher statements.
+
+All of the model code's queries go through run(), so that each statement's text is fixed
+(values are always passed as parameters, never spliced in) and the graph server's query
+plan cache gets reused across requests.  run() also keeps per-statement timing stats.
+
+A few statements depend on something that can't be a parameter (a node label, a
+variable-length bound).  Those are functions of such "shape" arguments returning the text,
+which only ever takes a small, bounded number of distinct values.
+"""
+
+from functools import lru_cache
+from .graph_backend import graph_backend
+import threading
+import time
+
+
+def _paths_statement(length:int, simple:bool, limited:bool) -> str:
+    if simple:
+        where = "WHERE all(k IN range(0, size(nodes(p)) - 2) " \
+                "          WHERE NOT nodes(p)[k] IN nodes(p)[k + 1..]) "
+    else:
+        where = ""
+
+    return \
+        f"MATCH (D:QuiverDiagram {{uid: $diagram_uid}})-[:CONTAINS]->(X:QuiverNode), " \
+        f"p=(X)-[:MAPS_TO*{int(length)}]->(:QuiverNode) " + where + \
+        f"RETURN [x IN nodes(p) | x {{.diagram_index, .shape, name: coalesce(x.name, '')}}], " \
+        f"       [f IN relationships(p) | f {{.diagram_index, .shape, name: coalesce(f.name, '')}}]" + \
+        (" LIMIT $limit" if limited else "")
+
+
+# The patterns matching the items that have a label shape, for the shape backfill:
+SHAPED_ITEM_MATCHES = {
+    'nodes' : "MATCH (x:QuiverNode)",
+    'arrows' : "MATCH ()-[x:MAPS_TO]->()",
+}
+
+
+STATEMENTS = {
+    # QuiverNode
+    'outgoing_arrows' :
+        "MATCH (X:QuiverNode {uid: $uid})-[f:MAPS_TO]->(:QuiverNode) "
+        "RETURN f",
+    'delete_outgoing_arrows' :
+        "MATCH (X:QuiverNode {uid: $uid})-[f:MAPS_TO]->(:QuiverNode) "
+        "DELETE f",
+
+    # Any model
+    'nodes_by_uids' : lambda label:
+        f"MATCH (x:{label}) WHERE x.uid IN $uids "
+        f"RETURN x",
+    'upsert_node' : lambda labels, key_names:
+        # Matches the node by its natural key, or creates it with $props.  Only atomic under
+        # a uniqueness constraint on the key (see the graph_schema command):
+        f"MERGE (x:{':'.join(labels)} {{" + 
+        ", ".join(f"{key}: $keys.{key}" for key in key_names) + "}) "
+        f"ON CREATE SET x = $props "
+        f"RETURN x",
+
+    'set_property' : lambda label, prop, unique:
+        # Sets just the one property of the node, rather than writing all of them back.  If 
+        # it's unique, nothing is returned (or set) when another node already has the value:
+        f"MATCH (x:{label} {{uid: $uid}}) " +
+        (f"OPTIONAL MATCH (E:{label} {{{prop}: $value}}) WHERE E <> x "
+         f"WITH x, count(E) AS taken WHERE taken = 0 " if unique else "") +
+        f"SET x.{prop} = $value "
+        f"RETURN x.uid",
+
+    # Category
+    'merge_duplicate_categories' :
+        # Folds the categories sharing a name into one, for the name's uniqueness constraint:
+        "MATCH (C:Category) "
+        "WITH C.name AS name, collect(C) AS categories WHERE size(categories) > 1 "
+        "UNWIND categories[1..] AS duplicate "
+        "WITH categories[0] AS category, duplicate "
+        "OPTIONAL MATCH (x)-[r:LIVES_IN]->(duplicate) "
+        "FOREACH (_ IN CASE WHEN x IS NULL THEN [] ELSE [1] END | "
+        "    MERGE (x)-[:LIVES_IN]->(category)) "
+        "DELETE r "
+        "WITH DISTINCT duplicate "
+        "DETACH DELETE duplicate "
+        "RETURN count(*)",
+
+    # QuiverDiagram contents
+    'diagram_objects' :
+        "MATCH (D:QuiverDiagram {uid: $diagram_uid})-[:CONTAINS]->(x:QuiverNode) "
+        "RETURN x",
+    'editor_rows' :
+        "MATCH (D:QuiverDiagram {uid: $diagram_uid}) "
+        "RETURN [(D)-[:CONTAINS]->(x:QuiverNode) | properties(x)], "
+        "       [(D)-[:CONTAINS]->(A:QuiverNode)-[f:MAPS_TO]->(B:QuiverNode) | "
+        "           {source_index: A.diagram_index, target_index: B.diagram_index, "
+        "            properties: properties(f)}]",
+    'revision_by_name' : lambda label:
+        f"MATCH (D:{label} {{name: $name}}) "
+        f"RETURN D.uid, coalesce(D.revision, 0), D.checked_out_by LIMIT 1",
+    'checkout_diagram' : lambda label:
+        # Compare-and-set of the checkout lease, under the diagram's write lock: it's taken
+        # (or renewed) for $username unless someone else's lease hasn't expired yet.  Returns 
+        # the holder afterwards, so the caller holds it iff that's $username:
+        f"MATCH (D:{label} {{name: $name}}) "
+        f"WITH D LIMIT 1 "
+        f"SET D._lock = true REMOVE D._lock "
+        f"WITH D, D.checked_out_by = $username OR "
+        f"        coalesce(D.checkout_expires, 0) < timestamp() AS free "
+        f"FOREACH (_ IN CASE WHEN free THEN [1] ELSE [] END | "
+        f"    SET D.checked_out_by = $username, D.checkout_expires = timestamp() + $ttl) "
+        f"RETURN D.uid, coalesce(D.revision, 0), D.checked_out_by",
+    'release_diagram' : lambda label:
+        # Expires $username's lease (the diagram keeps its last holder for the listings):
+        f"MATCH (D:{label} {{name: $name}}) "
+        f"WITH D LIMIT 1 "
+        f"SET D._lock = true REMOVE D._lock "
+        f"WITH D WHERE D.checked_out_by = $username "
+        f"SET D.checkout_expires = 0 "
+        f"RETURN D.uid",
+    'checkout_rule' :
+        # The same for a rule, whose lease covers its key & result diagrams too: all three
+        # are taken together, or none of them if any is under someone else's lease.  The rule
+        # is found by its relationship id, which brings its two diagrams along:
+        "MATCH (K:QuiverDiagram)-[r:RULE]->(R:QuiverDiagram) WHERE elementId(r) = $rule_id "
+        "SET K._lock = true, R._lock = true, r._lock = true "
+        "REMOVE K._lock, R._lock, r._lock "
+        "WITH K, r, R, [x IN [K, r, R] WHERE x.checked_out_by <> $username AND "
+        "                  coalesce(x.checkout_expires, 0) >= timestamp()][0] AS held "
+        "FOREACH (x IN CASE WHEN held IS NULL THEN [K, R] ELSE [] END | "
+        "    SET x.checked_out_by = $username, x.checkout_expires = timestamp() + $ttl) "
+        "FOREACH (_ IN CASE WHEN held IS NULL THEN [1] ELSE [] END | "
+        "    SET r.checked_out_by = $username, r.checkout_expires = timestamp() + $ttl) "
+        "RETURN coalesce(held.checked_out_by, $username), "
+        "       coalesce(K.revision, 0), coalesce(R.revision, 0)",
+    'release_rule' :
+        "MATCH (K:QuiverDiagram)-[r:RULE]->(R:QuiverDiagram) WHERE elementId(r) = $rule_id "
+        "SET K._lock = true, R._lock = true, r._lock = true "
+        "REMOVE K._lock, R._lock, r._lock "
+        "FOREACH (x IN [y IN [K, r, R] WHERE y.checked_out_by = $username] | "
+        "    SET x.checkout_expires = 0) "
+        "RETURN count(r)",
+    'upsert_diagram' : lambda labels:
+        # The diagram by that name, or a new one in the named category (upserted too):
+        f"MERGE (C:Category {{name: $category_name}}) "
+        f"ON CREATE SET C.uid = $category_uid "
+        f"MERGE (D:{':'.join(labels)} {{name: $props.name}}) "
+        f"ON CREATE SET D = $props "
+        f"FOREACH (_ IN CASE WHEN D.uid = $props.uid THEN [1] ELSE [] END | "
+        f"    CREATE (D)-[:LIVES_IN]->(C)) "
+        f"RETURN D",
+    'set_category' :
+        # Moves the diagram into the named category (upserting it), bumping its revision 
+        # if that's a move:
+        "MATCH (D:QuiverDiagram {uid: $diagram_uid}) "
+        "MERGE (C:Category {name: $category_name}) "
+        "ON CREATE SET C.uid = $category_uid "
+        "WITH D, C "
+        "OPTIONAL MATCH (D)-[old:LIVES_IN]->(B:Category) WHERE B <> C "
+        "WITH D, C, collect(old) AS olds "
+        "FOREACH (r IN olds | DELETE r) "
+        "MERGE (D)-[:LIVES_IN]->(C) "
+        "FOREACH (_ IN CASE WHEN size(olds) > 0 THEN [1] ELSE [] END | "
+        "    SET D.revision = coalesce(D.revision, 0) + 1) "
+        "RETURN coalesce(D.revision, 0)",
+    'create_rule' : lambda labels:
+        # A rule with new key & result diagrams in the named category (upserted), unless 
+        # a diagram by either name already exists, in which case nothing is returned:
+        f"OPTIONAL MATCH (E:{labels[0]}) WHERE E.name IN [$key_props.name, $result_props.name] "
+        f"WITH count(E) AS taken WHERE taken = 0 "
+        f"MERGE (C:Category {{name: $category_name}}) "
+        f"ON CREATE SET C.uid = $category_uid "
+        f"CREATE (K:{':'.join(labels)})-[:LIVES_IN]->(C), "
+        f"       (R:{':'.join(labels)})-[:LIVES_IN]->(C), "
+        f"       (K)-[r:RULE]->(R) "
+        f"SET K = $key_props, R = $result_props, r = $props "
+        f"RETURN r",
+    'create_diagram' : lambda labels:
+        # Creates the diagram in the named category (creating that too if need be), unless 
+        # a diagram by that name already exists, in which case nothing is returned:
+        f"OPTIONAL MATCH (E:{labels[0]} {{name: $props.name}}) "
+        f"WITH E LIMIT 1 "
+        f"WHERE E IS NULL "
+        f"MERGE (C:Category {{name: $category_name}}) "
+        f"ON CREATE SET C.uid = $category_uid "
+        f"CREATE (D:{':'.join(labels)})-[:LIVES_IN]->(C) "
+        f"SET D = $props "
+        f"RETURN D.uid",
+    'lock_revision' :
+        # Takes the diagram's write lock for the rest of the transaction & reads its revision:
+        "MATCH (D:QuiverDiagram {uid: $diagram_uid}) "
+        "SET D._lock = true REMOVE D._lock "
+        "RETURN coalesce(D.revision, 0)",
+    'bump_revision' :
+        # The object & arrow counts are only given (non-null) by the saves:
+        "MATCH (D:QuiverDiagram {uid: $diagram_uid}) "
+        "SET D.revision = coalesce(D.revision, 0) + 1, "
+        "    D.object_count = coalesce($object_count, D.object_count), "
+        "    D.arrow_count = coalesce($arrow_count, D.arrow_count) "
+        "RETURN D.revision",
+    'diagram_page' : lambda label, after:
+        # Keyset pagination on (name, uid), which the name index serves in order.  The range
+        # predicate on D.name (and IS NOT NULL) is what lets the planner seek the index:
+        f"MATCH (D:{label}) WHERE D.name IS NOT NULL " +
+        ("AND D.name >= $after_name AND (D.name > $after_name OR D.uid > $after_uid) " 
+         if after else "") +
+        f"WITH D ORDER BY D.name, D.uid LIMIT $limit "
+        f"OPTIONAL MATCH (D)-[:LIVES_IN]->(C:Category) "
+        f"RETURN D.name, D.uid, C.name, D.checked_out_by, "
+        f"       coalesce(D.object_count, 0), coalesce(D.arrow_count, 0)",
+    'create_vertices' :
+        "MATCH (D:QuiverDiagram {uid: $diagram_uid}) "
+        "OPTIONAL MATCH (D)-[:LIVES_IN]->(C:Category) "
+        "UNWIND $vertices AS v "
+        "CREATE (D)-[:CONTAINS]->(x:QuiverNode:Object) "
+        "SET x = v "
+        "FOREACH (c IN CASE WHEN C IS NULL THEN [] ELSE [C] END | "
+        "    CREATE (x)-[:LIVES_IN]->(c))",
+    'update_vertices' :
+        "UNWIND $vertices AS v "
+        "MATCH (x:QuiverNode {uid: v.uid}) "
+        "SET x += v",
+    'delete_vertices' :
+        "UNWIND $uids AS uid "
+        "MATCH (x:QuiverNode {uid: uid}) "
+        "DETACH DELETE x",
+    'create_edges' :
+        "UNWIND $edges AS e "
+        "MATCH (A:QuiverNode {uid: e.source}) "
+        "MATCH (B:QuiverNode {uid: e.target}) "
+        "CREATE (A)-[f:MAPS_TO]->(B) "
+        "SET f = e.properties",
+    'update_edges' :
+        "UNWIND $edges AS e "
+        "MATCH (:QuiverNode {uid: e.source})-[f:MAPS_TO]->(:QuiverNode {uid: e.target}) "
+        "WHERE f.diagram_index = e.properties.diagram_index "
+        "SET f += e.properties",
+    'delete_edges' :
+        "MATCH (D:QuiverDiagram {uid: $diagram_uid})-[:CONTAINS]->(:QuiverNode)"
+        "-[f:MAPS_TO]->(:QuiverNode) "
+        "WHERE f.diagram_index IN $indices "
+        "DELETE f",
+    'delete_objects_batch' :
+        "MATCH (D:QuiverDiagram {uid: $diagram_uid})-[:CONTAINS]->(x:QuiverNode) "
+        "WITH x LIMIT $batch_size "
+        "DETACH DELETE x "
+        "RETURN count(*)",
+    'delete_diagram' :
+        # The diagram node & its relationships, once its objects are gone (delete_objects_batch):
+        "MATCH (D:QuiverDiagram {uid: $diagram_uid}) "
+        "DETACH DELETE D",
+
+    # Search
+    'diagram_paths' : _paths_statement,
+
+    # Maintenance
+    'count_diagrams_batch' :
+        "MATCH (D:QuiverDiagram) WHERE D.object_count IS NULL "
+        "WITH D LIMIT $batch_size "
+        "SET D.object_count = size([(D)-[:CONTAINS]->(:QuiverNode) | 1]), "
+        "    D.arrow_count = size([(D)-[:CONTAINS]->(:QuiverNode)-[:MAPS_TO]->(:QuiverNode) | 1]) "
+        "RETURN count(*)",
+    'shapeless_items' : lambda kind:
+        f"{SHAPED_ITEM_MATCHES[kind]} WHERE x.shape IS NULL "
+        f"RETURN elementId(x), coalesce(x.name, '') LIMIT $batch_size",
+    'set_shapes' : lambda kind:
+        # By element id rather than the deprecated id(), as arrows have no uid:
+        f"UNWIND $rows AS row {SHAPED_ITEM_MATCHES[kind]} WHERE elementId(x) = row.id "
+        f"SET x.shape = row.shape",
+
+    # Runnable code
+    'python_code_by_pattern' :
+        "MATCH (p:Python) "
+        "WHERE p.code =~ $code_regex AND p.globals_dict =~ $globals_regex "
+        "RETURN p "
+        "ORDER BY size(p.code)",
+}
+
+
+_statement_names = {
+    # Statement text -> name, filled in as statement_text() gets called
+}
+
+
+@lru_cache(maxsize=None)
+def statement_text(name:str, **shape) -> str:
+    statement = STATEMENTS[name]
+
+    if callable(statement):
+        text = statement(**shape)
+    elif shape:
+        raise ValueError(f'Statement "{name}" takes no shape arguments.')
+    else:
+        text = statement
+
+    _statement_names[text] = name
+    return text
+
+
+def statement_name(query:str) -> str:
+    """
+    The name of the statement with the given text, or None if it's not a named statement.
+    """
+    return _statement_names.get(query)
+
+
+_stats_lock = threading.Lock()
+_stats = {
+    # Keyed by statement name, values are dicts with count, total_ms, max_ms
+}
+
+
+def record_statement(name:str, elapsed_ms:float):
+    with _stats_lock:
+        stats = _stats.get(name)
+
+        if stats is None:
+            stats = _stats[name] = {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0}
+
+        stats['count'] += 1
+        stats['total_ms'] += elapsed_ms
+        stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+
+
+def run(name:str, params:dict=None, **shape):
+    """
+    Runs the named statement with the given parameters (in the current transaction, if any)
+    on the configured graph backend.  Returns (results, meta) just like db.cypher_query().
+    """
+    query = statement_text(name, **shape)
+    start = time.perf_counter()
+
+    try:
+        return graph_backend().cypher_query(name, shape, query, params or {})
+    finally:
+        record_statement(name, (time.perf_counter() - start) * 1000)
+
+
+def statement_stats() -> dict:
+    with _stats_lock:
+        all_stats = {name : dict(stats) for name, stats in _stats.items()}
+
+    for stats in all_stats.values():
+        stats['mean_ms'] = stats['total_ms'] / stats['count']
+
+    return all_stats
@@ -0,0 +1,93 @@
+from django.core.cache import caches
+from dope.settings import DIAGRAM_CACHE_ALIAS
+from .models import QuiverDiagram
+from .wire_format import to_compact
+from . import async_graph
+import json
+import threading
+
+# Per-process counters:
+_stats_lock = threading.Lock()
+_stats = {
+    'hits' : 0,
+    'misses' : 0,
+    'invalidations' : 0,
+}
+
+
+def diagram_cache():
+    return caches[DIAGRAM_CACHE_ALIAS]
+
+
+def diagram_cache_key(uid:str, compact=False):
+    return f'diagram:{uid}:compact' if compact else f'diagram:{uid}'
+
+
+def serialize_diagram(format:list, compact=False) -> str:
+    if compact:
+        return json.dumps(to_compact(format), separators=(',', ':'))
+    return json.dumps(format)
+
+
+def _count(stat:str):
+    with _stats_lock:
+        _stats[stat] += 1
+
+
+def get_diagram_json(uid:str, revision:int, compact=False) -> str:
+    """
+    Returns the serialized Quiver JSON (or the compact encoding's) of the diagram with the 
+    given uid.  A cached copy is only used when it was stored at the diagram's current 
+    revision, otherwise the diagram is re-serialized from the database and the cache is 
+    refreshed.
+    """
+    cache = diagram_cache()
+    key = diagram_cache_key(uid, compact)
+    entry = cache.get(key)
+    
+    if entry is not None and entry[0] == revision:
+        _count('hits')
+        return entry[1]
+    
+    _count('misses')
+    data = serialize_diagram(QuiverDiagram.quiver_format_by_uid(uid), compact)
+    cache.set(key, (revision, data))
+    return data
+
+
+async def aget_diagram_json(uid:str, revision:int, compact=False) -> str:
+    """
+    The async counterpart of get_diagram_json, for the ASGI views.
+    """
+    cache = diagram_cache()
+    key = diagram_cache_key(uid, compact)
+    entry = await cache.aget(key)
+    
+    if entry is not None and entry[0] == revision:
+        _count('hits')
+        return entry[1]
+    
+    _count('misses')
+    data = serialize_diagram(await async_graph.quiver_format_by_uid(uid), compact)
+    await cache.aset(key, (revision, data))
+    return data
+
+
+def invalidate_diagram(uid:str):
+    # Bumping the diagram's revision already makes a cached entry stale, this just frees it.
+    diagram_cache().delete_many([diagram_cache_key(uid), diagram_cache_key(uid, compact=True)])
+    _count('invalidations')
+    
+    
+async def ainvalidate_diagram(uid:str):
+    await diagram_cache().adelete_many([diagram_cache_key(uid), diagram_cache_key(uid, compact=True)])
+    _count('invalidations')
+    
+
+def diagram_cache_stats() -> dict:
+    with _stats_lock:
+        stats = dict(_stats)
+        
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+    return stats
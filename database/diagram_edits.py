@@ -0,0 +1,161 @@
+"""
+Edit operations on a Quiver array, as sent by the editor's delta saves (patch_diagram).
+
+Each op is a dict with "op" (add, move, relabel, restyle or delete), "kind" (vertex or
+edge) and "index", the item's diagram_index.  Ops apply in order with the same array
+semantics as the editor: adding inserts at index (appending by default), and deleting a
+vertex also deletes its edges, with the indices above it shifting down.
+
+    {"op": "add", "kind": "vertex", "data": [x, y, label, colour]}
+    {"op": "add", "kind": "edge", "data": [source, target, label, alignment, options, colour]}
+    {"op": "move", "kind": "vertex", "index": 3, "x": 2, "y": 0}
+    {"op": "move", "kind": "edge", "index": 5, "source": 3, "target": 4}
+    {"op": "relabel", "kind": "vertex", "index": 3, "label": "F(X)"}
+    {"op": "restyle", "kind": "vertex", "index": 3, "colour": [0, 0, 0, 1]}
+    {"op": "restyle", "kind": "edge", "index": 5, "alignment": 2, "options": {...}, "colour": [...]}
+    {"op": "delete", "kind": "edge", "index": 5}
+"""
+
+import copy
+
+
+def _merge(d:dict, updates:dict):
+    for key, value in updates.items():
+        if isinstance(value, dict) and isinstance(d.get(key), dict):
+            _merge(d[key], value)
+        else:
+            d[key] = value
+
+
+class EditableDiagram:
+    def __init__(self, format:list):
+        format = copy.deepcopy(format)
+        self.vertices = format[2:2 + format[1]]
+        self.edges = format[2 + format[1]:]
+
+    def quiver_format(self) -> list:
+        return [0, len(self.vertices)] + self.vertices + self.edges
+
+    def _index(self, op:dict, items:list, inserting=False) -> int:
+        index = op.get('index', len(items) if inserting else None)
+        upper = len(items) if inserting else len(items) - 1
+
+        if not isinstance(index, int) or not 0 <= index <= upper:
+            raise ValueError(f'Edit op {op} has an index out of range.')
+
+        return index
+
+    def _vertex(self, index) -> int:
+        if not isinstance(index, int) or not 0 <= index < len(self.vertices):
+            raise ValueError(f'There is no vertex {index}.')
+        return index
+
+    def apply(self, op:dict):
+        kind = op.get('kind')
+        name = op.get('op')
+        method = getattr(self, f'{name}_{kind}', None) if isinstance(name, str) and \
+                                                         isinstance(kind, str) else None
+        if method is None:
+            raise ValueError(f'Unknown edit op {op}.')
+
+        method(op)
+
+    # Vertices
+
+    def add_vertex(self, op):
+        index = self._index(op, self.vertices, inserting=True)
+        data = op.get('data')
+
+        if not isinstance(data, list) or len(data) < 2:
+            raise ValueError(f'Edit op {op} needs the vertex data [x, y, ...].')
+
+        self.vertices.insert(index, list(data))
+
+        for e in self.edges:
+            e[0] += e[0] >= index
+            e[1] += e[1] >= index
+
+    def move_vertex(self, op):
+        v = self.vertices[self._index(op, self.vertices)]
+        v[0] = op.get('x', v[0])
+        v[1] = op.get('y', v[1])
+
+    def relabel_vertex(self, op):
+        v = self.vertices[self._index(op, self.vertices)]
+        v[2:3] = [op.get('label', '')]
+
+    def restyle_vertex(self, op):
+        v = self.vertices[self._index(op, self.vertices)]
+
+        if 'colour' in op:
+            while len(v) < 3:
+                v.append('')
+            v[3:4] = [op['colour']]
+
+    def delete_vertex(self, op):
+        index = self._index(op, self.vertices)
+        del self.vertices[index]
+        self.edges = [e for e in self.edges if index not in (e[0], e[1])]
+
+        for e in self.edges:
+            e[0] -= e[0] > index
+            e[1] -= e[1] > index
+
+    # Edges
+
+    def add_edge(self, op):
+        index = self._index(op, self.edges, inserting=True)
+        data = op.get('data')
+
+        if not isinstance(data, list) or len(data) < 2:
+            raise ValueError(f'Edit op {op} needs the edge data [source, target, ...].')
+
+        self._vertex(data[0])
+        self._vertex(data[1])
+        self.edges.insert(index, copy.deepcopy(data))
+
+    def move_edge(self, op):
+        e = self.edges[self._index(op, self.edges)]
+        e[0] = self._vertex(op.get('source', e[0]))
+        e[1] = self._vertex(op.get('target', e[1]))
+
+    def relabel_edge(self, op):
+        e = self.edges[self._index(op, self.edges)]
+        e[2:3] = [op.get('label', '')]
+
+    def restyle_edge(self, op):
+        e = self.edges[self._index(op, self.edges)]
+
+        while len(e) < 5:
+            e.append('' if len(e) == 2 else 0 if len(e) == 3 else {})
+
+        if 'alignment' in op:
+            e[3] = op['alignment']
+
+        if 'options' in op:
+            _merge(e[4], op['options'])
+
+        if 'colour' in op:
+            e[5:6] = [op['colour']]
+            e[4]['colour'] = op['colour']
+
+    def delete_edge(self, op):
+        del self.edges[self._index(op, self.edges)]
+
+
+def apply_edit_ops(format:list, ops:list) -> list:
+    """
+    Returns a new Quiver array: format with the edit ops applied in order.
+    Raises ValueError on a malformed op, in which case none of them apply.
+    """
+    if not isinstance(ops, list):
+        raise ValueError('The edit ops must be a list.')
+
+    diagram = EditableDiagram(format)
+
+    for op in ops:
+        if not isinstance(op, dict):
+            raise ValueError(f'Edit op {op} is not an object.')
+        diagram.apply(op)
+
+    return diagram.quiver_format()
@@ -0,0 +1,229 @@
+from collections import defaultdict, namedtuple
+from dope.label_templates import compile_label, bind_label
+from dope.settings import MAX_PATTERN_MATCH_STEPS
+from .models import QuiverDiagram
+
+
+# nodes & arrows map pattern diagram indices to target diagram indices,
+# bindings maps each pattern Variable to the text it matched:
+DiagramMatch = namedtuple('DiagramMatch', ['nodes', 'arrows', 'bindings'])
+
+
+class DiagramGraph:
+    """
+    Compact adjacency index of a diagram, for matching in memory.
+    Vertices and arrows are both identified by their diagram_index.
+    """
+    def __init__(self, vertices:dict, edges:dict):
+        # Arguments are in the format returned by QuiverDiagram.editor_rows_by_uid()
+        self.node_labels = {k : v.get('name') or '' for k,v in vertices.items()}
+        self.arrow_labels = {}
+        self.arrow_ends = {}
+        self.out_arrows = defaultdict(list)
+        self.in_arrows = defaultdict(list)
+        self.arrows_between = defaultdict(list)
+        
+        for k,e in edges.items():
+            source, target = e['source_index'], e['target_index']
+            self.arrow_labels[k] = e['properties'].get('name') or ''
+            self.arrow_ends[k] = (source, target)
+            self.out_arrows[source].append(k)
+            self.in_arrows[target].append(k)
+            self.arrows_between[source, target].append(k)
+            
+    @staticmethod
+    def from_diagram_uid(diagram_uid:str):
+        return DiagramGraph(*QuiverDiagram.editor_rows_by_uid(diagram_uid))
+    
+    @staticmethod
+    def from_quiver_format(format):
+        vertices = {}
+        
+        for k,v in enumerate(format[2:2 + format[1]]):
+            vertices[k] = {'name' : v[2] if len(v) > 2 else ''}
+            
+        edges = {}
+        
+        for k,e in enumerate(format[2 + format[1]:]):
+            edges[k] = {
+                'source_index' : e[0],
+                'target_index' : e[1],
+                'properties' : {'name' : e[2] if len(e) > 2 else ''},
+            }
+            
+        return DiagramGraph(vertices, edges)
+    
+    
+class LabelPattern:
+    """
+    A pattern label compiled into a regex that fully matches the labels it can stand for.
+    """
+    def __init__(self, label:str):
+        self.compiled = compile_label(label)
+        self.regex = self.compiled.regex
+        
+    def bind(self, text:str, bindings:dict):
+        return bind_label(self.compiled, text, bindings)
+    
+    
+class SubgraphMatcher:
+    """
+    Finds the occurrences of a pattern diagram within a target diagram, VF2-style.  Pattern 
+    nodes are placed one at a time in an order that keeps each new node connected to the 
+    ones already placed, and arrows are placed as soon as both of their ends are.  Candidates
+    are pruned by degree and by their labels fitting the pattern's label templates, and 
+    variables must bind consistently across all labels.  Nodes and arrows map injectively.
+    
+    The search gives up after max_steps candidate placements, so its running time is 
+    bounded even on adversarial diagrams;  self.truncated then tells you it did.
+    """
+    def __init__(self, pattern:DiagramGraph, target:DiagramGraph, 
+                 max_steps=MAX_PATTERN_MATCH_STEPS):
+        self.pattern = pattern
+        self.target = target
+        self.max_steps = max_steps
+        self.steps = 0
+        self.truncated = False
+        self._label_patterns = {}        
+        self._candidates = {p : self._node_candidates(p) for p in pattern.node_labels}
+        self._plan = self._search_plan()
+        
+    def _label_pattern(self, label:str) -> LabelPattern:
+        if label not in self._label_patterns:
+            self._label_patterns[label] = LabelPattern(label)
+        return self._label_patterns[label]
+    
+    def _node_candidates(self, p) -> list:
+        P, T = self.pattern, self.target
+        label_pattern = self._label_pattern(P.node_labels[p])
+        out_degree = len(P.out_arrows[p])
+        in_degree = len(P.in_arrows[p])
+        
+        return [t for t, label in T.node_labels.items() 
+                if len(T.out_arrows[t]) >= out_degree and len(T.in_arrows[t]) >= in_degree 
+                and label_pattern.regex.fullmatch(label)]
+    
+    def _search_plan(self) -> list:
+        """
+        Returns a list of (pattern node, pattern arrows to place right after it).
+        """
+        P = self.pattern
+        remaining = set(P.node_labels)
+        placed = set()
+        plan = []
+        
+        def rank(p):
+            links = sum(1 for a in P.out_arrows[p] if P.arrow_ends[a][1] in placed) + \
+                sum(1 for a in P.in_arrows[p] if P.arrow_ends[a][0] in placed)
+            # Most connected first, then the most constrained:
+            return (-links, len(self._candidates[p]), p)
+        
+        while remaining:
+            p = min(remaining, key=rank)
+            remaining.remove(p)
+            placed.add(p)
+            arrows = {a for a in P.out_arrows[p] + P.in_arrows[p] 
+                      if P.arrow_ends[a][0] in placed and P.arrow_ends[a][1] in placed}
+            plan.append((p, sorted(arrows)))
+            
+        return plan
+    
+    def _tick(self) -> bool:
+        self.steps += 1
+        if self.steps > self.max_steps:
+            self.truncated = True
+        return not self.truncated
+        
+    def iter_matches(self):
+        if any(not candidates for candidates in self._candidates.values()):
+            return
+        
+        yield from self._place_node(0, {}, {}, {})
+        
+    def find_matches(self, max_matches=None) -> list:
+        matches = []
+        
+        for match in self.iter_matches():
+            matches.append(match)
+            if max_matches is not None and len(matches) >= max_matches:
+                break
+            
+        return matches
+    
+    def _place_node(self, depth, node_map, arrow_map, bindings):
+        if depth == len(self._plan):
+            yield DiagramMatch(dict(node_map), dict(arrow_map), dict(bindings))
+            return
+        
+        p, arrows = self._plan[depth]
+        label_pattern = self._label_pattern(self.pattern.node_labels[p])
+        used = set(node_map.values())
+        
+        for t in self._candidates[p]:
+            if t in used:
+                continue
+            
+            if not self._tick():
+                return
+            
+            new_bindings = label_pattern.bind(self.target.node_labels[t], bindings)
+            
+            if new_bindings is None:
+                continue
+            
+            node_map[p] = t
+            bindings.update(new_bindings)
+            
+            yield from self._place_arrows(depth, arrows, 0, node_map, arrow_map, bindings)
+            
+            for var in new_bindings:
+                del bindings[var]
+            del node_map[p]
+            
+            if self.truncated:
+                return
+            
+    def _place_arrows(self, depth, arrows, k, node_map, arrow_map, bindings):
+        if k == len(arrows):
+            yield from self._place_node(depth + 1, node_map, arrow_map, bindings)
+            return
+        
+        a = arrows[k]
+        source, target = self.pattern.arrow_ends[a]
+        label_pattern = self._label_pattern(self.pattern.arrow_labels[a])
+        used = set(arrow_map.values())
+        
+        for b in self.target.arrows_between[node_map[source], node_map[target]]:
+            if b in used:
+                continue
+            
+            if not self._tick():
+                return
+            
+            new_bindings = label_pattern.bind(self.target.arrow_labels[b], bindings)
+            
+            if new_bindings is None:
+                continue
+            
+            arrow_map[a] = b
+            bindings.update(new_bindings)
+            
+            yield from self._place_arrows(depth, arrows, k + 1, node_map, arrow_map, bindings)
+            
+            for var in new_bindings:
+                del bindings[var]
+            del arrow_map[a]
+            
+            if self.truncated:
+                return
+            
+            
+def match_diagrams(pattern_uid:str, target_uid:str, max_matches=None, 
+                   max_steps=MAX_PATTERN_MATCH_STEPS) -> list:
+    """
+    Returns the occurrences (DiagramMatch's) of one stored diagram within another.
+    """
+    pattern = DiagramGraph.from_diagram_uid(pattern_uid)
+    target = DiagramGraph.from_diagram_uid(target_uid)
+    matcher = SubgraphMatcher(pattern, target, max_steps=max_steps)
+    return matcher.find_matches(max_matches)
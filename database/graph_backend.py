@@ -0,0 +1,84 @@
+"""
+The graph backend that the models' hot paths talk to.
+
+Besides the named Cypher statements of database.cypher, the backend implements the
+handful of OGM operations the models use (get_or_none, create, save, connect, reconnect).
+The GRAPH_BACKEND setting selects Neo4j (through neomodel) or an in-process memory graph
+(database.memory_graph) that lets save/load/search be profiled & benchmarked hermetically.
+"""
+
+from neomodel import db
+from dope.settings import GRAPH_BACKEND
+from dope.retry import graph_retry_policy
+import threading
+
+
+class Neo4jBackend:
+    name = 'neo4j'
+
+    def _call(self, func, *args, retry=True, **kwargs):
+        # A failure inside a transaction aborts all of it, so there only the breaker applies:
+        in_transaction = getattr(db, '_active_transaction', None) is not None
+        return graph_retry_policy.call(func, *args, retry=retry and not in_transaction, **kwargs)
+
+    def cypher_query(self, name:str, shape:dict, query:str, params:dict):
+        return self._call(db.cypher_query, query, params)
+
+    def transaction(self):
+        return db.transaction
+
+    def get_or_none(self, Model, **filters):
+        return self._call(Model.nodes.get_or_none, **filters)
+
+    def create(self, Model, **props):
+        # BUGFIX: not retried, since if the reply to a create that went through is lost,
+        # the retry creates a second node.  The same goes for connect() & relationships.
+        return self._call(Model(**props).save, retry=False)
+
+    def save(self, model):
+        return self._call(model.save)
+
+    def connect(self, model, rel_name:str, other, properties=None):
+        return self._call(getattr(model, rel_name).connect, other, properties, retry=False)
+
+    def reconnect(self, model, rel_name:str, old, new):
+        self._call(getattr(model, rel_name).reconnect, old, new)
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def graph_backend():
+    global _backend
+
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                _backend = make_graph_backend(GRAPH_BACKEND)
+
+    return _backend
+
+
+def make_graph_backend(name:str):
+    if name == 'neo4j':
+        return Neo4jBackend()
+
+    if name == 'memory':
+        from .memory_graph import MemoryBackend
+        return MemoryBackend()
+
+    raise NotImplementedError(f'There is no graph backend named "{name}".')
+
+
+def set_graph_backend(backend):
+    """
+    Swaps in another backend (e.g. a fresh MemoryBackend for a benchmark run) and returns
+    the previous one.
+    """
+    global _backend
+
+    with _backend_lock:
+        previous, _backend = _backend, backend
+
+    return previous
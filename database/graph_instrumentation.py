@@ -0,0 +1,176 @@
+"""
+Per-request accounting of graph queries.
+
+install_graph_instrumentation() wraps neomodel's db.cypher_query (which every OGM call and
+every named statement ends up in) as well as node saves & relationship connects, and
+GraphQueryMiddleware collects what they record over each request: the query count, the
+total graph time, the rows returned, the slowest statements and the most repeated one
+(a statement run once per item, like an N+1 loop, stands out there).
+
+In DEBUG the numbers go out as X-Graph-* response headers, otherwise as one structured
+log line per request on the "database.graph" logger.
+"""
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from contextvars import ContextVar
+from collections import Counter
+from dope.settings import DEBUG, GRAPH_SLOWEST_STATEMENTS
+from . import cypher
+import functools
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger('database.graph')
+
+_request_stats = ContextVar('graph_request_stats', default=None)
+
+
+class GraphRequestStats:
+    def __init__(self):
+        self.queries = 0
+        self.total_ms = 0.0
+        self.rows = 0
+        self.writes = Counter()    # OGM save / connect calls
+        self.statements = Counter()
+        self.timings = []   # (elapsed_ms, statement)
+
+    def record_query(self, query:str, elapsed_ms:float, rows:int):
+        statement = cypher.statement_name(query) or ' '.join(query.split())[:80]
+        self.queries += 1
+        self.total_ms += elapsed_ms
+        self.rows += rows
+        self.statements[statement] += 1
+        self.timings.append((elapsed_ms, statement))
+
+    def slowest(self, count=GRAPH_SLOWEST_STATEMENTS) -> list:
+        return sorted(self.timings, key=lambda t: t[0], reverse=True)[:count]
+
+    def summary(self) -> dict:
+        repeated = self.statements.most_common(1)
+
+        return {
+            'queries' : self.queries,
+            'total_ms' : round(self.total_ms, 3),
+            'rows' : self.rows,
+            'writes' : dict(self.writes),
+            'slowest' : [{'statement': s, 'ms': round(ms, 3)} for ms, s in self.slowest()],
+            'most_repeated' : {'statement': repeated[0][0], 'count': repeated[0][1]} \
+                              if repeated else None,
+        }
+
+
+def record_graph_query(query:str, elapsed_ms:float, rows:int):
+    stats = _request_stats.get()
+
+    if stats is not None:
+        stats.record_query(query, elapsed_ms, rows)
+
+
+def record_graph_write(kind:str):
+    stats = _request_stats.get()
+
+    if stats is not None:
+        stats.writes[kind] += 1
+
+
+_install_lock = threading.Lock()
+_installed = False
+
+
+def install_graph_instrumentation():
+    """
+    Wraps neomodel's entry points (once per process) so that they report to the current
+    request's GraphRequestStats, if any.
+    """
+    global _installed
+
+    with _install_lock:
+        if _installed:
+            return
+
+        # BUGFIX: neomodel.relationship_manager moved in neomodel 5.3, the root export didn't
+        from neomodel import db, StructuredNode, RelationshipManager
+
+        cypher_query = db.cypher_query
+
+        @functools.wraps(cypher_query)
+        def instrumented_cypher_query(query, params=None, *args, **kwargs):
+            start = time.perf_counter()
+            results, meta = cypher_query(query, params, *args, **kwargs)
+            record_graph_query(query, (time.perf_counter() - start) * 1000,
+                               len(results) if results else 0)
+            return results, meta
+
+        db.cypher_query = instrumented_cypher_query
+
+        def count_calls(cls, method_name:str, kind:str):
+            method = getattr(cls, method_name)
+
+            @functools.wraps(method)
+            def counted(*args, **kwargs):
+                record_graph_write(kind)
+                return method(*args, **kwargs)
+
+            setattr(cls, method_name, counted)
+
+        count_calls(StructuredNode, 'save', 'save')
+        count_calls(RelationshipManager, 'connect', 'connect')
+        _installed = True
+
+
+class GraphQueryMiddleware:
+    sync_capable = True
+    async_capable = True    # So as not to push the async views back onto a thread
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+
+        if self.is_async:
+            markcoroutinefunction(self)
+
+        install_graph_instrumentation()
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+
+        stats = GraphRequestStats()
+        token = _request_stats.set(stats)
+
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_stats.reset(token)
+
+        return self.report(request, response, stats)
+
+    async def __acall__(self, request):
+        stats = GraphRequestStats()
+        token = _request_stats.set(stats)
+
+        try:
+            response = await self.get_response(request)
+        finally:
+            _request_stats.reset(token)
+
+        return self.report(request, response, stats)
+
+    def report(self, request, response, stats):
+        if DEBUG:
+            response['X-Graph-Queries'] = str(stats.queries)
+            response['X-Graph-Time-Ms'] = f'{stats.total_ms:.3f}'
+            response['X-Graph-Rows'] = str(stats.rows)
+            response['X-Graph-Writes'] = str(sum(stats.writes.values()))
+            response['X-Graph-Slowest'] = '; '.join(
+                f'{s}={ms:.3f}ms' for ms, s in stats.slowest())
+        elif stats.queries or stats.writes:
+            summary = stats.summary()
+            summary['method'] = request.method
+            summary['path'] = request.path
+            summary['status'] = response.status_code
+            logger.info(json.dumps(summary), extra={'graph': summary})
+
+        return response
@@ -1,11 +1,12 @@
 from .models import Diagram
+from .graph_backend import graph_backend
 #from django.core.exceptions import ObjectDoesNotExist
 from django.db import DatabaseError
 from django.core.exceptions import ObjectDoesNotExist
 
 
 def get_diagram(request, **kwargs):    
-    diagram = Diagram.nodes.get_or_none(**kwargs)
+    diagram = graph_backend().get_or_none(Diagram, **kwargs)
 
     if diagram is None:
         raise ObjectDoesNotExist(
@@ -15,14 +16,13 @@ def get_diagram(request, **kwargs):
     session = request.session
     user = request.user.username
     
-    if 'diagram' in session:
-        if diagram.checked_out_by:  # Yes, test for both None and ''
-            if diagram.checked_out_by != user:
-                del session['diagram']
-                raise Exception(f'User "{diagram.checked_out_by}" already has that diagram checked out for editing.')
+    # BUGFIX: reading checked_out_by and then saving it raced with other users' checkouts.
+    uid, revision, checked_out_by = Diagram.checkout(diagram.name, user)
+    
+    if checked_out_by != user:
+        session.pop('diagram', None)
+        raise Exception(f'User "{checked_out_by}" already has that diagram checked out for editing.')
 
     diagram.checked_out_by = user
-    diagram.save()
     session['diagram'] = diagram.name            
     return diagram
-        
\ No newline at end of file
@@ -0,0 +1,57 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import setup_test_environment, teardown_test_environment
+from database.benchmarks import DiagramBenchmark, DEFAULT_SIZES
+from datetime import datetime, timezone
+import json
+
+
+class Command(BaseCommand):
+    help = "Benchmarks saving, loading, serializing, deleting & searching synthetic diagrams " \
+           "of increasing size, writing round trip counts and p50/p95 latencies to JSON."
+    
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+            help='The numbers of objects in the synthetic diagrams.')
+        parser.add_argument(
+            '--repeat', type=int, default=5, help='How many times to time each operation per size.')
+        parser.add_argument(
+            '--backend', choices=['memory', 'neo4j'], default='memory',
+            help='The graph backend to benchmark against.')
+        parser.add_argument(
+            '--search-path-length', type=int, default=4)
+        parser.add_argument(
+            '--search-path-limit', type=int, default=64)
+        parser.add_argument(
+            '--output', default='benchmark_results.json', help='Where to write the results.')
+        
+    def handle(self, *args, **options):
+        # The test client's users & sessions go into a throwaway database:
+        setup_test_environment()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        
+        try:
+            benchmark = DiagramBenchmark(
+                sizes=options['sizes'], repeat=options['repeat'],
+                search_path_length=options['search_path_length'],
+                search_path_limit=options['search_path_limit'])
+            results = benchmark.run(options['backend'])
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+            
+        results['timestamp'] = datetime.now(timezone.utc).isoformat()
+        
+        with open(options['output'], 'w') as file:
+            json.dump(results, file, indent=2)
+            
+        for size, operations in results['results'].items():
+            self.stdout.write(self.style.MIGRATE_HEADING(f'{size} objects'))
+            
+            for operation, stats in operations.items():
+                self.stdout.write(
+                    f"  {operation:<28} {stats['round_trips']:>4} round trips   "
+                    f"p50 {stats['p50_ms']:>10.3f} ms   p95 {stats['p95_ms']:>10.3f} ms")
+                
+        self.stdout.write(self.style.SUCCESS(f"Wrote {options['output']}"))
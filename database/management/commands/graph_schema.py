@@ -0,0 +1,115 @@
+from django.core.management.base import BaseCommand, CommandError
+from neomodel import db
+from database.models import backfill_label_shapes, backfill_diagram_counts
+from database import cypher
+
+
+# (kind, name, label or relationship type, property, is the label a relationship type).
+# Each entry's lookups stay O(log n) in the size of the graph:
+GRAPH_SCHEMA = [
+    ('UNIQUENESS', 'quiver_diagram_uid', 'QuiverDiagram', 'uid', False),
+    ('UNIQUENESS', 'quiver_node_uid', 'QuiverNode', 'uid', False),
+    ('UNIQUENESS', 'category_uid', 'Category', 'uid', False),
+    # Categories are upserted by name (see database.models.upsert).  Run with 
+    # --merge-categories first if duplicates have crept in:
+    ('UNIQUENESS', 'category_name', 'Category', 'name', False),
+    # Diagrams are created by name (see the create_diagram statement), which this makes 
+    # race-free.  It can't be created while duplicate names remain, which are reported:
+    ('UNIQUENESS', 'diagram_name', 'Diagram', 'name', False),
+    ('INDEX', 'quiver_node_shape', 'QuiverNode', 'shape', False),
+    ('INDEX', 'maps_to_shape', 'MAPS_TO', 'shape', True),
+]
+
+
+def schema_statement(kind, name, label, prop, is_rel) -> str:
+    pattern = f"()-[x:{label}]-()" if is_rel else f"(x:{label})"
+    
+    if kind == 'UNIQUENESS':
+        return f"CREATE CONSTRAINT {name} IF NOT EXISTS FOR {pattern} REQUIRE x.{prop} IS UNIQUE"
+    
+    return f"CREATE INDEX {name} IF NOT EXISTS FOR {pattern} ON (x.{prop})"
+
+
+def existing_schema() -> dict:
+    """
+    Returns a dict keyed by (kind, label, property) with values (name, state) for every
+    single-property constraint & index in the database.  Things are looked up by what 
+    they cover rather than by name, since an equivalent one may exist under another name
+    (e.g. from neomodel's install_labels).
+    """
+    schema = {}
+    
+    results, meta = db.cypher_query(
+        "SHOW INDEXES YIELD name, type, entityType, labelsOrTypes, properties, state, owningConstraint")
+    
+    for name, type, entity_type, labels, props, state, owning_constraint in results:
+        if not labels or not props or len(props) != 1:
+            continue   # Lookup indexes and composite ones
+        kind = 'UNIQUENESS' if owning_constraint else 'INDEX'
+        schema[kind, labels[0], props[0]] = (owning_constraint or name, state)
+        
+    results, meta = db.cypher_query(
+        "SHOW CONSTRAINTS YIELD name, type, labelsOrTypes, properties")
+    
+    for name, type, labels, props in results:
+        if 'UNIQUE' in type and labels and props and len(props) == 1:
+            schema.setdefault(('UNIQUENESS', labels[0], props[0]), (name, 'ONLINE'))
+            
+    return schema
+    
+
+class Command(BaseCommand):
+    help = "Declares the graph's uniqueness constraints & indexes, then reports their state."
+    
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check', action='store_true',
+            help="Only verify the schema, exiting with an error if anything's missing.")
+        parser.add_argument(
+            '--backfill-shapes', action='store_true',
+            help='Also compute the label shape signatures of nodes & arrows lacking one.')
+        parser.add_argument(
+            '--backfill-counts', action='store_true',
+            help='Also count the objects & arrows of diagrams saved before counts were kept.')
+        parser.add_argument(
+            '--merge-categories', action='store_true',
+            help='First fold categories with the same name into one, so their names can be unique.')
+        
+    def handle(self, *args, **options):
+        if options['merge_categories'] and not options['check']:
+            results, meta = cypher.run('merge_duplicate_categories')
+            self.stdout.write(f'Merged away {results[0][0]} duplicate categories.')
+            
+        if not options['check']:
+            for entry in GRAPH_SCHEMA:
+                try:
+                    db.cypher_query(schema_statement(*entry))
+                except Exception as e:
+                    # E.g. existing duplicates violate a uniqueness constraint
+                    self.stderr.write(self.style.ERROR(f'Could not create {entry[1]}: {e}'))
+                    
+        schema = existing_schema()
+        missing = []
+        
+        for kind, name, label, prop, is_rel in GRAPH_SCHEMA:
+            found = schema.get((kind, label, prop))
+            description = f'{kind.lower():<10} {label}.{prop}'
+            
+            if found is None:
+                missing.append(name)
+                self.stdout.write(self.style.ERROR(f'{description:<36} MISSING'))
+            else:
+                found_name, state = found
+                style = self.style.SUCCESS if state == 'ONLINE' else self.style.WARNING
+                self.stdout.write(style(f'{description:<36} {state} ({found_name})'))
+                
+        if options['backfill_shapes'] and not options['check']:
+            count = backfill_label_shapes()
+            self.stdout.write(f'Backfilled the shapes of {count} nodes & arrows.')
+            
+        if options['backfill_counts'] and not options['check']:
+            count = backfill_diagram_counts()
+            self.stdout.write(f'Backfilled the object & arrow counts of {count} diagrams.')
+                
+        if missing:
+            raise CommandError(f'Missing from the graph schema: {", ".join(missing)}')
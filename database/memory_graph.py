@@ -0,0 +1,682 @@
+"""
+An in-process stand-in for the Neo4j graph, selected with GRAPH_BACKEND = 'memory'.
+
+It implements every named statement of database.cypher (one _run_<name> method each) plus
+the OGM operations of database.graph_backend, over plain dicts.  Nodes & relationships
+are handed out as MemoryNode / MemoryRel, which quack enough like the driver's Node and
+Relationship for neomodel's inflate() to work on them.
+"""
+
+from contextlib import contextmanager
+from collections import defaultdict
+import itertools
+import re
+import threading
+import time
+from .graph_instrumentation import record_graph_query, record_graph_write
+
+
+class MemoryEntity:
+    def __init__(self, id:int, properties:dict):
+        self.id = id
+        self.element_id = str(id)
+        self._properties = properties
+
+    def __getitem__(self, key):
+        return self._properties[key]
+
+    def __contains__(self, key):
+        return key in self._properties
+
+    def __iter__(self):
+        return iter(self._properties)
+
+    def __len__(self):
+        return len(self._properties)
+
+    def get(self, key, default=None):
+        return self._properties.get(key, default)
+
+    def keys(self):
+        return self._properties.keys()
+
+    def values(self):
+        return self._properties.values()
+
+    def items(self):
+        return self._properties.items()
+
+
+class MemoryNode(MemoryEntity):
+    def __init__(self, id:int, labels, properties:dict):
+        super().__init__(id, properties)
+        self.labels = frozenset(labels)
+
+    def __repr__(self):
+        return f'MemoryNode({self.id}, {sorted(self.labels)}, {self._properties})'
+
+
+class MemoryRel(MemoryEntity):
+    def __init__(self, id:int, type:str, start_node:MemoryNode, end_node:MemoryNode,
+                 properties:dict):
+        super().__init__(id, properties)
+        self.type = type
+        self.start_node = start_node
+        self.end_node = end_node
+
+    @property
+    def nodes(self):
+        return (self.start_node, self.end_node)
+
+    def __repr__(self):
+        return f'MemoryRel({self.id}, {self.type}, {self.start_node.id}->{self.end_node.id})'
+
+
+class MemoryBackend:
+    name = 'memory'
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._ids = itertools.count()
+        self._undo = None   # The undo log of the open transaction, if any
+        self.nodes = {}
+        self.rels = {}
+        self.out_rels = defaultdict(dict)   # node id -> {rel id: rel}, ordered by creation
+        self.in_rels = defaultdict(dict)
+        self.by_label = defaultdict(dict)   # label -> {node id: node}
+        self.by_uid = {}
+
+    # Primitive writes.  Each one logs how to undo itself while a transaction is open.
+
+    def _log(self, undo):
+        if self._undo is not None:
+            self._undo.append(undo)
+
+    def _index(self, node):
+        for label in node.labels:
+            self.by_label[label][node.id] = node
+        if node.get('uid') is not None:
+            self.by_uid[node['uid']] = node
+
+    def _unindex(self, node):
+        for label in node.labels:
+            self.by_label[label].pop(node.id, None)
+        if node.get('uid') is not None and self.by_uid.get(node['uid']) is node:
+            del self.by_uid[node['uid']]
+
+    def create_node(self, labels, properties:dict) -> MemoryNode:
+        node = MemoryNode(next(self._ids), labels,
+                          {k : v for k,v in properties.items() if v is not None})
+        self.nodes[node.id] = node
+        self._index(node)
+        self._log(lambda: self._remove_node(node))
+        return node
+
+    def _remove_node(self, node):
+        self._unindex(node)
+        del self.nodes[node.id]
+        self.out_rels.pop(node.id, None)
+        self.in_rels.pop(node.id, None)
+
+    def delete_node(self, node, detach=True):
+        rels = list(self.out_rels[node.id].values()) + list(self.in_rels[node.id].values())
+
+        if rels and not detach:
+            raise ValueError(f'Cannot delete {node} because it still has relationships.')
+
+        for rel in rels:
+            if rel.id in self.rels:   # A self-loop shows up twice
+                self.delete_rel(rel)
+
+        self._remove_node(node)
+        self._log(lambda: self._restore_node(node))
+
+    def _restore_node(self, node):
+        self.nodes[node.id] = node
+        self._index(node)
+
+    def set_properties(self, entity, updates:dict, replace=False):
+        """
+        SET x += updates, or SET x = updates if replace.  Setting a property to None
+        removes it, as in Cypher.
+        """
+        previous = dict(entity._properties)
+        is_node = isinstance(entity, MemoryNode)
+
+        if is_node:
+            self._unindex(entity)
+
+        if replace:
+            entity._properties.clear()
+
+        for key, value in updates.items():
+            if value is None:
+                entity._properties.pop(key, None)
+            else:
+                entity._properties[key] = value
+
+        if is_node:
+            self._index(entity)
+
+        self._log(lambda: self._restore_properties(entity, previous))
+
+    def _restore_properties(self, entity, previous:dict):
+        is_node = isinstance(entity, MemoryNode)
+        if is_node:
+            self._unindex(entity)
+        entity._properties.clear()
+        entity._properties.update(previous)
+        if is_node:
+            self._index(entity)
+
+    def create_rel(self, type:str, start_node, end_node, properties:dict=None) -> MemoryRel:
+        properties = {k : v for k,v in (properties or {}).items() if v is not None}
+        rel = MemoryRel(next(self._ids), type, start_node, end_node, properties)
+        self._add_rel(rel)
+        self._log(lambda: self._remove_rel(rel))
+        return rel
+
+    def _add_rel(self, rel):
+        self.rels[rel.id] = rel
+        self.out_rels[rel.start_node.id][rel.id] = rel
+        self.in_rels[rel.end_node.id][rel.id] = rel
+
+    def _remove_rel(self, rel):
+        del self.rels[rel.id]
+        self.out_rels[rel.start_node.id].pop(rel.id, None)
+        self.in_rels[rel.end_node.id].pop(rel.id, None)
+
+    def delete_rel(self, rel):
+        self._remove_rel(rel)
+        self._log(lambda: self._add_rel(rel))
+
+    # Reads
+
+    def outgoing(self, node, type:str, end_label:str=None) -> list:
+        return [rel for rel in self.out_rels[node.id].values()
+                if rel.type == type and (end_label is None or end_label in rel.end_node.labels)]
+
+    def contained(self, diagram, label='QuiverNode') -> list:
+        return [rel.end_node for rel in self.outgoing(diagram, 'CONTAINS', label)]
+
+    def diagram(self, diagram_uid:str):
+        node = self.by_uid.get(diagram_uid)
+        if node is None or 'QuiverDiagram' not in node.labels:
+            return None
+        return node
+
+    def find_nodes(self, label:str, **filters) -> list:
+        if 'uid' in filters:
+            node = self.by_uid.get(filters['uid'])
+            candidates = [node] if node is not None and label in node.labels else []
+        else:
+            candidates = self.by_label[label].values()
+
+        return [node for node in candidates
+                if all(node.get(key) == value for key, value in filters.items())]
+
+    # Graph backend interface
+
+    @contextmanager
+    def transaction(self):
+        with self._lock:
+            if self._undo is not None:
+                # Join the transaction that's already open
+                yield
+                return
+
+            self._undo = []
+
+            try:
+                yield
+            except BaseException:
+                for undo in reversed(self._undo):
+                    undo()
+                raise
+            finally:
+                self._undo = None
+
+    def cypher_query(self, name:str, shape:dict, query:str, params:dict):
+        handler = getattr(self, f'_run_{name}', None)
+
+        if handler is None:
+            raise NotImplementedError(f'The memory graph does not implement statement "{name}".')
+
+        start = time.perf_counter()
+
+        with self._lock:
+            results = handler(**shape, **params)
+
+        record_graph_query(query, (time.perf_counter() - start) * 1000, len(results))
+        return results, None
+
+    def get_or_none(self, Model, **filters):
+        with self._lock:
+            nodes = self.find_nodes(Model.__label__, **filters)
+
+        if len(nodes) > 1:
+            raise Model.MultipleNodesReturned(repr(filters))
+
+        return Model.inflate(nodes[0]) if nodes else None
+
+    def create(self, Model, **props):
+        record_graph_write('save')
+
+        with self._lock:
+            node = self.create_node(Model.inherited_labels(), Model.deflate(props))
+        return Model.inflate(node)
+
+    def _node_of(self, model):
+        node = self.by_uid.get(model.uid)
+
+        if node is None:
+            raise ValueError(f'{model} has not been saved to the memory graph.')
+
+        return node
+
+    def save(self, model):
+        record_graph_write('save')
+
+        with self._lock:
+            props = type(model).deflate(model.__properties__, model)
+
+            if model.uid in self.by_uid:
+                self.set_properties(self._node_of(model), props, replace=True)
+            else:
+                self.create_node(type(model).inherited_labels(), props)
+
+        return model
+
+    def _relation_type(self, model, rel_name:str) -> str:
+        return getattr(type(model), rel_name).definition['relation_type']
+
+    def connect(self, model, rel_name:str, other, properties=None):
+        record_graph_write('connect')
+
+        with self._lock:
+            self.create_rel(self._relation_type(model, rel_name),
+                            self._node_of(model), self._node_of(other), properties)
+
+    def reconnect(self, model, rel_name:str, old, new):
+        with self._lock, self.transaction():
+            type = self._relation_type(model, rel_name)
+            node, old_node = self._node_of(model), self._node_of(old)
+
+            for rel in self.outgoing(node, type):
+                if rel.end_node is old_node:
+                    self.delete_rel(rel)
+                    self.create_rel(type, node, self._node_of(new), dict(rel._properties))
+
+    # The statements of database.cypher.  Each returns the result rows.
+
+    def _run_nodes_by_uids(self, label, uids):
+        return [[x] for uid in uids for x in self.find_nodes(label, uid=uid)]
+
+    def _run_upsert_node(self, labels, key_names, keys, props):
+        nodes = self.find_nodes(labels[0], **{key: keys[key] for key in key_names})
+        return [[nodes[0] if nodes else self.create_node(labels, props)]]
+
+    def _run_set_property(self, label, prop, unique, uid, value):
+        nodes = self.find_nodes(label, uid=uid)
+
+        if unique and any(x['uid'] != uid for x in self.find_nodes(label, **{prop: value})):
+            return []
+
+        for x in nodes:
+            self.set_properties(x, {prop: value})
+
+        return [[x['uid']] for x in nodes]
+
+    def _category(self, category_name, category_uid):
+        categories = self.find_nodes('Category', name=category_name)
+        return categories[0] if categories else \
+            self.create_node(('Category',), {'name': category_name, 'uid': category_uid})
+
+    def _run_merge_duplicate_categories(self):
+        by_name = defaultdict(list)
+        count = 0
+
+        for C in sorted(self.by_label['Category'].values(), key=lambda C: C.id):
+            by_name[C.get('name')].append(C)
+
+        for category, *duplicates in by_name.values():
+            for duplicate in duplicates:
+                for rel in list(self.in_rels[duplicate.id].values()):
+                    if rel.type == 'LIVES_IN' and \
+                       not any(r.end_node is category for r in self.outgoing(rel.start_node, 'LIVES_IN')):
+                        self.create_rel('LIVES_IN', rel.start_node, category)
+                self.delete_node(duplicate)
+                count += 1
+
+        return [[count]]
+
+    def _run_outgoing_arrows(self, uid):
+        node = self.by_uid.get(uid)
+        return [[rel] for rel in self.outgoing(node, 'MAPS_TO', 'QuiverNode')] if node else []
+
+    def _run_delete_outgoing_arrows(self, uid):
+        node = self.by_uid.get(uid)
+        for rel in self.outgoing(node, 'MAPS_TO', 'QuiverNode') if node else []:
+            self.delete_rel(rel)
+        return []
+
+    def _run_diagram_objects(self, diagram_uid):
+        D = self.diagram(diagram_uid)
+        return [[x] for x in self.contained(D)] if D else []
+
+    def _run_editor_rows(self, diagram_uid):
+        D = self.diagram(diagram_uid)
+
+        if D is None:
+            return []
+
+        vertices = []
+        edges = []
+
+        for A in self.contained(D):
+            vertices.append(dict(A._properties))
+
+            for f in self.outgoing(A, 'MAPS_TO', 'QuiverNode'):
+                edges.append({
+                    'source_index' : A.get('diagram_index'),
+                    'target_index' : f.end_node.get('diagram_index'),
+                    'properties' : dict(f._properties),
+                })
+
+        return [[vertices, edges]]
+
+    def _run_revision_by_name(self, label, name):
+        diagrams = self.find_nodes(label, name=name)
+
+        if not diagrams:
+            return []
+
+        D = diagrams[0]
+        return [[D['uid'], D.get('revision', 0), D.get('checked_out_by')]]
+
+    @staticmethod
+    def _lease_free(entity, username, now) -> bool:
+        return entity.get('checked_out_by') == username or entity.get('checkout_expires', 0) < now
+
+    def _run_checkout_diagram(self, label, name, username, ttl):
+        diagrams = self.find_nodes(label, name=name)
+
+        if not diagrams:
+            return []
+
+        D = diagrams[0]
+        now = int(time.time() * 1000)
+
+        if self._lease_free(D, username, now):
+            self.set_properties(D, {'checked_out_by': username, 'checkout_expires': now + ttl})
+
+        return [[D['uid'], D.get('revision', 0), D.get('checked_out_by')]]
+
+    def _run_release_diagram(self, label, name, username):
+        diagrams = self.find_nodes(label, name=name)
+
+        if not diagrams or diagrams[0].get('checked_out_by') != username:
+            return []
+
+        self.set_properties(diagrams[0], {'checkout_expires': 0})
+        return [[diagrams[0]['uid']]]
+
+    def _rule(self, rule_id):
+        r = self.rels.get(int(rule_id))
+        return r if r is not None and r.type == 'RULE' else None
+
+    def _run_checkout_rule(self, rule_id, username, ttl):
+        r = self._rule(rule_id)
+
+        if r is None:
+            return []
+
+        K, R = r.nodes
+        now = int(time.time() * 1000)
+        held = [x for x in (K, r, R) if not self._lease_free(x, username, now)]
+
+        if not held:
+            for x in (K, r, R):
+                self.set_properties(x, {'checked_out_by': username, 'checkout_expires': now + ttl})
+
+        holder = held[0].get('checked_out_by') if held else username
+        return [[holder, K.get('revision', 0), R.get('revision', 0)]]
+
+    def _run_release_rule(self, rule_id, username):
+        r = self._rule(rule_id)
+
+        if r is None:
+            return [[0]]
+
+        for x in (r.start_node, r, r.end_node):
+            if x.get('checked_out_by') == username:
+                self.set_properties(x, {'checkout_expires': 0})
+
+        return [[1]]
+
+    def _run_upsert_diagram(self, labels, props, category_name, category_uid):
+        C = self._category(category_name, category_uid)
+        diagrams = self.find_nodes(labels[0], name=props['name'])
+
+        if diagrams:
+            return [[diagrams[0]]]
+
+        D = self.create_node(labels, props)
+        self.create_rel('LIVES_IN', D, C)
+        return [[D]]
+
+    def _run_set_category(self, diagram_uid, category_name, category_uid):
+        D = self.diagram(diagram_uid)
+
+        if D is None:
+            return []
+
+        C = self._category(category_name, category_uid)
+        olds = [rel for rel in self.outgoing(D, 'LIVES_IN', 'Category') if rel.end_node is not C]
+
+        for rel in olds:
+            self.delete_rel(rel)
+
+        if not self.outgoing(D, 'LIVES_IN', 'Category'):
+            self.create_rel('LIVES_IN', D, C)
+
+        if olds:
+            self.set_properties(D, {'revision': D.get('revision', 0) + 1})
+
+        return [[D.get('revision', 0)]]
+
+    def _run_create_rule(self, labels, category_name, category_uid, key_props, result_props, props):
+        if any(self.find_nodes(labels[0], name=x['name']) for x in (key_props, result_props)):
+            return []
+
+        C = self._category(category_name, category_uid)
+        K = self.create_node(labels, key_props)
+        R = self.create_node(labels, result_props)
+        self.create_rel('LIVES_IN', K, C)
+        self.create_rel('LIVES_IN', R, C)
+        return [[self.create_rel('RULE', K, R, props)]]
+
+    def _run_create_diagram(self, labels, props, category_name, category_uid):
+        if self.find_nodes(labels[0], name=props['name']):
+            return []
+
+        C = self._category(category_name, category_uid)
+        D = self.create_node(labels, props)
+        self.create_rel('LIVES_IN', D, C)
+        return [[D['uid']]]
+
+    def _run_lock_revision(self, diagram_uid):
+        # The backend's lock is already held for the whole transaction
+        D = self.diagram(diagram_uid)
+        return [[D.get('revision', 0)]] if D is not None else []
+
+    def _run_bump_revision(self, diagram_uid, object_count=None, arrow_count=None):
+        D = self.diagram(diagram_uid)
+
+        if D is None:
+            return []
+
+        updates = {'revision': D.get('revision', 0) + 1}
+        if object_count is not None:
+            updates['object_count'] = object_count
+        if arrow_count is not None:
+            updates['arrow_count'] = arrow_count
+
+        self.set_properties(D, updates)
+        return [[D['revision']]]
+
+    def _run_diagram_page(self, label, after, limit, after_name=None, after_uid=None):
+        diagrams = sorted((D for D in self.by_label[label].values() if D.get('name') is not None),
+                          key=lambda D: (D['name'], D.get('uid')))
+
+        if after:
+            diagrams = [D for D in diagrams if (D.get('name'), D.get('uid')) > (after_name, after_uid)]
+
+        rows = []
+
+        for D in diagrams[:limit]:
+            categories = [rel.end_node for rel in self.outgoing(D, 'LIVES_IN', 'Category')]
+            rows.append([D.get('name'), D.get('uid'),
+                         categories[0].get('name') if categories else None,
+                         D.get('checked_out_by'), D.get('object_count', 0), D.get('arrow_count', 0)])
+
+        return rows
+
+    def _run_create_vertices(self, diagram_uid, vertices):
+        D = self.diagram(diagram_uid)
+
+        if D is None:
+            return []
+
+        categories = [rel.end_node for rel in self.outgoing(D, 'LIVES_IN', 'Category')]
+
+        for v in vertices:
+            x = self.create_node(('QuiverNode', 'Object'), v)
+            self.create_rel('CONTAINS', D, x)
+            for C in categories:
+                self.create_rel('LIVES_IN', x, C)
+
+        return []
+
+    def _run_update_vertices(self, vertices):
+        for v in vertices:
+            for x in self.find_nodes('QuiverNode', uid=v['uid']):
+                self.set_properties(x, v)
+        return []
+
+    def _run_delete_vertices(self, uids):
+        for uid in uids:
+            for x in self.find_nodes('QuiverNode', uid=uid):
+                self.delete_node(x)
+        return []
+
+    def _run_create_edges(self, edges):
+        for e in edges:
+            for A in self.find_nodes('QuiverNode', uid=e['source']):
+                for B in self.find_nodes('QuiverNode', uid=e['target']):
+                    self.create_rel('MAPS_TO', A, B, e['properties'])
+        return []
+
+    def _run_update_edges(self, edges):
+        for e in edges:
+            for A in self.find_nodes('QuiverNode', uid=e['source']):
+                for f in self.outgoing(A, 'MAPS_TO', 'QuiverNode'):
+                    if f.end_node.get('uid') == e['target'] and \
+                       f.get('diagram_index') == e['properties']['diagram_index']:
+                        self.set_properties(f, e['properties'])
+        return []
+
+    def _run_delete_edges(self, diagram_uid, indices):
+        D = self.diagram(diagram_uid)
+        indices = set(indices)
+
+        for A in self.contained(D) if D else []:
+            for f in self.outgoing(A, 'MAPS_TO', 'QuiverNode'):
+                if f.get('diagram_index') in indices:
+                    self.delete_rel(f)
+
+        return []
+
+    def _run_delete_objects_batch(self, diagram_uid, batch_size):
+        D = self.diagram(diagram_uid)
+        batch = self.contained(D)[:batch_size] if D else []
+
+        for x in batch:
+            self.delete_node(x)
+
+        return [[len(batch)]]
+
+    def _run_delete_diagram(self, diagram_uid):
+        D = self.diagram(diagram_uid)
+
+        if D is not None:
+            self.delete_node(D)
+
+        return []
+
+    def _run_diagram_paths(self, length, simple, limited, diagram_uid, limit=None):
+        D = self.diagram(diagram_uid)
+        rows = []
+
+        def project(entity):
+            return {
+                'diagram_index' : entity.get('diagram_index'),
+                'shape' : entity.get('shape'),
+                'name' : entity.get('name', ''),
+            }
+
+        def extend(nodes, rels):
+            if limited and len(rows) >= limit:
+                return
+
+            if len(rels) == length:
+                rows.append([[project(x) for x in nodes], [project(f) for f in rels]])
+                return
+
+            for f in self.outgoing(nodes[-1], 'MAPS_TO', 'QuiverNode'):
+                if f in rels or (simple and f.end_node in nodes):
+                    continue
+                extend(nodes + [f.end_node], rels + [f])
+
+        for X in self.contained(D) if D else []:
+            extend([X], [])
+
+        return rows
+
+    def _run_count_diagrams_batch(self, batch_size):
+        uncounted = [D for D in self.by_label['QuiverDiagram'].values() if D.get('object_count') is None]
+
+        for D in uncounted[:batch_size]:
+            objects = self.contained(D)
+            arrows = sum(len(self.outgoing(x, 'MAPS_TO', 'QuiverNode')) for x in objects)
+            self.set_properties(D, {'object_count': len(objects), 'arrow_count': arrows})
+
+        return [[min(len(uncounted), batch_size)]]
+
+    def _shaped_items(self, kind) -> list:
+        if kind == 'nodes':
+            return list(self.by_label['QuiverNode'].values())
+        return [f for f in self.rels.values()
+                if f.type == 'MAPS_TO' and 'QuiverNode' in f.start_node.labels]
+
+    def _run_shapeless_items(self, kind, batch_size):
+        items = [x for x in self._shaped_items(kind) if x.get('shape') is None]
+        return [[x.element_id, x.get('name', '')] for x in items[:batch_size]]
+
+    def _run_set_shapes(self, kind, rows):
+        items = {x.element_id : x for x in self._shaped_items(kind)}
+
+        for row in rows:
+            if row['id'] in items:
+                self.set_properties(items[row['id']], {'shape': row['shape']})
+
+        return []
+
+    def _run_python_code_by_pattern(self, code_regex, globals_regex):
+        code_regex = re.compile(code_regex)
+        globals_regex = re.compile(globals_regex)
+        rows = [[p] for p in self.by_label['Python'].values()
+                if code_regex.fullmatch(p.get('code', '')) and
+                globals_regex.fullmatch(p.get('globals_dict', ''))]
+        rows.sort(key=lambda row: len(row[0].get('code', '')))
+        return rows
@@ -0,0 +1,23 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingDiagramSave',
+            fields=[
+                ('diagram_uid', models.CharField(max_length=36, primary_key=True, serialize=False)),
+                ('username', models.CharField(max_length=64)),
+                ('payload', models.TextField()),
+                ('first_queued_at', models.DateTimeField()),
+                ('queued_at', models.DateTimeField()),
+                ('flushing_until', models.DateTimeField(null=True)),
+            ],
+        ),
+    ]
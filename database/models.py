@@ -4,13 +4,55 @@ from neomodel import (StructuredNode, StructuredRel, IntegerProperty,
                       RelationshipTo)
 #from django_neomodel import DjangoNode
 #from django.db import models
-from dope.settings import MAX_ATOMIC_LATEX_LENGTH, DEFAULT_CATEGORY_NAME
+from django.db import models as orm
+from dope.settings import (MAX_ATOMIC_LATEX_LENGTH, DEFAULT_CATEGORY_NAME, 
+                           DIAGRAM_DELETE_BATCH_SIZE, MAX_SEARCH_PATH_LENGTH,
+                           DIAGRAM_PAGE_SIZE, MAX_USERNAME_LENGTH, CHECKOUT_LEASE_TTL)
 from django.core.exceptions import ObjectDoesNotExist
 from neomodel import db
 from dope.python_tools import deep_get
 from dope.variable import Variable
 from dope.keyword import Keyword
+from dope.label_templates import compile_label, bind_label
+from database.diagram_edits import apply_edit_ops
 from database.neo4j_tools import neo4j_escape_regex_str 
+from database import cypher
+from database.graph_backend import graph_backend
+from collections import namedtuple
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+import json
+import time
+from uuid import uuid4
+
+
+# A MAPS_TO path, as lists of the property dicts (diagram_index, name, shape) of its
+# nodes and of its arrows:
+PathRecord = namedtuple('PathRecord', ['nodes', 'rels'])
+
+class RevisionConflict(Exception):
+    """
+    Raised when a write is based on a revision of a diagram that's no longer its latest.
+    """
+    def __init__(self, revision:int):
+        super().__init__(f'The diagram has changed since then; it is now at revision {revision}.')
+        self.revision = revision
+        
+        
+# A row of a diagram listing page (owner is whoever has the diagram checked out):
+DiagramListing = namedtuple(
+    'DiagramListing', ['name', 'uid', 'category', 'owner', 'object_count', 'arrow_count'])
+
+
+def encode_cursor(name:str, uid:str) -> str:
+    return urlsafe_b64encode(json.dumps([name, uid]).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor:str):
+    try:
+        name, uid = json.loads(urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, TypeError):
+        raise ValueError('That is not a valid page cursor.')
+    return name, uid
 
     
 class QuiverArrow(StructuredRel):    
@@ -21,6 +63,9 @@ class QuiverArrow(StructuredRel):
     #monic = BooleanProperty(default=False)
     #inclusion = BooleanProperty(default=False)
     diagram_index = IntegerProperty(required=True)
+    name = StringProperty(max_length=MAX_ATOMIC_LATEX_LENGTH, default='')
+    # Shape signature of name, see dope.label_templates.label_shape:
+    shape = StringProperty(index=True)
     
     # Strictly style below this line:   
     NUM_LINES = { 1: 'one', 2: 'two', 3: 'three' }
@@ -78,46 +123,58 @@ class QuiverArrow(StructuredRel):
         self.save()
         
     def load_from_editor(self, format):
+        for key, value in QuiverArrow.properties_from_editor(format).items():
+            setattr(self, key, value)
+        self.save()
+        
+    @staticmethod
+    def properties_from_editor(format) -> dict:
+        """
+        Returns the arrow properties encoded in a Quiver edge as a dict (endpoints excluded).
+        Properties not present in the edge are left out, so that they keep their defaults.
+        """
+        props = {}
+        
         if len(format) > 2:
-            self.name = format[2]
+            props['name'] = format[2]
         else:
-            self.name = ''   # BUGFIX: need this
+            props['name'] = ''   # BUGFIX: need this
         
         if len(format) > 3:
-            self.alignment = format[3]
+            props['alignment'] = format[3]
         
         if len(format) > 4:                
             options = format[4]            
-            self.label_position = options.get('label_position', 50)
-            self.offset = options.get('offset', 0)
-            self.curve = options.get('curve', 0)
+            props['label_position'] = options.get('label_position', 50)
+            props['offset'] = options.get('offset', 0)
+            props['curve'] = options.get('curve', 0)
             shorten = options.get('shorten', {'source': 0, 'target': 0})
-            self.tail_shorten = shorten.get('source', 0)
-            self.head_shorten = shorten.get('target', 0)
-            self.num_lines = options.get('level', 1)
+            props['tail_shorten'] = shorten.get('source', 0)
+            props['head_shorten'] = shorten.get('target', 0)
+            props['num_lines'] = options.get('level', 1)
             
-            self.body_style = next(x for x,y in self.BODY_STYLE.items() \
-                                   if y == deep_get(options, ('style', 'body', 'name'), 'solid'))
+            props['body_style'] = next(x for x,y in QuiverArrow.BODY_STYLE.items() \
+                                       if y == deep_get(options, ('style', 'body', 'name'), 'solid'))
             
-            self.tail_style = next(x for x,y in self.TAIL_STYLE.items() \
-                                   if y == deep_get(options, ('style', 'tail', 'name'), 'none' ))
+            props['tail_style'] = next(x for x,y in QuiverArrow.TAIL_STYLE.items() \
+                                       if y == deep_get(options, ('style', 'tail', 'name'), 'none' ))
             
             side = deep_get(options, ('style', 'tail', 'side'), 'none')
             
             if isinstance(side, int):
-                self.hook_tail_side = side
+                props['hook_tail_side'] = side
             else:
-                self.hook_tail_side = next(x for x,y in self.SIDE.items() if y == side)
+                props['hook_tail_side'] = next(x for x,y in QuiverArrow.SIDE.items() if y == side)
             
-            self.head_style = next(x for x,y in self.HEAD_STYLE.items() \
-                                   if y == deep_get(options, ('style', 'head', 'name'), 'arrowhead'))
+            props['head_style'] = next(x for x,y in QuiverArrow.HEAD_STYLE.items() \
+                                       if y == deep_get(options, ('style', 'head', 'name'), 'arrowhead'))
             
             side = deep_get(options, ('style', 'head', 'side'), 'none')
             
             if isinstance(side, int):
-                self.harpoon_head_side = side
+                props['harpoon_head_side'] = side
             else:
-                self.harpoon_head_side = next(x for x,y in self.SIDE.items() if y == side)
+                props['harpoon_head_side'] = next(x for x,y in QuiverArrow.SIDE.items() if y == side)
                 
             if len(format) > 5:
                 color = format[5]
@@ -126,17 +183,28 @@ class QuiverArrow(StructuredRel):
             else:
                 color = [0, 0, 0, 1.0]  # BUGFIX: black is hsl:  0,0,0 not 0,100,0
                 
-            self.color_hue = color[0]
-            self.color_sat = color[1]
-            self.color_lum = color[2]
+            props['color_hue'] = color[0]
+            props['color_sat'] = color[1]
+            props['color_lum'] = color[2]
             
             if len(color) > 3:
-                self.color_alph = color[3]            
+                props['color_alph'] = color[3]            
         
-        self.save()
+        props['shape'] = compile_label(props['name']).shape
+        return props
+    
+    def pre_save(self):
+        self.shape = compile_label(self.name or '').shape
         
-    def quiver_format(self):
-        format = [self.source.diagram_index, self.target.diagram_index]
+    def quiver_format(self, source_index=None, target_index=None):
+        # Pass in the endpoints' diagram indices when they're already known, so as to
+        # avoid the two extra lookups of self.source and self.target.
+        if source_index is None:
+            source_index = self.source.diagram_index
+        if target_index is None:
+            target_index = self.target.diagram_index
+            
+        format = [source_index, target_index]
         format.append(self.name if self.name is not None else '')
         format.append(self.alignment)
         options = {
@@ -183,6 +251,8 @@ class QuiverNode(StructuredNode):
     category = RelationshipTo('Category', 'LIVES_IN', cardinality=One)
     maps_to = RelationshipTo('QuiverNode', 'MAPS_TO', model=QuiverArrow, cardinality=ZeroOrMore)    
     diagram_index = IntegerProperty(required=True)
+    # Shape signature of name, see dope.label_templates.label_shape:
+    shape = StringProperty(index=True)
 
     # Position & Color:
     x = IntegerProperty(default=0)
@@ -229,19 +299,12 @@ class QuiverNode(StructuredNode):
         return f'QuiverNode("{self.name}")'
     
     def all_outgoing_arrows(self):
-        results, meta = db.cypher_query(
-            f"MATCH (X:QuiverNode)-[r:MAPS_TO]->(:QuiverNode)"
-            f"MATCH (f:QuiverArrow) "
-            f"WHERE X.uid='{self.uid}' AND f.uid=r.uid "
-            f"RETURN f")
+        results, meta = cypher.run('outgoing_arrows', {'uid': self.uid})
         return [QuiverArrow.inflate(row[0]) for row in results]
                     
     def delete(self):
         # Delete all the outgoing morphisms first:
-        db.cypher_query(f"MATCH (X:QuiverNode)-[r:MAPS_TO]->(:QuiverNode)"
-                        f"MATCH (f:QuiverArrow) "
-                        f"WHERE X.uid='{self.uid}' AND f.uid=r.uid DETACH DELETE f, r")  
-        # TODO: see if we need to also delete r here ("DELETE r,f"), or whether the following automatically deletes it:
+        cypher.run('delete_outgoing_arrows', {'uid': self.uid})
         super().delete()
            
     @staticmethod
@@ -252,21 +315,38 @@ class QuiverNode(StructuredNode):
         
     def init_from_editor(self, format, index):
         o = self
-        o.x = format[0]
-        o.y = format[1]
+        for key, value in QuiverNode.properties_from_editor(format).items():
+            setattr(o, key, value)
+        o.save()   
+        return o
+    
+    @staticmethod
+    def properties_from_editor(format) -> dict:
+        """
+        Returns the node properties encoded in a Quiver vertex as a dict.
+        """
+        props = {
+            'x' : format[0],
+            'y' : format[1],
+        }
         
         if len(format) > 2:
-            o.name = format[2]
+            props['name'] = format[2]
             
         if len(format) > 3:
             color = format[3]
-            o.color_hue = color[0]
-            o.color_sat = color[1]
-            o.color_lum = color[2]
-            o.color_alph = color[3]
-        
-        o.save()   
-        return o
+            props['color_hue'] = color[0]
+            props['color_sat'] = color[1]
+            props['color_lum'] = color[2]
+            props['color_alph'] = color[3]
+            
+        if 'name' in props:
+            props['shape'] = compile_label(props['name']).shape
+            
+        return props
+    
+    def pre_save(self):
+        self.shape = compile_label(self.name or '').shape
     
     def quiver_format(self):
         return [self.x, self.y, self.name, 
@@ -284,10 +364,17 @@ class QuiverDiagram(StructuredNode):
     uid = UniqueIdProperty()
     name = StringProperty(required=True)
     checked_out_by = StringProperty(max_length=MAX_ATOMIC_LATEX_LENGTH)
+    # When checked_out_by's lease runs out (ms since the epoch), see checkout():
+    checkout_expires = IntegerProperty()
     objects = RelationshipTo('QuiverNode', 'CONTAINS', cardinality=ZeroOrMore)   
     arrows = RelationshipTo('QuiverArrow', 'CONTAINS', cardinality=ZeroOrMore)
     category = RelationshipTo('Category', 'LIVES_IN', cardinality=One)
     commutes = StringProperty(choices=COMMUTES, default='C')
+    # Bumped on every write to the diagram, so that cached serializations can be validated:
+    revision = IntegerProperty(default=0)
+    # Kept up to date by the saves, for listing diagrams without looking inside them:
+    object_count = IntegerProperty(default=0)
+    arrow_count = IntegerProperty(default=0)
     
     def morphism_count(self):
         count = 0
@@ -329,64 +416,417 @@ class QuiverDiagram(StructuredNode):
     
     @staticmethod
     def our_create(**kwargs):
-        diagram = QuiverDiagram(**kwargs).save()
-        QuiverDiagram.init_diagram(diagram)
-        return diagram
+        return QuiverDiagram.upsert_by_name(**kwargs)
+    
+    @classmethod
+    def upsert_by_name(cls, name:str, category_name:str=DEFAULT_CATEGORY_NAME, **props):
+        """
+        Returns the diagram with the given name, or else creates it (with props) in the named
+        category, upserting that as well, all in one statement.
+        """
+        category = Category.deflate({'name': category_name})
+        results, meta = cypher.run('upsert_diagram', {
+                'props' : cls.deflate({'name': name, **props}),
+                'category_name' : category['name'],
+                'category_uid' : category['uid'],
+            }, labels=tuple(cls.inherited_labels()))
+        return cls.inflate(results[0][0])
+    
+    @classmethod
+    def create_params(cls, name:str, checked_out_by:str) -> dict:
+        # The parameters of the create_diagram statement, for a diagram checked out to its creator
+        cls.check_name(name)
+        category = Category.deflate({'name': DEFAULT_CATEGORY_NAME})
+        return {
+            'props' : cls.deflate({'name': name, 'checked_out_by': checked_out_by,
+                                   'checkout_expires': lease_expiry()}),
+            'category_name' : category['name'],
+            'category_uid' : category['uid'],
+        }
+    
+    @classmethod
+    def create_by_name(cls, name:str, checked_out_by:str):
+        """
+        Creates a diagram in the default category with a single statement.  Returns its uid,
+        or None if a diagram by that name already exists.
+        """
+        results, meta = cypher.run('create_diagram', cls.create_params(name, checked_out_by),
+                                   labels=tuple(cls.inherited_labels()))
+        return results[0][0] if results else None
         
     @staticmethod
     def init_diagram(diagram):
-        category = get_unique(Category, name=DEFAULT_CATEGORY_NAME)
-        diagram.category.connect(category)
-        diagram.save()  
-        
-    def quiver_format(self):
-        edges = []
-        vertices = []
+        QuiverDiagram.move_to_category(diagram.uid, DEFAULT_CATEGORY_NAME)
         
-        objects = list(self.all_objects())
-        objects.sort(key=lambda x: x.diagram_index)        
+    @staticmethod
+    def move_to_category(diagram_uid:str, category_name:str) -> int:
+        """
+        Puts the diagram in the named category (upserted), in one statement.  Returns the 
+        diagram's revision, which is bumped if it moved from another category.
+        """
+        category = Category.deflate({'name': category_name})
+        results, meta = cypher.run('set_category', {
+            'diagram_uid' : diagram_uid,
+            'category_name' : category['name'],
+            'category_uid' : category['uid'],
+        })
+        return results[0][0]
         
-        for o in objects:
-            vertices.append(o.quiver_format())
-            for f in o.all_outgoing_arrows():
-                edges.append(f.quiver_format())
-                    
+    def quiver_format(self):
+        return QuiverDiagram.quiver_format_by_uid(self.uid)
+    
+    @staticmethod
+    def quiver_format_by_uid(diagram_uid:str):
+        vertices, edges = QuiverDiagram.editor_rows_by_uid(diagram_uid)
+        return QuiverDiagram.quiver_format_from_rows(vertices, edges)
+    
+    @staticmethod
+    def quiver_format_from_rows(vertices:dict, edges:dict):
+        """
+        Builds the Quiver array in memory from the rows returned by stored_editor_rows().
+        """
         format = [0, len(vertices)]
-        format += vertices
-        format += edges
+        
+        for index in sorted(vertices):
+            format.append(QuiverNode(**vertices[index]).quiver_format())
+            
+        for index in sorted(edges):
+            e = edges[index]
+            f = QuiverArrow(**e['properties'])
+            format.append(f.quiver_format(e['source_index'], e['target_index']))
         
         return format
     
     def load_from_editor(self, format):
-        obs = []
-        vertices = format[2:2 + format[1]]
+        """
+        Writes the Quiver array `format` into this diagram, which is assumed to be empty.
+        The whole payload (vertices, MAPS_TO arrows, CONTAINS and LIVES_IN links) is written 
+        in one transaction using a fixed number of batched statements, so the number of
+        round trips doesn't grow with the size of the diagram.
+        """
+        vertices, edges = QuiverDiagram.editor_rows_from_format(format)
+        
+        with graph_backend().transaction():
+            self._create_vertices(vertices)
+            self._create_edges(edges)
+            self._bump_revision(QuiverDiagram.format_counts(format))
+            
+    def update_from_editor(self, format, base_revision:int=None):
+        """
+        Incrementally saves the Quiver array `format` over what's stored for this diagram.
+        Vertices and arrows are matched up by diagram_index, and only the ones that were 
+        inserted, updated, or deleted get written (all in one transaction).  So the amount 
+        written scales with the size of the edit, and unchanged nodes keep their uids.
+        If base_revision is given, the save is only made if the diagram is still at that 
+        revision, otherwise RevisionConflict is raised and nothing is written.
+        """
+        with graph_backend().transaction():
+            # BUGFIX: the stored rows were read before the transaction, so a write landing
+            # in between had the diff run against stale rows.  Now they're read under the lock.
+            self._lock_revision(base_revision)
+            statements = QuiverDiagram.update_statements(
+                self.uid, format, *self.stored_editor_rows())
+            
+            for name, params in statements:
+                cypher.run(name, params)
+            self._bump_revision(QuiverDiagram.format_counts(format))
+            
+    def patch_from_editor(self, base_revision:int, ops:list):
+        """
+        Applies the editor's edit ops (see database.diagram_edits) to this diagram, which
+        they were made against at base_revision.  The ops are applied to the stored Quiver
+        array and the result is saved incrementally, all atomically: if the diagram has 
+        moved on from base_revision, RevisionConflict is raised and nothing is written.
+        """
+        with graph_backend().transaction():
+            self._lock_revision(base_revision)
+            stored_vertices, stored_edges = self.stored_editor_rows()
+            format = QuiverDiagram.patched_format(stored_vertices, stored_edges, ops)
+            statements = QuiverDiagram.update_statements(
+                self.uid, format, stored_vertices, stored_edges)
+            
+            for name, params in statements:
+                cypher.run(name, params)
+            self._bump_revision(QuiverDiagram.format_counts(format))
+            
+    @staticmethod
+    def patched_format(stored_vertices:dict, stored_edges:dict, ops:list) -> list:
+        # BUGFIX: ops were only checked for their shape, so e.g. a non-string label or a 
+        # non-list colour got as far as the writes and came out as a TypeError (a 500).
+        format = apply_edit_ops(QuiverDiagram.quiver_format_from_rows(stored_vertices, stored_edges), ops)
+        QuiverDiagram.check_format(format)
+        return format
+    
+    def _lock_revision(self, base_revision:int=None):
+        # Takes the diagram's write lock, and checks its revision if base_revision is given
+        results, meta = cypher.run('lock_revision', {'diagram_uid': self.uid})
+        
+        if base_revision is not None:
+            QuiverDiagram.check_revision(results, base_revision)
+            
+    @staticmethod
+    def check_revision(results, base_revision:int):
+        revision = results[0][0] if results else 0
+        
+        if revision != base_revision:
+            raise RevisionConflict(revision)
+        
+    @staticmethod
+    def update_statements(diagram_uid:str, format, stored_vertices:dict, stored_edges:dict):
+        """
+        Diffs the Quiver array `format` against a diagram's stored rows (as returned by
+        editor_rows_by_uid) and returns the (statement name, params) list that writes the 
+        difference, for update_from_editor and its async counterpart to run in a transaction.
+        """
+        vertices, edges = QuiverDiagram.editor_rows_from_format(format)
+        
+        insert_vertices = []
+        update_vertices = []
+        
+        for v in vertices:
+            old = stored_vertices.pop(v['diagram_index'], None)
+            
+            if old is None:
+                insert_vertices.append(v)
+            else:
+                v['uid'] = old['uid']
+                if any(old.get(key) != value for key, value in v.items()):
+                    update_vertices.append(v)
+                    
+        # Whatever's left over in stored_vertices was deleted in the editor:
+        delete_vertices = [old['uid'] for old in stored_vertices.values()]
+        
+        insert_edges = []
+        update_edges = []
+        delete_edges = []
+                
+        for e in edges:
+            # Point the edge at the (possibly pre-existing) uids of its endpoints:
+            e['source'] = vertices[e['source_index']]['uid']
+            e['target'] = vertices[e['target_index']]['uid']
+            props = e['properties']            
+            old = stored_edges.pop(props['diagram_index'], None)
+            
+            if old is None:
+                insert_edges.append(e)
+            elif (old['source_index'], old['target_index']) != (e['source_index'], e['target_index']):
+                # A relationship can't be re-pointed, so it's replaced:
+                delete_edges.append(props['diagram_index'])
+                insert_edges.append(e)
+            elif any(old['properties'].get(key) != value for key, value in props.items()):
+                update_edges.append(e)
+                
+        delete_edges += list(stored_edges.keys())
+        statements = []
+        
+        if delete_edges:
+            statements.append(('delete_edges', {'diagram_uid': diagram_uid, 'indices': delete_edges}))
+        if delete_vertices:
+            statements.append(('delete_vertices', {'uids': delete_vertices}))
+        if update_vertices:
+            statements.append(('update_vertices', {'vertices': update_vertices}))
+        if insert_vertices:
+            statements.append(('create_vertices', {'diagram_uid': diagram_uid, 'vertices': insert_vertices}))
+        if update_edges:
+            statements.append(('update_edges', {'edges': update_edges}))
+        if insert_edges:
+            statements.append(('create_edges', {'edges': insert_edges}))
+            
+        return statements
+            
+    @classmethod
+    def revision_by_name(cls, name:str):
+        """
+        Cheaply looks up (uid, revision, checked_out_by) of the diagram with the given name,
+        without inflating the diagram or touching its contents.
+        """
+        cls.check_name(name)
+        results, meta = cypher.run('revision_by_name', {'name': name}, label=cls.__label__)
+        return cls.revision_from_results(name, results)
+    
+    @classmethod
+    def checkout(cls, name:str, username:str):
+        """
+        Takes or renews username's checkout lease on the diagram with the given name, unless
+        someone else holds an unexpired one, in a single compare-and-set statement.
+        Returns (uid, revision, checked_out_by): username holds the lease iff it's the holder.
+        """
+        cls.check_name(name)
+        results, meta = cypher.run('checkout_diagram', lease_params(name=name, username=username),
+                                   label=cls.__label__)
+        return cls.revision_from_results(name, results)
+    
+    @classmethod
+    def release(cls, name:str, username:str) -> bool:
+        """
+        Gives up username's checkout lease on the named diagram.  Returns whether they held it.
+        """
+        cls.check_name(name)
+        results, meta = cypher.run('release_diagram', {'name': name, 'username': username},
+                                   label=cls.__label__)
+        return bool(results)
+    
+    @classmethod
+    def list_page(cls, cursor:str=None, limit:int=DIAGRAM_PAGE_SIZE):
+        """
+        Returns a page of (DiagramListing's, next page's cursor or None), ordered by name
+        then uid.  The page is found by seeking past the cursor's (name, uid) on the name 
+        index and only the listed fields are projected, so it costs O(limit) however many 
+        diagrams there are.
+        """
+        params = {'limit': limit + 1}   # One extra to tell whether there's a next page
+        
+        if cursor:
+            params['after_name'], params['after_uid'] = decode_cursor(cursor)
+            
+        results, meta = cypher.run('diagram_page', params, label=cls.__label__, after=bool(cursor))
+        listings = [DiagramListing(*row) for row in results[:limit]]
+        
+        if len(results) > limit:
+            next_cursor = encode_cursor(listings[-1].name, listings[-1].uid)
+        else:
+            next_cursor = None
+            
+        return listings, next_cursor
+    
+    @classmethod
+    def check_name(cls, name:str):
+        if len(name) > MAX_ATOMIC_LATEX_LENGTH:
+            raise ValueError(f'That {cls.__name__} name is longer than {MAX_ATOMIC_LATEX_LENGTH} characters.')
+        
+    @classmethod
+    def revision_from_results(cls, name:str, results):
+        if not results:
+            raise ObjectDoesNotExist(f'An instance of the {cls} with name "{name}" does not exist.')
+        
+        return tuple(results[0])
+            
+    def _bump_revision(self, counts:dict=None):
+        results, meta = cypher.run('bump_revision', QuiverDiagram.bump_params(self.uid, counts))
+        self.revision = results[0][0]
+        
+    @staticmethod
+    def bump_params(diagram_uid:str, counts:dict=None) -> dict:
+        params = {'diagram_uid': diagram_uid, 'object_count': None, 'arrow_count': None}
+        params.update(counts or {})
+        return params
+    
+    @staticmethod
+    def format_counts(format) -> dict:
+        return {'object_count': format[1], 'arrow_count': len(format) - 2 - format[1]}
+            
+    def _create_vertices(self, vertices):
+        if vertices:
+            cypher.run('create_vertices', {'diagram_uid': self.uid, 'vertices': vertices})
+            
+    def _create_edges(self, edges):
+        if edges:
+            cypher.run('create_edges', {'edges': edges})
+            
+    def stored_editor_rows(self):
+        return QuiverDiagram.editor_rows_by_uid(self.uid)
+    
+    @staticmethod
+    def editor_rows_by_uid(diagram_uid:str):
+        """
+        Returns the stored state of a diagram as (vertices, edges), two dicts keyed by 
+        diagram_index.  Vertex values are the node's property dicts, edge values are dicts 
+        with the endpoints' diagram indices and the arrow's property dict.
+        Everything is fetched by a single projected query.
+        """
+        results, meta = cypher.run('editor_rows', {'diagram_uid': diagram_uid})
+        return QuiverDiagram.editor_rows_from_results(results)
+    
+    @staticmethod
+    def editor_rows_from_results(results):
+        if not results:
+            return {}, {}
         
-        for k,v in enumerate(vertices):
-            o = Object.create_from_editor(v, k)
-            obs.append(o)
+        vertices, edges = results[0]
+        vertices = {v['diagram_index'] : v for v in vertices}
+        edges = {e['properties']['diagram_index'] : e for e in edges}
+        return vertices, edges
+            
+    @staticmethod
+    def editor_rows_from_format(format):
+        """
+        Converts a Quiver array into the parameter rows used by the batched write statements.
+        Returns (vertices, edges) where each vertex is a dict of deflated QuiverNode properties
+        (with a freshly generated uid) and each edge is a dict with the source and target uids
+        and indices, and the deflated QuiverArrow properties.
+        """
+        vertices = []
         
-        edges = format[2 + format[1]:]
+        for k,v in enumerate(format[2:2 + format[1]]):
+            props = QuiverNode.properties_from_editor(v)
+            props['diagram_index'] = k
+            vertices.append(QuiverNode.deflate(props))
             
-        for k,e in enumerate(edges):
-            A = obs[e[0]]
-            B = obs[e[1]]
-            f = A.maps_to.connect(B, {'diagram_index': k})
-            f.save()
-            f.load_from_editor(e)
-            A.save()
-            f.save()
+        edges = []
+        
+        for k,e in enumerate(format[2 + format[1]:]):
+            props = QuiverArrow.properties_from_editor(e)
+            props['diagram_index'] = k
+            edges.append({
+                'source' : vertices[e[0]]['uid'],
+                'target' : vertices[e[1]]['uid'],
+                'source_index' : e[0],
+                'target_index' : e[1],
+                'properties' : QuiverArrow.deflate(props),
+            })
             
-        self.add_objects(obs)               
+        return vertices, edges
+    
+    @staticmethod
+    def check_format(format):
+        """
+        Raises ValueError unless the Quiver array `format` can be saved, e.g. before it's 
+        journaled to be written later (see database.write_behind).
+        """
+        try:
+            vertices, edges = QuiverDiagram.editor_rows_from_format(format)
+        except ValueError:
+            raise
+        except (LookupError, TypeError, AttributeError, StopIteration) as e:
+            raise ValueError(f'That is not a valid Quiver diagram ({type(e).__name__}: {e}).')
+        
+        if len(vertices) != format[1]:
+            raise ValueError(f'The diagram should have {format[1]} objects but has {len(vertices)}.')
+        
+        for e in edges:
+            if not all(isinstance(k, int) and 0 <= k < len(vertices) 
+                       for k in (e['source_index'], e['target_index'])):
+                raise ValueError(f'An arrow has endpoints {e["source_index"]}, {e["target_index"]} '
+                                 f'but there are only {len(vertices)} objects.')
     
     def all_objects(self):
-        results, meta = db.cypher_query(
-            f'MATCH (D:QuiverDiagram)-[:CONTAINS]->(x:QuiverNode) WHERE D.uid="{self.uid}" RETURN x')
+        results, meta = cypher.run('diagram_objects', {'diagram_uid': self.uid})
         return [Object.inflate(row[0]) for row in results]
         
-    def delete_objects(self):
-        for o in self.all_objects():
-            o.delete()
-        self.save()
+    def delete_objects(self, batch_size=DIAGRAM_DELETE_BATCH_SIZE):
+        """
+        Deletes all of this diagram's nodes together with their MAPS_TO arrows, batch_size 
+        nodes per statement.  The same bounded statement is repeated until a batch comes up 
+        short, so a small diagram takes a single round trip and a very large one is deleted 
+        in chunks rather than in one heap-hungry transaction on the graph server.
+        """
+        while True:
+            results, meta = cypher.run(
+                'delete_objects_batch', {'diagram_uid': self.uid, 'batch_size': batch_size})
+            
+            if results[0][0] < batch_size:
+                break
+            
+        # BUGFIX: the diagram changed but kept its revision, so its ETag stayed valid
+        self._bump_revision()
+        
+    def delete_diagram(self):
+        """
+        Deletes this diagram altogether: its objects in batches (see delete_objects), then
+        the diagram node itself.
+        """
+        self.delete_objects()
+        cypher.run('delete_diagram', {'diagram_uid': self.uid})
         
     def add_objects(self, obs):
         for o in obs:
@@ -394,126 +834,145 @@ class QuiverDiagram(StructuredNode):
         self.save()
         
     @staticmethod
-    def get_paths_by_length(diagram_uid):
-        paths_by_length = \
-            f"MATCH (D:Diagram)-[:CONTAINS]->(X:Node), " + \
-            f"p=(X)-[:MAPS_TO*]->(:Node) " + \
-            f"WHERE D.uid = '{diagram_uid}' " + \
-            f"RETURN p " + \
-            f"ORDER BY length(p) DESC" 
+    def get_paths_by_length(diagram_uid, max_length=MAX_SEARCH_PATH_LENGTH):
+        return list(QuiverDiagram.iter_paths(diagram_uid, max_length))
+    
+    @staticmethod
+    def iter_paths(diagram_uid, max_length=MAX_SEARCH_PATH_LENGTH, mode='trail', limit=None):
+        """
+        Lazily yields the MAPS_TO paths of a diagram as PathRecord's, longest first.
         
-        paths_by_length, meta = db.cypher_query(paths_by_length)
+        Paths have at most max_length arrows.  In 'trail' mode no arrow repeats within a 
+        path (Cypher's default), in 'simple' mode no node repeats either.  Paths are 
+        fetched one length at a time, so the consumer can start on the longest paths 
+        (and stop early, or after limit paths) before the shorter ones are enumerated.
+        """
+        if mode not in ('trail', 'simple'):
+            raise ValueError(f'Unknown path enumeration mode "{mode}".')
         
-        return paths_by_length
-                          
-        ## TODO: test code with doublequote in template_regex ^^^        
+        count = 0
+            
+        for length in range(max_length, 0, -1):
+            params = {'diagram_uid': diagram_uid}
+            
+            if limit is not None:
+                params['limit'] = limit - count
+                
+            results, meta = cypher.run('diagram_paths', params, length=length, 
+                                       simple=(mode == 'simple'), limited=(limit is not None))
+            
+            for nodes, rels in results:
+                yield PathRecord(nodes, rels)
+                count += 1
+                
+            if limit is not None and count >= limit:
+                return
         
     @staticmethod
     def build_query_from_paths(paths):
+        """
+        Builds a MATCH pattern out of PathRecord's (e.g. from iter_paths) that covers each 
+        of their arrows exactly once.  Returns (nodes, rels, pattern) where nodes and rels 
+        map diagram indices to the path entries (dicts with diagram_index, name & shape).
+        """
         nodes = {
-            # Keyed by Object.diagram_index, value is Object
+            # Keyed by QuiverNode.diagram_index
         }
         rels = {
-            # Keyed by Morphism.diagram_index, value is Morphism
+            # Keyed by QuiverArrow.diagram_index
         }
-
-        search_query = ''
+        parts = []
                
         for path in paths:
-            path = path[0]   # [0] is definitely needed here
-            node = Object.inflate(path.start_node)
-            
-            search_query += f"(n{node.diagram_index}:Node)"
+            start = path.nodes[0]
+            nodes.setdefault(start['diagram_index'], start)
+            part = ''
             
-            if node.diagram_index not in nodes:
-                nodes[node.diagram_index] = node
-            
-            add_query = ''
-            
-            for rel in path.relationships:
-                rel = QuiverArrow.inflate(rel)
-                #rel = get_model_by_uid(QuiverArrow, uid=rel.uid)
+            for source, rel, target in zip(path.nodes, path.rels, path.nodes[1:]):
+                if rel['diagram_index'] in rels:
+                    # Already covered by an earlier path, so the chain is broken here:
+                    if part:
+                        parts.append(part)
+                        part = ''
+                    continue
                 
-                if rel.diagram_index not in rels:
-                    rels[rel.diagram_index] = rel
-                    
-                    add_query += f"-[r{rel.diagram_index}:MAPS_TO]->"
-                    next_node = rel.end_node()  # BUGFIX: no need to inflate here
-                    add_query += f"(n{next_node.diagram_index}:Node)"
+                rels[rel['diagram_index']] = rel
+                nodes.setdefault(target['diagram_index'], target)
+                
+                if not part:
+                    part = f"(n{source['diagram_index']}:QuiverNode)"
                     
-                    # BUGFIX: don't forget to add the next node into nodes:
-                    if next_node.diagram_index not in nodes:
-                        nodes[next_node.diagram_index] = next_node
-            
-            if add_query:      
-                search_query += add_query
+                part += f"-[r{rel['diagram_index']}:MAPS_TO]->(n{target['diagram_index']}:QuiverNode)"
                 
-            search_query += ', '
+            if part:
+                parts.append(part)
         
-        if search_query:
-            search_query = search_query[:-2]
-        return nodes, rels, search_query
+        return nodes, rels, ', '.join(parts)
     
     @staticmethod
     def build_match_query(query, nodes, rels):
+        """
+        Turns the MATCH pattern built by build_query_from_paths into a full query that 
+        looks up candidate nodes & arrows by indexed equality on their label's shape 
+        signature.  Returns (templates, query, params) where templates maps each label to
+        its compiled LabelTemplate, for the residual variable check (see match_bindings).
+        """
         query = "MATCH " + query            
         
-        template_regexes = {
-            # Keyed by node or relationship .name property, values are 
-            # (template, neo4j regex)
+        templates = {
+            # Keyed by node or relationship .name property, values are LabelTemplate's
         }
+        params = {}
         
-        #var_mapping = {
-            ## Keyed by variable object, value is list of tuples (node or rel, template_index)
-        #}
-        
-        def neo4j_regex_from_template(template):
-            regex = ""
-            for piece in template:
-                if isinstance(piece, Variable):
-                    regex += ".+"
-                elif isinstance(piece, Keyword):
-                    regex += neo4j_escape_regex_str(str(piece))
-                else:  # str
-                    regex += neo4j_escape_regex_str(piece)                
-            return regex   
-                    
-        for node in nodes.values():
-            name = node.name
-            
-            if name not in template_regexes:
-                template, vars = Variable.parse_into_template(name)
-                regex = neo4j_regex_from_template(template)
-                template_regexes[name] = (template, regex)
-                
-        for rel in rels.values():
-            name = rel.name
+        for item in list(nodes.values()) + list(rels.values()):
+            name = item['name']
             
-            if name not in template_regexes:
-                template, vars = Variable.parse_into_template(name)
-                regex = neo4j_regex_from_template(template)
-                template_regexes[name] = (template, regex)       
+            if name not in templates:
+                templates[name] = compile_label(name)
         
-        query += " WHERE "
+        conditions = []
         
         for index, node in nodes.items():
-            query += f"n{index}.uid =~ '{template_regexes[node.uid][1]}' AND "
+            conditions.append(f"n{index}.shape = $n{index}_shape")
+            params[f'n{index}_shape'] = templates[node['name']].shape
             
-        if rels:
-            for index, rel in rels.items():
-                query += f"r{index}.uid =~ '{template_regexes[rel.uid][1]}' AND "
+        for index, rel in rels.items():
+            conditions.append(f"r{index}.shape = $r{index}_shape")
+            params[f'r{index}_shape'] = templates[rel['name']].shape
             
-        query = query[:-5]   # Remove AND      
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+            
+        query += " RETURN " + ", ".join(
+            [f"n{index}.name" for index in nodes] + [f"r{index}.name" for index in rels])
         
-        return template_regexes, query   
+        return templates, query, params
+    
+    @staticmethod
+    def match_bindings(templates, nodes, rels, row):
+        """
+        The cheap residual check done on a row returned by build_match_query's query:
+        returns the variable bindings of the match, or None if the variables bind 
+        inconsistently across the labels (e.g. pattern A -> A against X -> Y).
+        """
+        bindings = {}
+        labels = [node['name'] for node in nodes.values()] + [rel['name'] for rel in rels.values()]
+        
+        for pattern_label, text in zip(labels, row):
+            new_bindings = bind_label(templates[pattern_label], text, bindings)
+            
+            if new_bindings is None:
+                return None
+            
+            bindings.update(new_bindings)
+            
+        return bindings
 
 
 class Diagram(QuiverDiagram):
     @staticmethod
     def our_create(**kwargs):
-        diagram = Diagram(**kwargs).save()
-        Diagram.init_diagram(diagram)
-        return diagram
+        return Diagram.upsert_by_name(**kwargs)
 
 class Object(QuiverNode):
     pass
@@ -524,7 +983,7 @@ class Category(StructuredNode):
 
     @staticmethod
     def our_create(**kwargs):
-        category = Category(**kwargs).save()
+        category = graph_backend().create(Category, **kwargs)
         return category
 
 class Arrow(QuiverArrow):
@@ -535,6 +994,8 @@ class DiagramSet(Object):
 
 class DiagramRule(Arrow):
     checked_out_by = StringProperty(max_length=MAX_ATOMIC_LATEX_LENGTH)
+    # When checked_out_by's lease runs out (ms since the epoch), see checkout():
+    checkout_expires = IntegerProperty()
     
     # Mathematics
     #functor_id = StringProperty()
@@ -542,47 +1003,67 @@ class DiagramRule(Arrow):
     # We will have to be careful when deleting a Functor.  We can only delete it
     # if there exist no rules referring to it through this property.
     
+    # A rule is a RULE relationship from its key diagram to its result diagram:
     @property
-    def checked_out_by(self):
-        return self.checkedOutBy
-    
-    @checked_out_by.setter
-    def checked_out_by(self, username):
-        if self.checked_out_by != username:
-            diagram = self.key_diagram.single()
-            diagram.checked_out_by = username
-            diagram.save()
-            diagram = self.result_diagram.single()
-            diagram.checked_out_by = username
-            diagram.save()
-            self.checkedOutBy = username
-            self.save()
-            
-    def can_be_checked_out(self):
-        return self.key_diagram.single().checked_out_by is None and \
-            self.result_diagram.single().checked_out_by is None and \
-            self.checked_out_by is None
+    def key_diagram(self):
+        return self.start_node()
+    
+    @property
+    def result_diagram(self):
+        return self.end_node()
+    
+    def checkout(self, username:str):
+        """
+        Takes or renews username's checkout lease on this rule together with its key and 
+        result diagrams, all in one statement: either all three are leased to username or,
+        if anyone else holds an unexpired lease on any of them, none are.  Returns 
+        (checked_out_by, key diagram revision, result diagram revision).
+        """
+        # BUGFIX: the key & result diagrams' uids each cost a round trip to look up
+        results, meta = cypher.run('checkout_rule', lease_params(rule_id=self.element_id_property,
+                                                                 username=username))
+        
+        if not results:
+            raise ObjectDoesNotExist('That rule no longer exists.')
+        
+        return tuple(results[0])
+    
+    def release(self, username:str):
+        cypher.run('release_rule', {'rule_id': self.element_id_property, 'username': username})
+        
+    def can_be_checked_out(self, username:str=None):
+        now = int(time.time() * 1000)
+        return all(x.checked_out_by in (None, username) or (x.checkout_expires or 0) < now
+                   for x in (self.key_diagram, self.result_diagram, self))
     
     @staticmethod
     def our_create(key=None, res=None, **kwargs):
+        # Diagram names are unique, so the default ones are suffixed with part of a fresh uuid
+        suffix = uuid4().hex[:12]
         if key is None:
-            key = 'Key'
+            key = f'Key {suffix}'
         if res is None:
-            res = 'Result'
-            
-        cat = get_unique(Category, name='Any')    
-        source = Diagram(name=key).save()
-        source.category.connect(cat)
-        source.save()
-        target = Diagram(name=res).save()
-        target.category.connect(cat)
-        target.save()
-        rule = DiagramRule(**kwargs)
-        rule.save()
-        rule.key_diagram.connect(source)
-        rule.result_diagram.connect(target)
-        rule.save()
-        return rule
+            res = f'Result {suffix}'
+            
+        if key == res:
+            raise ValueError('A rule\'s key and result diagrams need different names.')
+            
+        # BUGFIX: this connected the rule to its diagrams as though it were a node.  Now the
+        # rule, its two diagrams & their category are all written by one statement.
+        category = Category.deflate({'name': 'Any'})
+        results, meta = cypher.run('create_rule', {
+                'category_name' : category['name'],
+                'category_uid' : category['uid'],
+                'key_props' : Diagram.deflate({'name': key}),
+                'result_props' : Diagram.deflate({'name': res}),
+                # BUGFIX: diagram_index is required but a rule is its diagrams' only arrow
+                'props' : DiagramRule.deflate({'diagram_index': 0, **kwargs}),
+            }, labels=tuple(Diagram.inherited_labels()))
+        
+        if not results:
+            raise ValueError(f'A diagram named "{key}" or "{res}" already exists.')
+        
+        return DiagramRule.inflate(results[0][0])
         
     #@staticmethod
     #def get_variable_mapping(source:Diagram, target:Diagram) -> dict:
@@ -622,7 +1103,7 @@ def get_model_by_name(Model, name:str):
     if isinstance(Model, str):
         Model = get_model_class(Model)
         
-    model = Model.nodes.get_or_none(name=name)
+    model = graph_backend().get_or_none(Model, name=name)
     
     if model is None:
         raise ObjectDoesNotExist(f'An instance of the {Model} with name "{name}" does not exist.')
@@ -637,19 +1118,140 @@ def get_model_by_uid(Model, uid:str):
     if isinstance(Model, str):
         Model = get_model_class(Model)
         
-    model = Model.nodes.get_or_none(uid=uid)    
+    model = graph_backend().get_or_none(Model, uid=uid)    
     
     if model is None:
         raise ObjectDoesNotExist(f'An instance of the {Model} with uid "{uid}" does not exist.')
     
     return model
+
+
+def get_models_by_uids(Model, uids:list):
+    """
+    Fetches the instances of Model with the given uids in a single query.  Returns 
+    (models, missing) where models are in the order of uids and missing lists the uids
+    that matched nothing.
+    """
+    if any(len(uid) > 36 for uid in uids):
+        raise ValueError('An id is longer than a UUID4 is supposed to be.')
+    
+    if isinstance(Model, str):
+        Model = get_model_class(Model)
+        
+    results, meta = cypher.run('nodes_by_uids', {'uids': list(uids)}, label=Model.__label__)
+    by_uid = {}
+    
+    for row in results:
+        model = Model.inflate(row[0])
+        by_uid[model.uid] = model
+        
+    models = [by_uid[uid] for uid in uids if uid in by_uid]
+    missing = [uid for uid in uids if uid not in by_uid]
+    return models, missing
                     
                     
-def get_unique(Model, **kwargs):
-    model = Model.nodes.get_or_none(**kwargs)
+def backfill_label_shapes(batch_size=DIAGRAM_DELETE_BATCH_SIZE):
+    """
+    Computes the shape signature of every QuiverNode and MAPS_TO arrow that doesn't have
+    one yet (i.e. those stored before shapes were introduced), batch_size at a time.
+    Returns the number of nodes and arrows updated.
+    """
+    count = 0
     
-    if model is None:
-        model = Model.our_create(**kwargs)
-        model.save()
+    for kind in cypher.SHAPED_ITEM_MATCHES:
+        while True:
+            results, meta = cypher.run('shapeless_items', {'batch_size': batch_size}, kind=kind)
+            
+            if not results:
+                break
+            
+            rows = [{'id': id, 'shape': compile_label(name).shape} for id, name in results]
+            cypher.run('set_shapes', {'rows': rows}, kind=kind)
+            count += len(rows)
+            
+    return count
+
+
+def backfill_diagram_counts(batch_size=DIAGRAM_DELETE_BATCH_SIZE):
+    """
+    Counts the objects & arrows of every diagram saved before the counts were kept, 
+    batch_size diagrams at a time.  Returns the number of diagrams updated.
+    """
+    count = 0
+    
+    while True:
+        results, meta = cypher.run('count_diagrams_batch', {'batch_size': batch_size})
+        count += results[0][0]
+        
+        if results[0][0] < batch_size:
+            return count
+                    
+                    
+def lease_expiry() -> int:
+    # For a newly created diagram's checkout lease, see QuiverDiagram.checkout()
+    return int(time.time() * 1000) + CHECKOUT_LEASE_TTL * 1000
+
+
+def lease_params(**params) -> dict:
+    params['ttl'] = CHECKOUT_LEASE_TTL * 1000
+    return params
+    
+
+def upsert(Model, keys:dict, **props):
+    """
+    Returns the Model instance with the natural key `keys` (e.g. {'name': ...}), creating it
+    with props too if there's none, in a single MERGE.  That's atomic given a uniqueness 
+    constraint on the key (see the graph_schema command), so concurrent callers can't 
+    create duplicates.
+    """
+    results, meta = cypher.run('upsert_node', {
+            'keys' : keys,
+            'props' : Model.deflate({**keys, **props}),
+        }, labels=tuple(Model.inherited_labels()), key_names=tuple(sorted(keys)))
+    return Model.inflate(results[0][0])
+    
+                    
+def set_property(model, field:str, value):
+    """
+    Sets the one property of the model (on the graph too) in a single statement.  A diagram's
+    revision is bumped along with it.  Raises ValueError if that would give a diagram or a 
+    category the name of another.
+    """
+    Model = type(model)
+    prop = Model.defined_properties(aliases=False, rels=False).get(field)
+    
+    if prop is None:
+        raise ValueError(f'A {Model.__name__} has no property "{field}".')
+    
+    # Those with a uniqueness constraint (see the graph_schema command):
+    unique = field == 'name' and isinstance(model, (Diagram, Category))
+    
+    with graph_backend().transaction():
+        results, meta = cypher.run('set_property', {'uid': model.uid, 'value': prop.deflate(value)},
+                                   label=Model.__label__, prop=field, unique=unique)
+        
+        if unique and not results:
+            raise ValueError(f'A {Model.__name__} named "{value}" already exists.')
         
-    return model
\ No newline at end of file
+        setattr(model, field, value)
+        
+        if isinstance(model, QuiverDiagram):
+            model._bump_revision()
+    
+                    
+def get_unique(Model, **kwargs):
+    # BUGFIX: a get_or_none() then create raced, e.g. into duplicate default Categories.
+    return upsert(Model, kwargs)
+
+class PendingDiagramSave(orm.Model):
+    """
+    The write-behind journal (see database.write_behind): a diagram's latest acknowledged 
+    save that hasn't been flushed to the graph yet.  It lives in the Django database so 
+    that it survives a worker crash.
+    """
+    diagram_uid = orm.CharField(max_length=36, primary_key=True)
+    username = orm.CharField(max_length=MAX_USERNAME_LENGTH)
+    payload = orm.TextField()        # The Quiver array, as JSON
+    first_queued_at = orm.DateTimeField()
+    queued_at = orm.DateTimeField()
+    flushing_until = orm.DateTimeField(null=True)   # A flusher's claim on it, see flush()
@@ -1,11 +1,9 @@
+import re
+
+
 def escape_regex_str(string):
-    string = string.replace('\\', r'\\')  # BUGFIX: double escape is usually needed in Neo4j regex
-    #string = string.replace("'", r"\'")
-    string = string.replace('{', r'\{')
-    string = string.replace('}', r'\}')
-    string = string.replace('(', r'\(')
-    string = string.replace(')', r'\)')
-    return string
+    # Escape every regex metacharacter, LaTeX is full of them (^, ., |, [, ...)
+    return re.escape(string)
 
 
 def neo4j_escape_regex_str(string):
@@ -8,7 +8,8 @@ import neomodel
 import uuid
 from .namespace import Namespace
 import re
-from .neo4j_tools import neo4j_escape_regex_str
+from .neo4j_tools import neo4j_escape_regex_str, escape_regex_str
+from . import cypher
 
 python_identifier_regex = re.compile(r'([_A-Za-z][0-9_A-Za-z]*)')
 
@@ -20,10 +21,8 @@ class Code(Object):
     
     @staticmethod
     def create_code(subclass, code:str, **kwargs):
-        var_query = subclass.var_subst_query(code, **kwargs)
-        var_query += '\n'
-        var_query += 'ORDER BY size(p.code)'
-        existing_codes, meta = neomodel.db.cypher_query(var_query)
+        existing_codes, meta = cypher.run(
+            'python_code_by_pattern', subclass.var_subst_params(code, **kwargs))
         
         for python in existing_codes:
             code = str(python.code)
@@ -35,7 +34,7 @@ class Code(Object):
         return code     
     
     @staticmethod
-    def var_subst_query(*args, **kwargs):
+    def var_subst_params(*args, **kwargs):
         raise NotImplementedError
         
     
@@ -63,15 +62,17 @@ class Python(Code):
         return Code.create_code(Python, code, globals_dict=globals_dict)
         
     @staticmethod 
-    def var_subst_query(code:str, globals_dict:str) -> str:        
-        code = neo4j_escape_regex_str(code)
-        code = python_identifier_regex.sub(code, python_identifier_regex.pattern)
+    def var_subst_params(code:str, globals_dict:str) -> dict:
+        # The parameters of the 'python_code_by_pattern' statement:  regexes matching any
+        # code (and globals dict) that's equal to the given one up to renaming identifiers.
+        def identifiers_to_pattern(text):
+            return python_identifier_regex.sub(
+                lambda match: python_identifier_regex.pattern, escape_regex_str(text))
         
-        globals_dict = neo4j_escape_regex_str(globals_dict)
-        globals_dict = python_identifier_regex.sub(code, python_identifier_regex.pattern)
-                
-        query = f"MATCH (p:Python) WHERE p.code ~= {code} AND p.globals_dict ~= {globals_dict}"        
-        return query
+        return {
+            'code_regex' : identifiers_to_pattern(code),
+            'globals_regex' : identifiers_to_pattern(globals_dict),
+        }
     
     
 class VariableSubstitution(Arrow):
@@ -1,3 +1,592 @@
-from django.test import TestCase
+from django.test import TestCase, SimpleTestCase, RequestFactory
+from django.contrib.auth import get_user_model
+from django.db import OperationalError
+from django.urls import reverse
+from unittest import mock
+from django.core.cache import caches
+from django.utils import timezone
+from datetime import timedelta
+from dope.label_templates import compile_label
+from dope.settings import DIAGRAM_CACHE_ALIAS
+from dope.retry import CircuitBreaker, RetryPolicy
+from .graph_backend import graph_backend, set_graph_backend, make_graph_backend
+from .benchmarks.suite import CountingBackend
+from .wire_format import COMPACT_DIAGRAM_TYPE, to_compact
+from .diagram_matching import DiagramGraph, SubgraphMatcher, match_diagrams
+from .models import (Diagram, DiagramRule, QuiverDiagram, PendingDiagramSave, RevisionConflict,
+                     lease_expiry, set_property, backfill_label_shapes)
+from .views import diagram_etag
+from . import views
+from . import async_graph, write_behind, graph_instrumentation, cypher
+from asgiref.sync import async_to_sync
+import asyncio
+import json
 
-# Create your tests here.
+
+def edge(source:int, target:int, label:str=''):
+    options = {
+        'label_position' : 50, 'offset' : 0, 'curve' : 0,
+        'shorten' : {'source': 0, 'target': 0}, 'level' : 1,
+        'style' : {'body': {'name': 'solid'}, 'head': {'name': 'arrowhead', 'side': 'none'},
+                   'tail': {'name': 'none', 'side': 'none'}},
+    }
+    return [source, target, label, 0, options]
+
+
+def quiver_format(labels:list, edges:list=()) -> list:
+    return [0, len(labels)] + [[k, 0, label, [0, 0, 0, 1]] for k, label in enumerate(labels)] + \
+           [edge(*e) for e in edges]
+
+
+def summary(format:list):
+    # The vertex labels and (source, target, label) of the edges, which survive a round trip
+    vertices = format[2:2 + format[1]]
+    edges = format[2 + format[1]:]
+    return [v[2] for v in vertices], [(e[0], e[1], e[2]) for e in edges]
+
+
+class MemoryGraphTestCase(TestCase):
+    """
+    Runs each test against a fresh in-memory graph (see database.memory_graph).
+    """
+    def setUp(self):
+        self.previous_backend = set_graph_backend(make_graph_backend('memory'))
+        caches[DIAGRAM_CACHE_ALIAS].clear()
+        # The tests flush the write-behind journal themselves
+        patcher = mock.patch('database.write_behind.start_flusher')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        set_graph_backend(self.previous_backend)
+
+    def create_diagram(self, name='D', **props):
+        return Diagram.our_create(name=name, **props)
+
+    def client_for(self, username:str):
+        user, created = get_user_model().objects.get_or_create(username=username)
+        self.client.force_login(user)
+        return self.client
+
+    def save(self, username:str, name:str, format:list, **headers):
+        return self.client_for(username).post(
+            reverse('save_diagram', args=[name]) + headers.pop('query', ''), 
+            json.dumps(format), content_type='application/json', **headers)
+
+
+class LabelShapeTests(SimpleTestCase):
+    def test_non_numeric_subscripts_are_literal(self):
+        # Used to raise AttributeError in Variable.longest_match
+        for label in ['x_i', 'B_x', 'A_', "a_'", 'x__1', '\\eta_{X_{3}}']:
+            with self.subTest(label=label):
+                self.assertIsInstance(compile_label(label).shape, str)
+
+    def test_numeric_subscripts_are_part_of_the_variable(self):
+        self.assertEqual(compile_label('x_{12}').shape, '$0')
+        self.assertEqual(compile_label("x_1'").shape, '$0')
+        self.assertEqual(compile_label('x_i').shape, '$0_$1')
+
+
+class LabelShapeSaveTests(MemoryGraphTestCase):
+    def test_save_and_load_with_subscripted_labels(self):
+        diagram = self.create_diagram()
+        format = quiver_format(['x_i', 'B_x'], [(0, 1, 'f_i')])
+        diagram.update_from_editor(format)
+        self.assertEqual(QuiverDiagram.quiver_format_by_uid(diagram.uid)[2][2], 'x_i')
+        self.assertEqual(len(QuiverDiagram.quiver_format_by_uid(diagram.uid)), 5)
+
+
+class GraphInstrumentationTests(SimpleTestCase):
+    def setUp(self):
+        # Installs afresh over a stub cypher_query, putting neomodel back afterwards
+        from neomodel import db, StructuredNode, RelationshipManager
+        originals = [(db, 'cypher_query', db.cypher_query), (StructuredNode, 'save', StructuredNode.save),
+                     (RelationshipManager, 'connect', RelationshipManager.connect),
+                     (graph_instrumentation, '_installed', graph_instrumentation._installed)]
+
+        def restore():
+            for owner, name, value in originals:
+                setattr(owner, name, value)
+
+        self.addCleanup(restore)
+        self.db = db
+        db.cypher_query = mock.Mock(return_value=([[1], [2]], None))
+        graph_instrumentation._installed = False
+
+    def test_installs_once(self):
+        graph_instrumentation.install_graph_instrumentation()
+        wrapped = self.db.cypher_query
+        graph_instrumentation.install_graph_instrumentation()
+        self.assertIs(self.db.cypher_query, wrapped)
+
+        stats = graph_instrumentation.GraphRequestStats()
+        token = graph_instrumentation._request_stats.set(stats)
+        try:
+            self.db.cypher_query('MATCH (x) RETURN x')
+        finally:
+            graph_instrumentation._request_stats.reset(token)
+
+        self.assertEqual((stats.queries, stats.rows), (1, 2))
+
+
+class GraphQueryMiddlewareTests(MemoryGraphTestCase):
+    @mock.patch('database.graph_instrumentation.DEBUG', True)
+    def test_request_queries_are_counted(self):
+        self.create_diagram()
+        response = self.client_for('alice').get(reverse('load_diagram', args=['D']))
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(int(response['X-Graph-Queries']), 0)
+
+
+
+class LockedSaveTests(MemoryGraphTestCase):
+    def test_stale_update_writes_nothing(self):
+        diagram = self.create_diagram()
+        diagram.update_from_editor(quiver_format(['A', 'B'], [(0, 1, 'f')]))
+        base = diagram.revision
+        diagram.update_from_editor(quiver_format(['A', 'B', 'C']))
+
+        with self.assertRaises(RevisionConflict) as raised:
+            diagram.update_from_editor(quiver_format(['X']), base_revision=base)
+
+        self.assertEqual(raised.exception.revision, base + 1)
+        self.assertEqual(summary(QuiverDiagram.quiver_format_by_uid(diagram.uid)), (['A', 'B', 'C'], []))
+
+    def test_async_save_diffs_rows_read_under_the_lock(self):
+        diagram = self.create_diagram()
+        revision = async_to_sync(async_graph.update_from_editor)(
+            diagram.uid, quiver_format(['A', 'B'], [(0, 1, 'f')]))
+        revision = async_to_sync(async_graph.patch_from_editor)(
+            diagram.uid, revision, [{'op': 'relabel', 'kind': 'vertex', 'index': 1, 'label': 'C'}])
+
+        self.assertEqual(revision, 2)
+        self.assertEqual(summary(QuiverDiagram.quiver_format_by_uid(diagram.uid)),
+                         (['A', 'C'], [(0, 1, 'f')]))
+
+        with self.assertRaises(RevisionConflict):
+            async_to_sync(async_graph.update_from_editor)(diagram.uid, quiver_format([]), 1)
+
+
+
+class ConditionalSaveTests(MemoryGraphTestCase):
+    def setUp(self):
+        super().setUp()
+        self.diagram = self.create_diagram(checked_out_by='alice', checkout_expires=lease_expiry())
+
+    def test_save_against_the_current_revision(self):
+        response = self.save('bob', 'D', quiver_format(['A']),
+                             HTTP_IF_MATCH=diagram_etag(self.diagram.uid, 0))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['revision'], 1)
+        self.assertEqual(response['ETag'], diagram_etag(self.diagram.uid, 1))
+
+    def test_stale_save_is_a_conflict(self):
+        self.save('bob', 'D', quiver_format(['A']), query='?base_revision=0')
+        response = self.save('bob', 'D', quiver_format(['B']), query='?base_revision=0')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['revision'], 1)
+        self.assertEqual(summary(QuiverDiagram.quiver_format_by_uid(self.diagram.uid)), (['A'], []))
+
+    def test_if_match_of_another_etag_is_a_conflict(self):
+        response = self.save('bob', 'D', quiver_format(['A']), HTTP_IF_MATCH='"other.0"')
+        self.assertEqual(response.status_code, 409)
+
+    def test_if_match_any_needs_the_checkout(self):
+        # If-Match: * used to skip both the checkout and the revision check
+        with self.assertRaises(OperationalError):
+            self.save('bob', 'D', quiver_format(['A']), HTTP_IF_MATCH='*')
+
+        self.assertEqual(summary(QuiverDiagram.quiver_format_by_uid(self.diagram.uid)), ([], []))
+
+
+@mock.patch('database.views.WRITE_BEHIND_SAVES', True)
+class WriteBehindTests(MemoryGraphTestCase):
+    def setUp(self):
+        super().setUp()
+        self.diagram = self.create_diagram()
+
+    def test_saves_are_coalesced_until_committed(self):
+        self.save('alice', 'D', quiver_format(['A']))
+        self.save('alice', 'D', quiver_format(['A', 'B'], [(0, 1, 'f')]))
+        self.assertEqual(PendingDiagramSave.objects.count(), 1)
+        self.assertEqual(summary(QuiverDiagram.quiver_format_by_uid(self.diagram.uid)), ([], []))
+
+        self.assertTrue(write_behind.commit(self.diagram.uid))
+        self.assertFalse(PendingDiagramSave.objects.exists())
+        self.assertEqual(summary(QuiverDiagram.quiver_format_by_uid(self.diagram.uid)),
+                         (['A', 'B'], [(0, 1, 'f')]))
+
+    def test_commit_gives_up_on_a_save_claimed_elsewhere(self):
+        self.save('alice', 'D', quiver_format(['A']))
+        PendingDiagramSave.objects.update(flushing_until=timezone.now() + timedelta(minutes=1))
+
+        with self.assertRaises(TimeoutError):
+            write_behind.commit(self.diagram.uid, wait=0.1)
+
+    def test_conditional_save_flushes_the_pending_one_first(self):
+        self.save('alice', 'D', quiver_format(['A']))
+        response = self.save('alice', 'D', quiver_format(['B']), query='?base_revision=0')
+        self.assertEqual(response.status_code, 409)
+        self.assertFalse(PendingDiagramSave.objects.exists())
+
+    def test_invalid_save_is_rejected_before_journaling(self):
+        for format in ['junk', [0, 2, [0, 0, 'A', [0, 0, 0, 1]]], 
+                       quiver_format(['A'], [(0, 3, 'f')]), quiver_format(['A'], [(-1, 0, 'f')])]:
+            with self.subTest(format=format):
+                response = self.save('alice', 'D', format)
+                self.assertEqual(response.status_code, 400)
+                self.assertFalse(PendingDiagramSave.objects.exists())
+
+
+class CreateDiagramTests(MemoryGraphTestCase):
+    def test_create_view_checks_out_the_new_diagram(self):
+        client = self.client_for('alice')
+        response = client.post(reverse('create_diagram'), {'diagram-name-input': 'D'})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Diagram.checkout('D', 'bob')[2], 'alice')
+
+        response = client.post(reverse('create_diagram'), {'diagram-name-input': 'D'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(Diagram.create_by_name('D', 'bob'))
+
+    def test_deleted_diagram_frees_its_name(self):
+        diagram = self.create_diagram()
+        diagram.update_from_editor(quiver_format(['A', 'B'], [(0, 1, 'f')]))
+        diagram.delete_diagram()
+        self.assertEqual(Diagram.list_page()[0], [])
+        self.assertIsNotNone(Diagram.create_by_name('D', 'alice'))
+
+    def test_create_rule(self):
+        # Used to raise RequiredProperty for the diagram_index
+        rule = DiagramRule.our_create(checked_out_by='alice')
+        self.assertEqual(rule.diagram_index, 0)
+        self.assertEqual(rule.checked_out_by, 'alice')
+
+    def test_create_rule_onto_a_taken_name(self):
+        self.create_diagram('K')
+        with self.assertRaises(ValueError):
+            DiagramRule.our_create(key='K', res='R')
+        with self.assertRaises(ValueError):
+            DiagramRule.our_create(key='R', res='R')
+        self.assertEqual([listing.name for listing in Diagram.list_page()[0]], ['K'])
+
+
+class RevisionTests(MemoryGraphTestCase):
+    def test_set_property_bumps_the_revision(self):
+        diagram = self.create_diagram(checked_out_by='alice')
+        set_property(diagram, 'name', 'E')
+        self.assertEqual(diagram.revision, 1)
+        self.assertEqual(Diagram.revision_by_name('E')[1:], (1, 'alice'))
+
+        with self.assertRaises(ValueError):
+            set_property(diagram, 'all_objects', 'x')
+
+    def test_set_property_onto_a_taken_name(self):
+        diagram = self.create_diagram('D')
+        self.create_diagram('E')
+
+        with self.assertRaises(ValueError):
+            set_property(diagram, 'name', 'E')
+
+        self.assertEqual(Diagram.revision_by_name('D')[1], 0)
+        set_property(diagram, 'name', 'D')    # Its own name isn't taken
+
+    def test_delete_objects_bumps_the_revision(self):
+        diagram = self.create_diagram()
+        diagram.update_from_editor(quiver_format(['A', 'B'], [(0, 1, 'f')]))
+        diagram.delete_objects()
+        self.assertEqual(diagram.revision, 2)
+        self.assertEqual(summary(QuiverDiagram.quiver_format_by_uid(diagram.uid)), ([], []))
+
+
+class DiagramPageTests(MemoryGraphTestCase):
+    def test_pages_follow_on_by_name_then_uid(self):
+        for name in ['C', 'A', 'B', 'E', 'D']:
+            self.create_diagram(name)
+
+        names, cursor = [], None
+        while True:
+            listings, cursor = Diagram.list_page(cursor, limit=2)
+            names += [listing.name for listing in listings]
+            if cursor is None:
+                break
+
+        self.assertEqual(names, ['A', 'B', 'C', 'D', 'E'])
+
+
+class LeaseTests(MemoryGraphTestCase):
+    def test_checkout_is_exclusive_until_released_or_expired(self):
+        self.create_diagram()
+        self.assertEqual(Diagram.checkout('D', 'alice')[2], 'alice')
+        self.assertEqual(Diagram.checkout('D', 'bob')[2], 'alice')
+        self.assertTrue(Diagram.release('D', 'alice'))
+        self.assertEqual(Diagram.checkout('D', 'bob')[2], 'bob')
+        self.assertFalse(Diagram.release('D', 'alice'))
+
+        self.create_diagram('E', checked_out_by='alice', checkout_expires=1)
+        self.assertEqual(Diagram.checkout('E', 'bob')[2], 'bob')
+
+    def test_rule_checkout_covers_its_diagrams(self):
+        rule = DiagramRule.our_create(key='K', res='R')
+        self.assertEqual(rule.checkout('alice')[0], 'alice')
+        self.assertEqual(rule.checkout('bob')[0], 'alice')
+        self.assertEqual(Diagram.checkout('K', 'bob')[2], 'alice')
+
+        rule.release('alice')
+        self.assertEqual(Diagram.checkout('R', 'bob')[2], 'bob')
+        self.assertEqual(rule.checkout('alice')[0], 'bob')
+
+    def test_model_string_needs_the_lease(self):
+        diagram = self.create_diagram(checked_out_by='alice', checkout_expires=lease_expiry())
+        request = RequestFactory().post('/', {'pk': diagram.uid, 'value': 'E'})
+        request.user = get_user_model().objects.create(username='bob')
+        response = views.set_model_string(request, 'Diagram', 'name')
+        self.assertFalse(json.loads(response.content)['success'])
+        self.assertEqual(Diagram.revision_by_name('D')[1], 0)
+
+        request.user = get_user_model().objects.create(username='alice')
+        response = views.set_model_string(request, 'Diagram', 'name')
+        self.assertTrue(json.loads(response.content)['success'])
+        self.assertEqual(Diagram.revision_by_name('E')[1], 1)
+
+
+class RetryPolicyTests(SimpleTestCase):
+    def setUp(self):
+        self.breaker = CircuitBreaker(threshold=1, reset_timeout=0)
+        self.policy = RetryPolicy(self.breaker, max_tries=3, base_delay=0, max_delay=0)
+
+    def trip(self):
+        with self.assertRaises(ConnectionError):
+            self.policy.call(mock.Mock(side_effect=ConnectionError))
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+
+    def test_interrupted_probe_lets_the_next_call_probe(self):
+        self.trip()
+        with self.assertRaises(KeyboardInterrupt):
+            self.policy.call(mock.Mock(side_effect=KeyboardInterrupt))
+        self.assertEqual(self.policy.call(lambda: 1), 1)
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_cancelled_async_probe_lets_the_next_call_probe(self):
+        self.trip()
+
+        async def cancelled():
+            raise asyncio.CancelledError
+
+        with self.assertRaises(asyncio.CancelledError):
+            asyncio.run(self.policy.acall(cancelled))
+        self.assertEqual(self.policy.call(lambda: 1), 1)
+
+    def test_no_retry_when_told_not_to(self):
+        func = mock.Mock(side_effect=ConnectionError)
+        with self.assertRaises(ConnectionError):
+            RetryPolicy(CircuitBreaker(threshold=10), max_tries=3, base_delay=0).call(func, retry=False)
+        self.assertEqual(func.call_count, 1)
+
+
+class BulkLoadTests(MemoryGraphTestCase):
+    def statements_to_load(self, size:int) -> int:
+        diagram = self.create_diagram(f'D{size}')
+        format = quiver_format([f'X_{k}' for k in range(size)], [(k, k + 1, 'f') for k in range(size - 1)])
+        counting = CountingBackend(graph_backend())
+        previous = set_graph_backend(counting)
+
+        try:
+            diagram.load_from_editor(format)
+        finally:
+            set_graph_backend(previous)
+
+        self.assertEqual(summary(QuiverDiagram.quiver_format_by_uid(diagram.uid)), summary(format))
+        self.assertEqual(Diagram.list_page(limit=100)[0][-1].object_count, size)
+        return counting.round_trips
+
+    def test_statements_dont_grow_with_the_diagram(self):
+        self.assertEqual(self.statements_to_load(2), self.statements_to_load(50))
+
+
+class IncrementalSaveTests(MemoryGraphTestCase):
+    def setUp(self):
+        super().setUp()
+        self.diagram = self.create_diagram()
+        self.diagram.update_from_editor(quiver_format(['A', 'B', 'C'], [(0, 1, 'f'), (1, 2, 'g')]))
+
+    def uids(self):
+        vertices, edges = self.diagram.stored_editor_rows()
+        return {k: v['uid'] for k, v in vertices.items()}
+
+    def test_unchanged_objects_keep_their_uids(self):
+        before = self.uids()
+        self.diagram.update_from_editor(quiver_format(['A', 'B', 'D'], [(0, 1, 'f'), (1, 2, 'h')]))
+        self.assertEqual(self.uids(), before)
+        self.assertEqual(summary(QuiverDiagram.quiver_format_by_uid(self.diagram.uid)),
+                         (['A', 'B', 'D'], [(0, 1, 'f'), (1, 2, 'h')]))
+
+    def test_removed_objects_and_arrows_are_deleted(self):
+        before = self.uids()
+        self.diagram.update_from_editor(quiver_format(['A', 'B'], [(1, 0, 'k')]))
+        self.assertEqual(self.uids(), {0: before[0], 1: before[1]})
+        self.assertEqual(summary(QuiverDiagram.quiver_format_by_uid(self.diagram.uid)),
+                         (['A', 'B'], [(1, 0, 'k')]))
+        self.assertEqual(self.diagram.revision, 2)
+
+
+class LoadDiagramTests(MemoryGraphTestCase):
+    def setUp(self):
+        super().setUp()
+        self.diagram = self.create_diagram()
+        self.diagram.update_from_editor(quiver_format(['A']))
+        self.client = self.client_for('alice')
+        self.url = reverse('load_diagram', args=['D'])
+
+    def test_revalidation_is_not_modified_until_a_save(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['ETag'], diagram_etag(self.diagram.uid, 1))
+        self.assertEqual(summary(json.loads(response.content)), (['A'], []))
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=diagram_etag(self.diagram.uid, 1))
+        self.assertEqual(response.status_code, 304)
+
+        self.save('alice', 'D', quiver_format(['A', 'B']), query='?base_revision=1')
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=diagram_etag(self.diagram.uid, 1))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['ETag'], diagram_etag(self.diagram.uid, 2))
+        self.assertEqual(summary(json.loads(response.content)), (['A', 'B'], []))
+
+    def test_load_needs_the_checkout(self):
+        Diagram.checkout('D', 'bob')
+        with self.assertRaises(OperationalError):
+            self.client.get(self.url)
+
+
+class PatchDiagramTests(MemoryGraphTestCase):
+    def setUp(self):
+        super().setUp()
+        self.diagram = self.create_diagram()
+        self.diagram.update_from_editor(quiver_format(['A', 'B'], [(0, 1, 'f')]))
+
+    def patch(self, username:str, base_revision:int, ops:list):
+        return self.client_for(username).post(
+            reverse('patch_diagram', args=['D']),
+            json.dumps({'base_revision': base_revision, 'ops': ops}), content_type='application/json')
+
+    def test_ops_apply_in_order(self):
+        response = self.patch('alice', 1, [
+            {'op': 'add', 'kind': 'vertex', 'data': [1, 1, 'C', [0, 0, 0, 1]]},
+            {'op': 'relabel', 'kind': 'vertex', 'index': 0, 'label': 'X'},
+            {'op': 'delete', 'kind': 'vertex', 'index': 1},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['revision'], 2)
+        self.assertEqual(summary(QuiverDiagram.quiver_format_by_uid(self.diagram.uid)), (['X', 'C'], []))
+
+    def test_stale_patch_is_a_conflict(self):
+        response = self.patch('alice', 0, [{'op': 'relabel', 'kind': 'vertex', 'index': 0, 'label': 'X'}])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['revision'], 1)
+        self.assertEqual(summary(QuiverDiagram.quiver_format_by_uid(self.diagram.uid))[0], ['A', 'B'])
+
+    def test_bad_op_is_rejected(self):
+        for op in [{'op': 'relabel', 'kind': 'vertex', 'index': 7, 'label': 'X'},
+                   {'op': 'add', 'kind': 'vertex', 'data': [0, 0, 5]},
+                   {'op': 'restyle', 'kind': 'vertex', 'index': 0, 'colour': 7},
+                   {'op': 'relabel', 'kind': 'edge', 'index': 0, 'label': ['f']}]:
+            with self.subTest(op=op):
+                response = self.patch('alice', 1, [op])
+                self.assertEqual(response.status_code, 400)
+
+        self.assertEqual(summary(QuiverDiagram.quiver_format_by_uid(self.diagram.uid)),
+                         (['A', 'B'], [(0, 1, 'f')]))
+
+    def test_bad_async_op_is_rejected(self):
+        with self.assertRaises(ValueError):
+            async_to_sync(async_graph.patch_from_editor)(
+                self.diagram.uid, 1, [{'op': 'add', 'kind': 'vertex', 'data': [0, 0, 5]}])
+
+    def test_patch_needs_the_checkout(self):
+        Diagram.checkout('D', 'bob')
+        with self.assertRaises(OperationalError):
+            self.patch('alice', 1, [])
+
+
+class CompactSaveTests(MemoryGraphTestCase):
+    def post(self, data):
+        return self.client_for('alice').post(
+            reverse('save_diagram', args=['D']), json.dumps(data), content_type=COMPACT_DIAGRAM_TYPE)
+
+    def test_compact_save_round_trips(self):
+        diagram = self.create_diagram()
+        format = quiver_format(['A', 'B'], [(0, 1, 'f')])
+        self.assertEqual(self.post(to_compact(format)).status_code, 200)
+        self.assertEqual(summary(QuiverDiagram.quiver_format_by_uid(diagram.uid)), summary(format))
+
+    def test_malformed_compact_save_is_rejected(self):
+        self.create_diagram()
+
+        for data in [{'v': 1, 'objects': {'x': 5}}, {'v': 1, 'objects': [], 'arrows': {}},
+                     {'v': 1, 'objects': {'x': [0], 'label': [3]}},
+                     {'v': 1, 'objects': {'x': [0], 'colour': [7]}},
+                     {'v': 1, 'objects': {'x': [0, 1]}, 'arrows': {'source': ['a'], 'target': [1]}}]:
+            with self.subTest(data=data):
+                self.assertEqual(self.post(data).status_code, 400)
+
+
+def diagram_graph(labels:list, edges:list=()) -> DiagramGraph:
+    return DiagramGraph.from_quiver_format(quiver_format(labels, edges))
+
+
+class SubgraphMatcherTests(MemoryGraphTestCase):
+    def test_matches_bind_the_label_variables(self):
+        pattern = diagram_graph(['F(X)', 'F(Y)'], [(0, 1, 'F(f)')])
+        target = diagram_graph(['F(A)', 'F(B)', 'G(A)'], [(0, 1, 'F(g)'), (2, 1, 'F(h)')])
+        matcher = SubgraphMatcher(pattern, target)
+        matches = matcher.find_matches()
+
+        self.assertEqual(len(matches), 1)
+        self.assertEqual((matches[0].nodes, matches[0].arrows), ({0: 0, 1: 1}, {0: 0}))
+        self.assertEqual({str(var): text for var, text in matches[0].bindings.items()},
+                         {'F': 'F', 'X': 'A', 'Y': 'B', 'f': 'g'})
+        self.assertFalse(matcher.truncated)
+
+    def test_no_match(self):
+        # A pair of opposite arrows doesn't occur in a chain:
+        pattern = diagram_graph(['X', 'Y'], [(0, 1, 'f'), (1, 0, 'g')])
+        target = diagram_graph(['A', 'B', 'C'], [(0, 1, 'g'), (1, 2, 'h')])
+        self.assertEqual(SubgraphMatcher(pattern, target).find_matches(), [])
+
+    def test_search_is_truncated_after_max_steps(self):
+        n = 6
+        target = diagram_graph(['A'] * n, [(i, j, 'f') for i in range(n) for j in range(n) if i != j])
+        pattern = diagram_graph(['X'] * 4, [(0, 1, 'f'), (1, 2, 'f'), (2, 3, 'f')])
+        matcher = SubgraphMatcher(pattern, target, max_steps=50)
+        matches = matcher.find_matches()
+
+        self.assertTrue(matcher.truncated)
+        self.assertLessEqual(matcher.steps, 51)
+        self.assertLess(len(matches), n * (n - 1) * (n - 2) * (n - 3))
+
+    def test_match_stored_diagrams(self):
+        pattern = self.create_diagram('P')
+        pattern.update_from_editor(quiver_format(['X', 'Y'], [(0, 1, 'f')]))
+        target = self.create_diagram('T')
+        target.update_from_editor(quiver_format(['A', 'B', 'C'], [(0, 1, 'g'), (1, 2, 'h')]))
+
+        matches = match_diagrams(pattern.uid, target.uid)
+        self.assertEqual(sorted(match.nodes[0] for match in matches), [0, 1])
+        self.assertEqual(len(match_diagrams(pattern.uid, target.uid, max_matches=1)), 1)
+
+
+class BackfillTests(MemoryGraphTestCase):
+    def test_backfill_label_shapes(self):
+        diagram = self.create_diagram()
+        diagram.update_from_editor(quiver_format(['x_i', 'B'], [(0, 1, 'f_{1}')]))
+        backend = graph_backend()
+        items = [x for kind in cypher.SHAPED_ITEM_MATCHES for x in backend._shaped_items(kind)]
+        shapes = [x.get('shape') for x in items]
+        self.assertNotIn(None, shapes)
+
+        for x in items:
+            backend.set_properties(x, {'shape': None})
+
+        self.assertEqual(backfill_label_shapes(batch_size=2), 3)
+        self.assertEqual([x.get('shape') for x in items], shapes)
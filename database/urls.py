@@ -1,13 +1,26 @@
 from django.urls import path
-from .views import save_diagram, create_diagram, load_diagram
+from .views import diagram_cache_stats_view, diagram_list, checkout_diagram
+from dope.settings import ASYNC_DIAGRAM_VIEWS
+
+if ASYNC_DIAGRAM_VIEWS:
+    from .async_views import (save_diagram, patch_diagram, commit_diagram, create_diagram, 
+                             load_diagram)
+else:
+    from .views import (save_diagram, patch_diagram, commit_diagram, create_diagram, 
+                        load_diagram)
 
 
 urlpatterns = [
     #path('set-category', set_diagram_category, name='set_diagram_category'),    
     #path('set-model-string/<str:Model>/<str:field>', set_model_string, name='set_model_string'),
     path('save-diagram/<str:diagram_name>', save_diagram, name='save_diagram'),
+    path('patch-diagram/<str:diagram_name>', patch_diagram, name='patch_diagram'),
+    path('commit-diagram/<str:diagram_name>', commit_diagram, name='commit_diagram'),
     path('load-diagram/<str:diagram_name>', load_diagram, name='load_diagram'),
+    path('checkout-diagram/<str:diagram_name>', checkout_diagram, name='checkout_diagram'),
     path('create-diagram', create_diagram, name='create_diagram'),
+    path('diagram-cache-stats', diagram_cache_stats_view, name='diagram_cache_stats'),
+    path('diagrams', diagram_list, name='diagram_list'),
     #path('load-cd/<str:diagram_id>', load_diagram_from_database, name='load_diagram'),
     #path('open-cds', list_open_diagrams, name='open_diagrams'),
     #path('all-cds', list_all_diagrams, name='all_diagrams'),
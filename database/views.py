@@ -1,48 +1,59 @@
 from django.shortcuts import render, redirect, HttpResponse
-from .models import get_model_by_name, get_unique, Diagram
+from .models import (get_model_by_name, get_model_by_uid, get_models_by_uids, get_model_class, 
+                     get_unique, set_property, Diagram, QuiverDiagram, DiagramRule, Category, 
+                     RevisionConflict)
+from . import cypher
+from .diagram_cache import get_diagram_json, invalidate_diagram, diagram_cache_stats
+from . import write_behind
 from django.contrib.auth.decorators import login_required, user_passes_test
 #from accounts.permissions import is_editor
-from dope.http_tools import get_posted_text, render_error
-from django.http import JsonResponse
-from dope.python_tools import full_qualname, call_with_retry
+from dope.http_tools import (get_posted_text, render_error, etag_matches, accepts_media_type, 
+                             decoded_body)
+from django.http import JsonResponse, HttpResponseNotModified
+from django.utils.http import quote_etag, parse_etags
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.views.decorators.gzip import gzip_page
+from .wire_format import COMPACT_DIAGRAM_TYPE, from_compact
+from dope.python_tools import full_qualname
+from dope.retry import CircuitOpenError, retry_stats
 import json
 from django.db import OperationalError
 from django.core.exceptions import ObjectDoesNotExist
 from neomodel.properties import StringProperty
-from dope.settings import MAX_ATOMIC_LATEX_LENGTH
+from dope.label_templates import label_template_cache_stats
+from dope.settings import MAX_ATOMIC_LATEX_LENGTH, WRITE_BEHIND_SAVES, DIAGRAM_PAGE_SIZE
 from django.contrib import messages
 
 
 @login_required
 def create_diagram(request):
+    error_msg = None
+    
     try:
         if request.method == 'POST':
             #namespace = request.user.username
-            diagram_name = request.POST.get('diagram-name-input')
+            diagram_name = request.POST.get('diagram-name-input', '')
         
             #diagram_name = DrawnDiagram.validate_name(diagram_name)
         
-            if 0 < len(diagram_name) <= MAX_ATOMIC_LATEX_LENGTH:               
-                diagram = call_with_retry(Diagram.nodes.get_or_none, name=diagram_name)
+            if len(diagram_name) == 0:
+                error_msg = 'A diagram name must be non-empty.'
+            elif len(diagram_name) > MAX_ATOMIC_LATEX_LENGTH:
+                error_msg = f'A diagram name can be no longer than {MAX_ATOMIC_LATEX_LENGTH} characters.'                
+            # The existence check & the create are one statement, so two requests can't both 
+            # create the name (and a failed lookup can't be taken for "no such diagram"):
+            elif Diagram.create_by_name(diagram_name, request.user.username) is None:
+                error_msg = 'A diagram by that name already exists.'
             else:
-                if len(diagram_name) == 0:
-                    error_msg = 'A diagram name must be non-empty.'
-                elif len(diagram_name) > MAX_ATOMIC_LATEX_LENGTH:
-                    error_msg = f'A diagram name can be no longer than {MAX_ATOMIC_LATEX_LENGTH} characters.'                
-            
-            if diagram is None:
-                diagram = Diagram.our_create(
-                    name=diagram_name, checked_out_by=request.user.username)
-                
                 return redirect('diagram_editor', diagram_name)
-            else:
-                error_msg = 'A diagram by that name already exists.'
-        else:
-            error_msg = None
             
+    except CircuitOpenError as e:
+        error_msg = str(e)
+        
     except Exception as e:
         if __debug__:
             raise e
+        error_msg = f'{full_qualname(e)}: {str(e)}'
         
     if error_msg:
         messages.error(request, error_msg)
@@ -63,6 +74,22 @@ def create_diagram(request):
         #raise ObjectDoesNotExist(f'An instance of the model {Model} with uid "{uid}" does not exist.')
     
     #return model
+    
+    
+def check_checkout(model, username:str):
+    """
+    Takes or renews username's checkout lease on the diagram or rule, as a save does, raising
+    OperationalError if someone else holds an unexpired one.
+    """
+    if isinstance(model, QuiverDiagram):
+        uid, revision, checked_out_by = type(model).checkout(model.name, username)
+    elif isinstance(model, DiagramRule):
+        checked_out_by, key_revision, result_revision = model.checkout(username)
+    else:
+        raise OperationalError(f'A {type(model).__name__} cannot be checked out.')
+    
+    if checked_out_by != username:
+        raise OperationalError(f'The {type(model).__name__} is checked out by {checked_out_by}.')
                         
 
 @login_required   
@@ -73,9 +100,8 @@ def set_model_string(request, Model:str, field:str):
         
         ModelClass = get_model_class(Model)         
         model = get_model_by_uid(ModelClass, uid=old_id)
-        
-        if model.checked_out_by != request.user.username:
-            raise OperationalError(f'The {Model} is not checked out by you.')
+        # BUGFIX: a stale checked_out_by let an expired or stolen checkout through
+        check_checkout(model, request.user.username)
         
         if not hasattr(model, field):
             raise ValueError(f'A {Model} has no field "{field}" implemented.')
@@ -89,8 +115,10 @@ def set_model_string(request, Model:str, field:str):
         current_val = getattr(model, field)
         
         if current_val != string:
-            setattr(model, field, string)
-            model.save()
+            # Just the one property, and a diagram's revision with it:
+            set_property(model, field, string)
+            if isinstance(model, QuiverDiagram):
+                invalidate_diagram(model.uid)
             
         return JsonResponse({'success': True})
         
@@ -104,21 +132,16 @@ def set_model_string(request, Model:str, field:str):
 def set_diagram_category(request):
     try:                        
         diagram = get_model_by_uid(Diagram, uid=request.POST['pk'])
-        
-        if diagram.checked_out_by != request.user.username:
-            raise OperationalError(f'The {Model} is not checked out by you.')
+        check_checkout(diagram, request.user.username)
                
         category_name = get_posted_text(request).strip()
         
         if category_name == '':
             raise Exception(f'Category name cannot be empty.')       
     
-        category = diagram.category.single()
-    
-        if category_name != category.name:
-            new_category = get_unique(Category, name=category_name)
-            diagram.category.reconnect(category, new_category)
-            diagram.save()
+        # One statement, which only bumps the revision if the category changed:
+        if QuiverDiagram.move_to_category(diagram.uid, category_name) != diagram.revision:
+            invalidate_diagram(diagram.uid)
             
         return JsonResponse({'success': True})
         
@@ -131,12 +154,13 @@ def set_diagram_category(request):
 def list_open_diagrams(request):
     
     try:          
-        diagrams = []
         diagram_ids = request.session.get('diagram ids', [])
+        diagrams, missing = get_models_by_uids(Diagram, diagram_ids)
         
-        for diagram_id in diagram_ids:
-            diagram = get_model_by_uid(Diagram, uid=diagram_id)
-            diagrams.append(diagram)
+        if missing:
+            # Diagrams deleted since they were opened
+            request.session['diagram ids'] = [uid for uid in diagram_ids if uid not in missing]
+            messages.warning(request, f'{len(missing)} of your open diagrams no longer exist.')
             
         context = {
             'diagrams' : diagrams
@@ -149,32 +173,111 @@ def list_open_diagrams(request):
     
 def list_all_diagrams(request):
     try:
+        diagrams, next_cursor = Diagram.list_page(request.GET.get('after'))
         context = {
-            'diagrams' : Diagram.nodes.order_by('name')
+            'diagrams' : diagrams,
+            'next_cursor' : next_cursor,
         }        
          
         return render(request, 'diagram_list_page.html', context) 
             
     except Exception as e:
         return redirect('error', f'{full_qualname(e)}: {str(e)}')
+    
+    
+@login_required
+def diagram_list(request):
+    """
+    One page of the diagram listing as JSON.  Pass the returned "next" cursor back as 
+    ?after= to get the following page; it's null on the last page.
+    """
+    try:
+        limit = min(int(request.GET.get('limit', DIAGRAM_PAGE_SIZE)), DIAGRAM_PAGE_SIZE)
+        diagrams, next_cursor = Diagram.list_page(request.GET.get('after'), max(limit, 1))
+        
+        return JsonResponse({
+            'diagrams' : [d._asdict() for d in diagrams],
+            'next' : next_cursor,
+        })
+    
+    except ValueError as e:
+        return JsonResponse({'error_msg' : str(e)}, status=400)
+        
+        
+def wants_compact(request) -> bool:
+    return accepts_media_type(request, COMPACT_DIAGRAM_TYPE)
+
+
+def diagram_etag(uid:str, revision:int, compact=False) -> str:
+    # Each encoding is a different representation, so it needs its own ETag:
+    return quote_etag(f'{uid}.{revision}.c' if compact else f'{uid}.{revision}')
+
+
+def diagram_response(data:str, etag:str, compact=False):
+    """
+    The response to a diagram load: its JSON, or a 304 if data is None (the client's copy 
+    is current).
+    """
+    if data is None:
+        response = HttpResponseNotModified()
+    else:
+        content_type = COMPACT_DIAGRAM_TYPE if compact else 'application/json'
+        response = HttpResponse(data, content_type=content_type)
+        
+    response['ETag'] = etag
+    # Make the browser revalidate every time, which is cheap given the ETag:
+    patch_cache_control(response, private=True, no_cache=True)
+    patch_vary_headers(response, ['Accept'])
+    return response
+
+
+def posted_diagram(request):
+    """
+    The diagram posted to a save as a Quiver array.  The body may be in the compact 
+    encoding (by its Content-Type), and gzip or deflate compressed (by Content-Encoding).
+    """
+    body = decoded_body(request).decode('utf-8')
+    
+    if request.content_type == COMPACT_DIAGRAM_TYPE:
+        return from_compact(json.loads(body))
+    
+    if body:
+        try:
+            return json.loads(body)
+        except json.decoder.JSONDecodeError:
+            # For some reason, empty diagrams are resulting in the body as a URL str (not JSON)
+            pass
         
+    return [0, 0]
         
+
 @login_required
+@gzip_page
 def load_diagram(request, diagram_name:str):
     try:
         if request.method == 'GET':
             user = request.user.username
             
-            diagram = get_model_by_name(Diagram, diagram_name)
+            uid, revision, checked_out_by = Diagram.checkout(diagram_name, user)
             
-            if diagram.checked_out_by != user:
+            if checked_out_by != user:
                 raise OperationalError(
-                    f'The diagram with name "{diagram_name}" is already checked out by {diagram.checked_out_by}')                
-                        
-            data = diagram.quiver_format()
+                    f'The diagram with name "{diagram_name}" is already checked out by {checked_out_by}')                
+            
+            # A save still pending in the write-behind journal goes to the graph first:
+            if WRITE_BEHIND_SAVES and write_behind.commit(uid):
+                uid, revision, checked_out_by = Diagram.revision_by_name(diagram_name)
             
-            messages.success(request, "Loaded diagram from the database! ✨")
-            return JsonResponse(data, safe=False)            
+            compact = wants_compact(request)
+            etag = diagram_etag(uid, revision, compact)
+            
+            if etag_matches(request, etag):
+                data = None
+            else:
+                data = get_diagram_json(uid, revision, compact)
+                messages.success(request, "Loaded diagram from the database! ✨")
+                
+            return diagram_response(data, etag, compact)
             
             #return render(request, 'diagram_editor.html', context)
         else:
@@ -188,38 +291,112 @@ def load_diagram(request, diagram_name:str):
         return JsonResponse({'error_msg' : error_msg})
 
 
+def posted_edit_ops(request):
+    """
+    The (base revision, edit ops) posted to a delta save, whose body is the JSON object
+    {"base_revision": ..., "ops": [...]} (optionally gzip or deflate compressed).
+    """
+    try:
+        data = json.loads(decoded_body(request).decode('utf-8'))
+    except json.decoder.JSONDecodeError:
+        raise ValueError('The edit ops must be posted as a JSON object.')
+    
+    if not isinstance(data, dict) or not isinstance(data.get('base_revision'), int):
+        raise ValueError('The edit ops must come with the base_revision they were made against.')
+    
+    return data['base_revision'], data.get('ops', [])
+
+
+def is_conditional_save(request) -> bool:
+    # BUGFIX: If-Match: * names no revision, so it used to skip both the checkout and the 
+    # revision check.  Such a save now needs the checkout like an unconditional one.
+    if_match = request.META.get('HTTP_IF_MATCH', '').strip()
+    return (if_match != '' and if_match != '*') or 'base_revision' in request.GET
+
+
+def posted_base_revision(request, uid:str, revision:int) -> int:
+    """
+    The revision a conditional save (see is_conditional_save) was made against, from its 
+    base_revision query parameter or its If-Match header (an ETag of the diagram's load).
+    An If-Match listing none of the diagram's ETags is a conflict with its current revision.
+    """
+    if 'base_revision' in request.GET:
+        try:
+            return int(request.GET['base_revision'])
+        except ValueError:
+            raise ValueError('The base_revision must be an integer.')
+        
+    for tag in parse_etags(request.META['HTTP_IF_MATCH']):
+        # Strip any weakness flag & the quotes, and the encoding suffix (see diagram_etag):
+        tag = tag[2:] if tag.startswith('W/') else tag
+        parts = tag.strip('"').split('.')
+        
+        if parts[0] == uid and len(parts) > 1 and parts[1].isdigit():
+            return int(parts[1])
+        
+    raise RevisionConflict(revision)
+
+
+def patched_response(uid:str, revision:int):
+    response = JsonResponse({'revision' : revision})
+    response['ETag'] = diagram_etag(uid, revision)
+    return response
+
+
+def conflict_response(e:RevisionConflict):
+    return JsonResponse({'error_msg' : str(e), 'revision' : e.revision}, status=409)
+
+
 @login_required   
 def save_diagram(request, diagram_name):
+    """
+    Saves the posted Quiver array as the diagram's contents.  A save sent with If-Match or 
+    base_revision (see posted_base_revision) needs no checkout: it's written straight away 
+    provided the diagram is still at that revision, returning the new one, or else it's 
+    rejected with a 409 carrying the current one.
+    """
     try:
         if request.method != 'POST': #or not request.headers.get("contentType", "application/json; charset=utf-8"):
             raise OperationalError('You can only use the POST method to save to the database.')            
         user = request.user.username
         
-        diagram = get_model_by_name(Diagram, diagram_name)
+        if is_conditional_save(request):
+            diagram = get_model_by_name(Diagram, diagram_name)
+            base_revision = posted_base_revision(request, diagram.uid, diagram.revision)
+            data = posted_diagram(request)
+            
+            # Any save still pending goes first, so it counts as a newer revision:
+            if WRITE_BEHIND_SAVES:
+                write_behind.commit(diagram.uid)
+            
+            diagram.update_from_editor(data, base_revision)
+            invalidate_diagram(diagram.uid)
+            return patched_response(diagram.uid, diagram.revision)
+        
+        uid, revision, checked_out_by = Diagram.checkout(diagram_name, user)
 
-        if diagram.checked_out_by != user:
+        if checked_out_by != user:
             raise OperationalError(
-                f'The diagram with name "{diagram_name}" is already checked out by {diagram.checked_out_by}')                
+                f'The diagram with name "{diagram_name}" is already checked out by {checked_out_by}')                
                        
-        body = request.body.decode('utf-8')
-        
-        if body:
-            try:
-                data = json.loads(body)                
-            except json.decoder.JSONDecodeError:
-                # For some reason, empty diagrams are resulting in the body as a URL str (not JSON)
-                data = [0, 0]               
-        else:
-            data = [0, 0]
+        data = posted_diagram(request)
         
-        diagram.delete_objects()
-        diagram.load_from_editor(data)        
+        if WRITE_BEHIND_SAVES:
+            write_behind.queue_save(uid, user, data)
+        else:
+            write_behind.write_diagram(get_model_by_uid(Diagram, uid), data)
 
         messages.success(request, "Saved diagram to the database! 🤩")
         
         return JsonResponse(
             'Wrote the following data to the database:\n' + str(data), safe=False)
 
+    except RevisionConflict as e:
+        return conflict_response(e)
+    
+    except ValueError as e:
+        return JsonResponse({'error_msg' : str(e)}, status=400)
+    
     except Exception as e:
         if __debug__:
             raise e
@@ -230,3 +407,114 @@ def save_diagram(request, diagram_name):
     #except Exception as e:
         #return JsonResponse({'success': False, 'error_msg': f'{full_qualname(e)}: {e}'}) 
 
+
+@login_required
+def patch_diagram(request, diagram_name):
+    """
+    The delta save: applies the posted edit ops (see database.diagram_edits) atomically, 
+    provided the diagram is still at the revision they were made against.  Returns the 
+    new revision, or a 409 with the current one.
+    """
+    try:
+        if request.method != 'POST':
+            raise OperationalError('You can only use the POST method to save to the database.')
+        user = request.user.username
+        
+        uid, revision, checked_out_by = Diagram.checkout(diagram_name, user)
+        
+        if checked_out_by != user:
+            raise OperationalError(
+                f'The diagram with name "{diagram_name}" is already checked out by {checked_out_by}')
+            
+        base_revision, ops = posted_edit_ops(request)
+        
+        if WRITE_BEHIND_SAVES:
+            write_behind.commit(uid)
+            
+        diagram = get_model_by_uid(Diagram, uid)
+        diagram.patch_from_editor(base_revision, ops)
+        invalidate_diagram(diagram.uid)
+        return patched_response(diagram.uid, diagram.revision)
+    
+    except RevisionConflict as e:
+        return conflict_response(e)
+    
+    except ValueError as e:
+        return JsonResponse({'error_msg' : str(e)}, status=400)
+    
+    except Exception as e:
+        if __debug__:
+            raise e
+        error_msg = f'{full_qualname(e)}: {str(e)}'
+        messages.error(request, error_msg)
+        return JsonResponse({'error_msg' : error_msg})
+
+
+@login_required
+def commit_diagram(request, diagram_name):
+    """
+    Writes the diagram's pending save (see database.write_behind) to the graph now, rather 
+    than after the debounce window.  Returns the diagram's revision.
+    """
+    try:
+        if request.method != 'POST':
+            raise OperationalError('You can only use the POST method to save to the database.')
+        user = request.user.username
+        
+        uid, revision, checked_out_by = Diagram.checkout(diagram_name, user)
+        
+        if checked_out_by != user:
+            raise OperationalError(
+                f'The diagram with name "{diagram_name}" is already checked out by {checked_out_by}')
+            
+        if write_behind.commit(uid):
+            uid, revision, checked_out_by = Diagram.revision_by_name(diagram_name)
+            
+        return patched_response(uid, revision)
+    
+    except Exception as e:
+        if __debug__:
+            raise e
+        error_msg = f'{full_qualname(e)}: {str(e)}'
+        messages.error(request, error_msg)
+        return JsonResponse({'error_msg' : error_msg})
+
+
+@login_required
+def checkout_diagram(request, diagram_name):
+    """
+    Takes or renews the user's checkout lease on the diagram (POST), or gives it up (DELETE), 
+    which the editor does when it's closed.  Returns the holder and the diagram's revision, 
+    with a 409 if someone else holds it.
+    """
+    try:
+        user = request.user.username
+        
+        if request.method == 'POST':
+            uid, revision, checked_out_by = Diagram.checkout(diagram_name, user)
+        elif request.method == 'DELETE':
+            Diagram.release(diagram_name, user)
+            uid, revision, checked_out_by = Diagram.revision_by_name(diagram_name)
+        else:
+            raise OperationalError('You can only POST or DELETE a checkout.')
+        
+        return JsonResponse({'checked_out_by' : checked_out_by, 'revision' : revision}, 
+                            status=200 if checked_out_by == user or request.method == 'DELETE' 
+                            else 409)
+        
+    except Exception as e:
+        if __debug__:
+            raise e
+        error_msg = f'{full_qualname(e)}: {str(e)}'
+        return JsonResponse({'error_msg' : error_msg})
+    
+
+@user_passes_test(lambda user: user.is_staff)
+def diagram_cache_stats_view(request):
+    stats = diagram_cache_stats()
+    stats['label_templates'] = label_template_cache_stats()
+    stats['statements'] = cypher.statement_stats()
+    stats['graph_retry'] = retry_stats()
+    stats['write_behind'] = write_behind.write_behind_stats()
+    return JsonResponse(stats)
+
@@ -0,0 +1,175 @@
+"""
+The compact diagram encoding, an alternative to Quiver's array format on the wire.
+
+Quiver's format is a list of per-item arrays in which every arrow repeats a nested options
+dict (and its colour twice).  The compact one is columnar instead: one list per field, with
+the items in order, and a field whose values are all the default is left out entirely:
+
+    {"v": 1,
+     "objects": {"x": [...], "y": [...], "label": [...], "colour": [...]},
+     "arrows": {"source": [...], "target": [...], "label": [...], "curve": [...], ...}}
+
+Clients ask for it with the COMPACT_DIAGRAM_TYPE media type (Accept on load, Content-Type
+on save).  Conversion goes through the Quiver array, so everything downstream is unchanged.
+"""
+
+COMPACT_DIAGRAM_TYPE = 'application/vnd.dope.diagram+json'
+COMPACT_VERSION = 1
+
+DEFAULT_COLOUR = [0, 0, 0, 1]
+
+# Object columns after x, y and label, with their defaults:
+OBJECT_FIELDS = {
+    'colour' : DEFAULT_COLOUR,
+}
+
+# Arrow columns after source, target and label, with their defaults & their place in the
+# Quiver edge's options dict:
+ARROW_FIELDS = {
+    'alignment' : (0, None),
+    'label_position' : (50, ('label_position',)),
+    'offset' : (0, ('offset',)),
+    'curve' : (0, ('curve',)),
+    'shorten_source' : (0, ('shorten', 'source')),
+    'shorten_target' : (0, ('shorten', 'target')),
+    'level' : (1, ('level',)),
+    'tail' : ('none', ('style', 'tail', 'name')),
+    'tail_side' : ('none', ('style', 'tail', 'side')),
+    'head' : ('arrowhead', ('style', 'head', 'name')),
+    'head_side' : ('none', ('style', 'head', 'side')),
+    'body' : ('solid', ('style', 'body', 'name')),
+    'colour' : (DEFAULT_COLOUR, None),
+}
+
+
+# The types the columns' values must have, where it matters to the decoding (the rest are
+# checked as the diagram's properties when it's saved):
+COLUMN_TYPES = {
+    'x' : (int, float),
+    'y' : (int, float),
+    'label' : str,
+    'colour' : list,
+    'source' : int,
+    'target' : int,
+}
+
+
+def _lookup(d:dict, keys, default):
+    for key in keys:
+        if not isinstance(d, dict) or key not in d:
+            return default
+        d = d[key]
+    return d
+
+
+def _columns(columns:dict, defaults:dict) -> dict:
+    # Drops the columns that hold nothing but the default:
+    return {field : values for field, values in columns.items()
+            if field not in defaults or any(v != defaults[field] for v in values)}
+
+
+def to_compact(format:list) -> dict:
+    """
+    Encodes a Quiver array compactly.
+    """
+    num_vertices = format[1]
+    vertices = format[2:2 + num_vertices]
+    edges = format[2 + num_vertices:]
+
+    objects = {
+        'x' : [v[0] for v in vertices],
+        'y' : [v[1] for v in vertices],
+        'label' : [v[2] if len(v) > 2 else '' for v in vertices],
+        'colour' : [list(v[3]) if len(v) > 3 else DEFAULT_COLOUR for v in vertices],
+    }
+
+    arrows = {
+        'source' : [e[0] for e in edges],
+        'target' : [e[1] for e in edges],
+        'label' : [e[2] if len(e) > 2 else '' for e in edges],
+    }
+
+    for field, (default, path) in ARROW_FIELDS.items():
+        if field == 'alignment':
+            arrows[field] = [e[3] if len(e) > 3 else default for e in edges]
+        elif field == 'colour':
+            arrows[field] = [list(e[5]) if len(e) > 5 else
+                             _lookup(e[4], ('colour',), default) if len(e) > 4 else default
+                             for e in edges]
+        else:
+            arrows[field] = [_lookup(e[4], path, default) if len(e) > 4 else default
+                             for e in edges]
+
+    return {
+        'v' : COMPACT_VERSION,
+        'objects' : _columns(objects, OBJECT_FIELDS),
+        'arrows' : _columns(arrows, {field : default for field, (default, path) in ARROW_FIELDS.items()}),
+    }
+
+
+def from_compact(data:dict) -> list:
+    """
+    Decodes the compact encoding back into a Quiver array.
+    """
+    if not isinstance(data, dict) or data.get('v') != COMPACT_VERSION:
+        raise ValueError(f'Expected a version {COMPACT_VERSION} compact diagram.')
+
+    objects = data.get('objects', {})
+    arrows = data.get('arrows', {})
+
+    # BUGFIX: malformed columns came out as TypeErrors (500s) rather than ValueErrors (400s)
+    if not isinstance(objects, dict) or not isinstance(arrows, dict):
+        raise ValueError('The compact diagram\'s objects and arrows must be objects.')
+
+    def column(columns:dict, field:str, default, count:int=None) -> list:
+        values = columns.get(field)
+
+        if values is None:
+            return [default] * count
+
+        if not isinstance(values, list) or count is not None and len(values) != count:
+            raise ValueError(f'The compact diagram\'s "{field}" column is not a list of the right length.')
+
+        types = COLUMN_TYPES.get(field)
+
+        if types is not None and not all(isinstance(v, types) and not isinstance(v, bool)
+                                         for v in values):
+            raise ValueError(f'The compact diagram\'s "{field}" column has a value of the wrong type.')
+
+        return values
+
+    num_vertices = len(column(objects, 'x', 0, None if 'x' in objects else 0))
+    num_edges = len(column(arrows, 'source', 0, None if 'source' in arrows else 0))
+
+    format = [0, num_vertices]
+
+    for x, y, label, colour in zip(
+            column(objects, 'x', 0, num_vertices),
+            column(objects, 'y', 0, num_vertices),
+            column(objects, 'label', '', num_vertices),
+            column(objects, 'colour', DEFAULT_COLOUR, num_vertices)):
+        format.append([x, y, label, list(colour)])
+
+    columns = {field : column(arrows, field, default, num_edges)
+               for field, (default, path) in ARROW_FIELDS.items()}
+    sources = column(arrows, 'source', 0, num_edges)
+    targets = column(arrows, 'target', 0, num_edges)
+    labels = column(arrows, 'label', '', num_edges)
+
+    for k in range(num_edges):
+        options = {}
+
+        for field, (default, path) in ARROW_FIELDS.items():
+            if path is None:
+                continue
+
+            d = options
+            for key in path[:-1]:
+                d = d.setdefault(key, {})
+            d[path[-1]] = columns[field][k]
+
+        colour = list(columns['colour'][k])
+        options['colour'] = colour
+        format.append([sources[k], targets[k], labels[k], columns['alignment'][k], options, colour])
+
+    return format
@@ -0,0 +1,200 @@
+"""
+Write-behind of the editor's diagram saves (when WRITE_BEHIND_SAVES is on).
+
+A save is acknowledged as soon as it's journaled in the Django database as the diagram's
+PendingDiagramSave, which replaces any earlier save still pending for it, so only the latest
+payload per diagram is kept.  A background thread per worker flushes it to the graph once
+no newer save has come in for WRITE_BEHIND_DEBOUNCE seconds (or WRITE_BEHIND_MAX_DELAY after
+the first one, for an editor that never stops saving).  So the graph's write load is bounded
+by the flush rate rather than by how often the editor saves.
+
+A diagram's pending save is also flushed first thing when it's loaded, patched or committed,
+so reads never see the graph behind an acknowledged save.  Journal rows left over by a
+crashed worker are picked up by any worker's flusher (started with the app if 
+WRITE_BEHIND_FLUSHER is set, see DatabaseConfig.ready), or by the next load.
+"""
+
+from django.db import IntegrityError, transaction, close_old_connections
+from django.db.models import Q
+from django.core.exceptions import ObjectDoesNotExist
+from django.utils import timezone
+from dope.retry import CircuitOpenError
+from dope.settings import (INCREMENTAL_DIAGRAM_SAVE, WRITE_BEHIND_DEBOUNCE, WRITE_BEHIND_MAX_DELAY,
+                           WRITE_BEHIND_FLUSH_LEASE, WRITE_BEHIND_COMMIT_WAIT)
+from .models import PendingDiagramSave, Diagram, QuiverDiagram, get_model_by_uid
+from .diagram_cache import invalidate_diagram
+from datetime import timedelta
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger('database.graph')
+
+# Per-process counters:
+_stats_lock = threading.Lock()
+_stats = {
+    'queued' : 0,
+    'coalesced' : 0,
+    'flushed' : 0,
+    'flush_failures' : 0,
+}
+
+_flusher = None
+_flusher_lock = threading.Lock()
+
+
+def _count(stat:str):
+    with _stats_lock:
+        _stats[stat] += 1
+
+
+def write_diagram(diagram, format):
+    """
+    Writes the Quiver array `format` to the graph as the diagram's contents.
+    """
+    if INCREMENTAL_DIAGRAM_SAVE:
+        diagram.update_from_editor(format)
+    else:
+        diagram.delete_objects()
+        diagram.load_from_editor(format)
+
+    invalidate_diagram(diagram.uid)
+
+
+def queue_save(diagram_uid:str, username:str, format):
+    """
+    Journals `format` as the diagram's pending save, replacing any not yet flushed.
+    Once this returns, the save is durable.  Raises ValueError if `format` can't be saved,
+    rather than acknowledging a save that would then fail every flush.
+    """
+    QuiverDiagram.check_format(format)
+    now = timezone.now()
+    payload = json.dumps(format)
+    pending = PendingDiagramSave.objects.filter(diagram_uid=diagram_uid)
+
+    if pending.update(username=username, payload=payload, queued_at=now):
+        _count('coalesced')
+    else:
+        try:
+            with transaction.atomic():
+                PendingDiagramSave.objects.create(
+                    diagram_uid=diagram_uid, username=username, payload=payload,
+                    first_queued_at=now, queued_at=now)
+        except IntegrityError:
+            # A concurrent save journaled it first:
+            pending.update(username=username, payload=payload, queued_at=now)
+            _count('coalesced')
+
+    _count('queued')
+    start_flusher()
+
+
+def flush(diagram_uid:str) -> bool:
+    """
+    Writes the diagram's pending save to the graph and drops it from the journal.  Returns
+    False if there's none, or another flusher has claimed it.
+    """
+    now = timezone.now()
+    # Claim it, so that two flushers can't write different payloads out of order:
+    claimed = PendingDiagramSave.objects.filter(diagram_uid=diagram_uid).filter(
+        Q(flushing_until__isnull=True) | Q(flushing_until__lt=now)).update(
+        flushing_until=now + timedelta(seconds=WRITE_BEHIND_FLUSH_LEASE))
+
+    if not claimed:
+        return False
+
+    pending = PendingDiagramSave.objects.get(diagram_uid=diagram_uid)
+
+    try:
+        diagram = get_model_by_uid(Diagram, diagram_uid)
+        write_diagram(diagram, json.loads(pending.payload))
+
+    except ObjectDoesNotExist:
+        # The diagram's been deleted, so there's nothing to save it to:
+        logger.warning('Dropped the pending save of deleted diagram %s', diagram_uid)
+
+    except Exception:
+        _count('flush_failures')
+        PendingDiagramSave.objects.filter(diagram_uid=diagram_uid).update(flushing_until=None)
+        raise
+
+    _count('flushed')
+
+    # Unless a newer save came in meanwhile, which stays pending:
+    if not PendingDiagramSave.objects.filter(
+            diagram_uid=diagram_uid, queued_at=pending.queued_at).delete()[0]:
+        PendingDiagramSave.objects.filter(diagram_uid=diagram_uid).update(flushing_until=None)
+
+    return True
+
+
+def commit(diagram_uid:str, wait:float=WRITE_BEHIND_COMMIT_WAIT) -> bool:
+    """
+    Flushes the diagram's pending save now, waiting up to `wait` seconds for it if another
+    flusher is already on it.  Returns True if there was one.
+    """
+    pending = False
+    # BUGFIX: this waited out the whole flush lease, holding up a request for a minute
+    give_up_at = time.monotonic() + wait
+
+    while PendingDiagramSave.objects.filter(diagram_uid=diagram_uid).exists():
+        pending = True
+
+        if flush(diagram_uid):
+            continue
+
+        if time.monotonic() >= give_up_at:
+            raise TimeoutError(f'Timed out waiting for diagram {diagram_uid} to be flushed.')
+        time.sleep(0.05)
+
+    return pending
+
+
+def flush_due() -> int:
+    """
+    Flushes every pending save that's past its debounce window.  Returns how many were.
+    """
+    now = timezone.now()
+    due = PendingDiagramSave.objects.filter(
+        Q(queued_at__lte=now - timedelta(seconds=WRITE_BEHIND_DEBOUNCE)) |
+        Q(first_queued_at__lte=now - timedelta(seconds=WRITE_BEHIND_MAX_DELAY)))
+    count = 0
+
+    for diagram_uid in due.values_list('diagram_uid', flat=True):
+        try:
+            count += flush(diagram_uid)
+        except CircuitOpenError:
+            break       # They'd all fail fast, so retry on the next round
+        except Exception:
+            logger.exception('Failed to flush the pending save of diagram %s', diagram_uid)
+
+    return count
+
+
+def _flush_loop():
+    while True:
+        time.sleep(WRITE_BEHIND_DEBOUNCE / 2)
+        close_old_connections()
+
+        try:
+            flush_due()
+        except Exception:
+            logger.exception('Write-behind flush failed')
+
+
+def start_flusher():
+    global _flusher
+
+    with _flusher_lock:
+        if _flusher is None:
+            _flusher = threading.Thread(target=_flush_loop, name='write-behind', daemon=True)
+            _flusher.start()
+
+
+def write_behind_stats() -> dict:
+    with _stats_lock:
+        stats = dict(_stats)
+
+    stats['pending'] = PendingDiagramSave.objects.count()
+    return stats
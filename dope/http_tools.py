@@ -1,8 +1,10 @@
-from .settings import MAX_TEXT_LENGTH
+from .settings import MAX_TEXT_LENGTH, MAX_DECOMPRESSED_BODY_SIZE
 from django.shortcuts import render, HttpResponse
+from django.utils.http import parse_etags
 from django.contrib import messages
 from dope.python_tools import full_qualname
 import json
+import zlib
 
 
 def render_error(request, error_msg=None, excep=None):
@@ -34,7 +36,8 @@ def get_posted_text(request, key=None, max_len=None): # TODO:  max_len=MAX_TEXT_
     text = request.POST[key]
     text = text.strip()
     
-    if len(text) > max_len:
+    # BUGFIX: the default max_len of None made every call raise TypeError
+    if max_len is not None and len(text) > max_len:
         raise ValueError(f'The text exceeded max length {max_len}')
     
     return text
@@ -62,6 +65,66 @@ def get_model_id(request, edit_mode):
     return edit_id
 
 
+def etag_matches(request, etag:str) -> bool:
+    """
+    Returns whether the request's If-None-Match header matches the given (quoted) ETag,
+    using the weak comparison that RFC 7232 prescribes for If-None-Match.
+    """
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    
+    if not if_none_match:
+        return False
+    
+    if if_none_match.strip() == '*':
+        return True
+    
+    def strip_weak(tag):
+        return tag[2:] if tag.startswith('W/') else tag
+    
+    etag = strip_weak(etag)
+    return any(strip_weak(tag) == etag for tag in parse_etags(if_none_match))
+
+
+def accepts_media_type(request, media_type:str) -> bool:
+    """
+    Whether the request's Accept header explicitly lists media_type.  Unlike 
+    request.accepts(), wildcards like */* don't count, so that browsers keep getting 
+    the default representation.
+    """
+    accept = request.META.get('HTTP_ACCEPT', '')
+    return any(part.split(';')[0].strip().lower() == media_type for part in accept.split(','))
+
+
+def decoded_body(request) -> bytes:
+    """
+    The request body, inflated if it was sent with a gzip or deflate Content-Encoding.
+    Inflation stops at MAX_DECOMPRESSED_BODY_SIZE so that a tiny body can't expand into
+    gigabytes.
+    """
+    encoding = request.headers.get('Content-Encoding', 'identity').strip().lower()
+    
+    if encoding == 'identity':
+        return request.body
+    
+    if encoding == 'gzip':
+        wbits = 16 + zlib.MAX_WBITS
+    elif encoding == 'deflate':
+        wbits = zlib.MAX_WBITS
+    else:
+        raise ValueError(f'Unsupported Content-Encoding "{encoding}".')
+    
+    try:
+        decompressor = zlib.decompressobj(wbits)
+        body = decompressor.decompress(request.body, MAX_DECOMPRESSED_BODY_SIZE)
+    except zlib.error as e:
+        raise ValueError(f'The {encoding} request body could not be inflated: {e}')
+    
+    if decompressor.unconsumed_tail:
+        raise ValueError(f'The request body inflates to over {MAX_DECOMPRESSED_BODY_SIZE} bytes.')
+    
+    return body
+
+
 # `data` is a python dictionary
 def render_to_json(request, data):
     return HttpResponse(
@@ -0,0 +1,78 @@
+from collections import namedtuple
+from functools import lru_cache
+from .variable import Variable
+from .settings import LABEL_TEMPLATE_CACHE_SIZE
+
+
+# template & variables are tuples since compiled labels are shared, callers that want to 
+# edit a template (e.g. Variable.subst_vars_into_template) must copy it into a list first.
+# shape is the label's canonical signature (see label_shape) for indexed equality lookups.
+LabelTemplate = namedtuple('LabelTemplate', 
+                           ['template', 'variables', 'neo4j_regex', 'regex', 'shape'])
+
+
+@lru_cache(maxsize=LABEL_TEMPLATE_CACHE_SIZE)
+def compile_label(label:str) -> LabelTemplate:
+    """
+    Parses a LaTeX label into its template once per process (LRU cached), along with
+    the Neo4j regex and the Python regex (from Variable.variable_match_regex) matching it,
+    and its shape signature.
+    """
+    template, variables = Variable.parse_into_template(label)
+    regex, var_count = Variable.variable_match_regex(template)
+    return LabelTemplate(tuple(template), tuple(variables), 
+                         Variable.neo4j_match_regex(template), regex, label_shape(template))
+
+
+def label_shape(template) -> str:
+    """
+    The canonical shape signature of a label template:  keywords and literal text are kept,
+    and each variable occurrence is replaced by a positional placeholder $0, $1, ...
+    So e.g. "A \\times B" and "X \\times X" both have shape "$0 \\times $1", and labels that
+    could match each other under a variable substitution have equal shapes.
+    """
+    shape = ''
+    var_count = 0
+    for piece in template:
+        if isinstance(piece, Variable):
+            shape += f'${var_count}'
+            var_count += 1
+        else:  # Keyword or str
+            shape += str(piece)
+    return shape
+
+
+def bind_label(compiled:LabelTemplate, text:str, bindings:dict):
+    """
+    Matches text against a compiled pattern label.  Returns None if it doesn't match or 
+    contradicts the given variable bindings, otherwise the dict of newly bound variables.
+    """
+    match = compiled.regex.fullmatch(text)
+    
+    if match is None:
+        return None
+    
+    new_bindings = {}
+    
+    for k, var in enumerate(compiled.variables):
+        value = match.group(f'V{k}')
+        bound = bindings[var] if var in bindings else new_bindings.get(var)
+        
+        if bound is None:
+            new_bindings[var] = value
+        elif bound != value:
+            return None
+        
+    return new_bindings
+
+
+def label_template_cache_stats() -> dict:
+    info = compile_label.cache_info()
+    lookups = info.hits + info.misses
+    return {
+        'hits' : info.hits,
+        'misses' : info.misses,
+        'size' : info.currsize,
+        'max_size' : info.maxsize,
+        'hit_rate' : info.hits / lookups if lookups else 0.0,
+    }
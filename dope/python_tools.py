@@ -1,12 +1,8 @@
-from .settings import MAX_BAD_CONN_RETRIES
+from .retry import graph_retry_policy
 
 def call_with_retry(func, *args, **kwargs):
-    tries = 0
-    while tries < MAX_BAD_CONN_RETRIES:
-        try:
-            return func(*args, **kwargs)
-        except Exception as e:
-            tries += 1
+    # Retries transient errors with backoff (see dope.retry), then raises the last error.
+    return graph_retry_policy.call(func, *args, **kwargs)
 
 def full_qualname(o):
     module = o.__class__.__module__
@@ -0,0 +1,186 @@
+"""
+Retrying of calls to the graph server.
+
+Errors are classified as transient (the server or connection is unavailable, a deadlock,
+a leader switch...) or permanent (bad query, constraint violation, a bug).  Only transient
+ones are retried, with exponential backoff and full jitter so that clients which failed
+together don't retry in lockstep.  A circuit breaker shared by all calls counts consecutive
+transient failures, and once it trips, calls fail fast with CircuitOpenError until a
+cool-down has passed; then a single trial call is let through to probe the server.
+So an outage doesn't get multiplied into a retry storm against a struggling server.
+"""
+
+from .settings import (MAX_BAD_CONN_RETRIES, RETRY_BASE_DELAY, RETRY_MAX_DELAY,
+                       CIRCUIT_BREAKER_THRESHOLD, CIRCUIT_BREAKER_RESET_TIMEOUT)
+import asyncio
+import random
+import threading
+import time
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+def is_transient_error(e:Exception) -> bool:
+    # The Neo4j driver's own verdict (ServiceUnavailable, SessionExpired, TransientError...):
+    is_retryable = getattr(e, 'is_retryable', None)
+
+    if callable(is_retryable):
+        return is_retryable()
+
+    return isinstance(e, (ConnectionError, TimeoutError))
+
+
+class CircuitBreaker:
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, threshold=CIRCUIT_BREAKER_THRESHOLD,
+                 reset_timeout=CIRCUIT_BREAKER_RESET_TIMEOUT):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """
+        Raises CircuitOpenError unless a call may go through now.
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return
+
+            if self.state == self.OPEN and \
+               time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN    # Let this one call through as a probe
+                return
+
+        _count('fast_failures')
+        raise CircuitOpenError(
+            'The graph database is unavailable right now, please try again shortly.')
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                if self.state != self.OPEN:
+                    _count('trips')
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def record_abandoned(self):
+        # A call cut short (cancelled, interrupted) says nothing about the server.  But if it
+        # was the half-open probe, the next call must be let through to probe instead:
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+
+class RetryPolicy:
+    def __init__(self, breaker:CircuitBreaker, max_tries=MAX_BAD_CONN_RETRIES,
+                 base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY):
+        self.breaker = breaker
+        self.max_tries = max_tries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def delay(self, attempt:int) -> float:
+        # "Full jitter": uniform over [0, capped exponential backoff]
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _should_retry(self, e:Exception, attempt:int, retry:bool) -> bool:
+        if not is_transient_error(e):
+            _count('permanent_failures')
+            self.breaker.record_success()   # The server did answer
+            return False
+
+        _count('transient_failures')
+        self.breaker.record_failure()
+
+        if not retry or attempt + 1 >= self.max_tries or self.breaker.state == CircuitBreaker.OPEN:
+            return False
+
+        _count('retries')
+        return True
+
+    def call(self, func, *args, retry=True, **kwargs):
+        """
+        Calls func, retrying it on transient errors unless retry is False (e.g. when inside
+        a transaction, which a failure aborts as a whole).  The last error is re-raised.
+        """
+        for attempt in range(self.max_tries):
+            self.breaker.before_call()
+
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if not self._should_retry(e, attempt, retry):
+                    raise
+                time.sleep(self.delay(attempt))
+            except BaseException:
+                # BUGFIX: a KeyboardInterrupt etc. during the probe left the breaker half-open,
+                # failing every call fast from then on
+                self.breaker.record_abandoned()
+                raise
+            else:
+                self.breaker.record_success()
+                return result
+
+    async def acall(self, func, *args, retry=True, **kwargs):
+        """
+        The same as call() for a coroutine function func.
+        """
+        for attempt in range(self.max_tries):
+            self.breaker.before_call()
+
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as e:
+                if not self._should_retry(e, attempt, retry):
+                    raise
+                await asyncio.sleep(self.delay(attempt))
+            except BaseException:
+                # E.g. the CancelledError of a request that went away
+                self.breaker.record_abandoned()
+                raise
+            else:
+                self.breaker.record_success()
+                return result
+
+
+# Per-process counters:
+_stats_lock = threading.Lock()
+_stats = {
+    'retries' : 0,
+    'transient_failures' : 0,
+    'permanent_failures' : 0,
+    'trips' : 0,
+    'fast_failures' : 0,
+}
+
+
+def _count(stat:str):
+    with _stats_lock:
+        _stats[stat] += 1
+
+
+graph_breaker = CircuitBreaker()
+graph_retry_policy = RetryPolicy(graph_breaker)
+
+
+def retry_stats() -> dict:
+    with _stats_lock:
+        stats = dict(_stats)
+
+    stats['circuit'] = graph_breaker.state
+    return stats
@@ -60,6 +60,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'database.graph_instrumentation.GraphQueryMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -115,6 +116,27 @@ else:
         'default' : dj_database_url.config(conn_max_age=600)
     }
 
+# Cache
+# https://docs.djangoproject.com/en/3.1/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Serialized Quiver JSON of diagrams, validated against each diagram's revision:
+    'diagrams': {
+        'BACKEND': os.environ.get(
+            'DIAGRAM_CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.environ.get('DIAGRAM_CACHE_LOCATION', 'diagrams'),
+        'TIMEOUT': 60 * 60,
+        'OPTIONS': {
+            'MAX_ENTRIES': 1000,
+        },
+    },
+}
+
+DIAGRAM_CACHE_ALIAS = 'diagrams'
+
 # Password validation
 # https://docs.djangoproject.com/en/3.1/ref/settings/#auth-password-validators
 
@@ -166,6 +188,14 @@ def neo4j_url():
 
 NEOMODEL_NEO4J_BOLT_URL = neo4j_url()
 
+# 'neo4j', or 'memory' for the in-process stand-in graph (see database.memory_graph) that's
+# used for profiling & benchmarking without a live Neo4j instance:
+GRAPH_BACKEND = os.environ.get('GRAPH_BACKEND', 'neo4j')
+
+# Serve the diagram create / load / save views from database.async_views, which talk to 
+# Neo4j through its async driver.  Only worthwhile when served over ASGI (see Procfile.asgi):
+ASYNC_DIAGRAM_VIEWS = os.environ.get('ASYNC_DIAGRAM_VIEWS', '0') == '1'
+
 NEOMODEL_SIGNALS = True
 NEOMODEL_FORCE_TIMEZONE = False
 NEOMODEL_ENCRYPTED_CONNECTION = False  # TODO: how do we switch this on without error?
@@ -194,9 +224,71 @@ MAX_TEXT_LENGTH = 123
 DEFAULT_CATEGORY_NAME = 'C'
 
 MAX_USER_EDIT_DIAGRAMS = 8
+DIAGRAM_PAGE_SIZE = 50
+
+# Cap on the inflated size of a gzip / deflate encoded request body (bytes):
+MAX_DECOMPRESSED_BODY_SIZE = 64 * 1024 * 1024
 MAX_BAD_CONN_RETRIES = 5
 
+# Backoff between retries of transient graph errors (seconds, see dope.retry):
+RETRY_BASE_DELAY = 0.1
+RETRY_MAX_DELAY = 2.0
+
+# Consecutive transient graph failures that trip the circuit breaker, and how long it then
+# fails fast (seconds) before letting a trial call through:
+CIRCUIT_BREAKER_THRESHOLD = 5
+CIRCUIT_BREAKER_RESET_TIMEOUT = 30
+
+# Save only the vertices & arrows that changed since the last save, rather than
+# deleting and recreating the whole diagram:
+INCREMENTAL_DIAGRAM_SAVE = True
+
+# How long a diagram checkout lasts unless renewed (seconds).  Loading & saving renew it:
+CHECKOUT_LEASE_TTL = 15 * 60
+
+# Acknowledge diagram saves once they're journaled in the Django database, and write them
+# to the graph later (see database.write_behind):
+WRITE_BEHIND_SAVES = os.environ.get('WRITE_BEHIND_SAVES', '0') == '1'
+
+# Start the background flusher when the app loads, so saves journaled before a restart are
+# flushed without waiting for a new one.  Only set this in the web server's environment:
+WRITE_BEHIND_FLUSHER = os.environ.get('WRITE_BEHIND_FLUSHER', '0') == '1'
+
+# A journaled save is flushed once no newer one has come in for WRITE_BEHIND_DEBOUNCE 
+# seconds, or at the latest WRITE_BEHIND_MAX_DELAY seconds after the first one it replaced:
+WRITE_BEHIND_DEBOUNCE = 2.0
+WRITE_BEHIND_MAX_DELAY = 10.0
+
+# How long a flusher's claim on a journaled save lasts (seconds) if it dies mid-flush:
+WRITE_BEHIND_FLUSH_LEASE = 60
+
+# How long a load, patch or commit waits (seconds) for a save that another flusher is 
+# writing, before giving up with a TimeoutError:
+WRITE_BEHIND_COMMIT_WAIT = 5
+
+# Max number of nodes deleted per statement when clearing out a diagram:
+DIAGRAM_DELETE_BATCH_SIZE = 5000
+
+# Bound on the candidate placements tried by the in-memory diagram pattern matcher:
+MAX_PATTERN_MATCH_STEPS = 100000
+
+# Number of parsed label templates kept (process-wide) by dope.label_templates.compile_label:
+LABEL_TEMPLATE_CACHE_SIZE = 4096
+
+# Longest MAPS_TO path (in arrows) enumerated when turning a diagram into a search query:
+MAX_SEARCH_PATH_LENGTH = 8
+
+# How many of a request's slowest graph statements get reported (see GraphQueryMiddleware):
+GRAPH_SLOWEST_STATEMENTS = 3
+
 # Activate Django-Heroku.
 django_heroku.settings(locals())
 
+# One structured log line per request with graph queries (see database.graph_instrumentation):
+LOGGING = locals().get('LOGGING') or {'version': 1, 'disable_existing_loggers': False}
+LOGGING.setdefault('handlers', {})['graph_console'] = {'class': 'logging.StreamHandler'}
+LOGGING.setdefault('loggers', {})['database.graph'] = {
+    'handlers': ['graph_console'], 'level': 'INFO', 'propagate': False,
+}
+
 #MESSAGE_STORAGE = 'django.contrib.messages.storage.session.SessionStorage'
\ No newline at end of file
@@ -119,7 +119,12 @@ class Variable:
         
         for i in range(2):
             if subscript is None and text.startswith('_', pos):
-                subscript = Variable.subscript_parser.match(text, pos=pos+1)
+                # BUGFIX: a subscript that's not a number (x_i, \eta_{X}) or is missing (A_)
+                # crashed here.  Now the '_' and what follows are left as literal text.
+                match = Variable.subscript_parser.match(text, pos=pos+1)
+                if match is None:
+                    break
+                subscript = match
                 pos = subscript.span()[1]
             elif prime is None and text.startswith("'", pos):
                 prime = Variable.prime_parser.match(text, pos=pos)
@@ -160,6 +165,19 @@ class Variable:
         
         return template
 
+    @staticmethod
+    def neo4j_match_regex(template):
+        """
+        Returns a Neo4j (Cypher string literal) regex matching any label of the template's shape.
+        """
+        regex = ""
+        for piece in template:
+            if isinstance(piece, Variable):
+                regex += ".+"
+            else:  # Keyword or str
+                regex += neo4j_escape_regex_str(str(piece))
+        return regex
+    
     @staticmethod 
     def variable_match_regex(template):
         regex = ''